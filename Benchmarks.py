@@ -0,0 +1,609 @@
+"""
+Benchmarks for the hot paths in Classes. These are not unit tests, they print timings.
+run all of them with
+    python Benchmarks.py
+or only some with
+    python Benchmarks.py schedule
+"""
+import os
+import sys
+import time
+import random
+import datetime
+
+from Classes import *
+
+
+def oracle_matches(target_time, moment):
+    """
+    checks one second against a targetTime dict the slow and obvious way, without any of Schedule's bitsets
+    """
+    for key, value in (('$Y', moment.year), ('$M', moment.month), ('%H', moment.hour), ('%M', moment.minute),
+                       ('%S', moment.second)):
+        if target_time[key] and value not in target_time[key]:
+            return False
+    days = target_time['$D']
+    weekdays = target_time['$W']
+    day_ok = moment.day in days
+    weekday_ok = moment.weekday() in weekdays
+    if days and weekdays:
+        return day_ok or weekday_ok
+    if days:
+        return day_ok
+    if weekdays:
+        return weekday_ok
+    return True
+
+
+def oracle_next_time(target_time, after, limit):
+    """
+    steps forward one second at a time from 'after' until a valid second is found or 'limit' seconds have passed
+    """
+    moment = after.replace(microsecond=0)
+    second = datetime.timedelta(seconds=1)
+    for i in range(limit):
+        moment += second
+        if oracle_matches(target_time, moment):
+            return moment
+    return None
+
+
+def schedule(runs=20):
+    """
+    compares Schedule.next_time against the second-by-second oracle from random starting points and times both
+    """
+    specs = [
+        ('%M:%S', '16,17,19,20,25,26,27,28,52,53:0,20,30,40,50'),
+        ('%H:%M:%S', '9,17:30:0'),
+        ('$w %H:%M', 'monday,friday 8:15'),
+        ('$W %H:%M:%S', '6 23:59:59'),
+        ('%h:%M:%S', '12:0:0'),
+        ('$D %H:%M:%S', '1,15,31 6:0:0'),
+    ]
+    limit = 60 * 60 * 24 * 40
+    scheduler = WaitingQueue()
+    random.seed(1)
+    start = datetime.datetime(2014, 1, 1)
+    for time_format, target_time in specs:
+        variable = TimeVariable(target_time, scheduler, time_format)
+        fast_total = 0.0
+        slow_total = 0.0
+        for run in range(runs):
+            after = start + datetime.timedelta(seconds=random.randint(0, 60 * 60 * 24 * 365 * 4),
+                                               microseconds=random.randint(0, 999999))
+            began = time.time()
+            fast = variable.get_next_time(after)
+            fast_total += time.time() - began
+            began = time.time()
+            slow = oracle_next_time(variable.targetTime, after, limit)
+            slow_total += time.time() - began
+            if fast != slow:
+                raise AssertionError(time_format + ' ' + target_time + ' after ' + str(after) + ': schedule gave ' +
+                                     str(fast) + ', oracle gave ' + str(slow))
+        began = time.time()
+        variable.get_next_times(1000, start)
+        batch = time.time() - began
+        print '%-16s %-45s next_time %8.1f us  oracle %10.1f us  next_times(1000) %7.2f ms' % (
+            time_format, target_time, fast_total / runs * 1e6, slow_total / runs * 1e6, batch * 1e3)
+    # a schedule with nothing left to run must stay out of the scheduler, and not break the timers added after it
+    scheduler = WaitingQueue()
+    used_up = TimeVariable('2001', scheduler, '$Y')
+    TimeVariable('9,17:30:0', scheduler, '%H:%M:%S')
+    used_up.handle.reschedule()
+    scheduler.update()
+    if used_up.value is not None or used_up.handle.pending() or len(scheduler) != 1:
+        raise AssertionError('a used up schedule was put in the scheduler')
+    scheduler.close()
+
+
+def timer_creation(count=20000):
+    """
+    creates many TimeVariables from a handful of specs, first with the schedule cache as it is and then with it
+    emptied before every timer so each one is parsed again
+    """
+    specs = [
+        ('%M:%S', '16,17,19,20,25,26,27,28,52,53:0,20,30,40,50'),
+        ('%H:%M:%S', '9,17:30:0'),
+        ('$w %H:%M', 'monday,friday 8:15'),
+        ('%h:%M:%S', '12:0:0'),
+    ]
+    scheduler = WaitingQueue()
+    began = time.time()
+    for i in range(count):
+        time_format, target_time = specs[i % len(specs)]
+        TimeVariable(target_time, scheduler, time_format)
+    cached = time.time() - began
+    shared = len(schedule_cache)
+    scheduler = WaitingQueue()
+    began = time.time()
+    for i in range(count):
+        time_format, target_time = specs[i % len(specs)]
+        schedule_cache.clear()
+        TimeVariable(target_time, scheduler, time_format)
+    uncached = time.time() - began
+    print '%d timers: cached %.1f us each, uncached %.1f us each, %d schedules shared' % (
+        count, cached / count * 1e6, uncached / count * 1e6, shared)
+
+
+def input_latency(count=2000):
+    """
+    time from writing a line into a pipe to the command parsed from it running, with the InputDriver on a Reactor
+    in another thread
+    """
+    import os
+    import threading
+    import Reactor
+    read_end, write_end = os.pipe()
+    latencies = []
+    arrived = threading.Event()
+
+    def parse(data):
+        return Command([lambda: (latencies.append(time.time() - float(data)), arrived.set())], [])
+
+    reactor = Reactor.Reactor()
+    InputDriver(read_end, parse).attach(reactor)
+    thread = threading.Thread(target=reactor.run_forever, name='reactor')
+    thread.start()
+    for i in range(count):
+        arrived.clear()
+        os.write(write_end, repr(time.time()) + '\n')
+        arrived.wait(1)
+    reactor.stop()
+    thread.join()
+    latencies.sort()
+    print '%d lines: p50 %.1f us, p99 %.1f us, max %.1f us' % (
+        len(latencies), latencies[len(latencies) // 2] * 1e6, latencies[int(len(latencies) * .99)] * 1e6,
+        latencies[-1] * 1e6)
+
+
+def pixel_bank(length=10000, frames=20):
+    """
+    a strip of 'length' pixels stored as one RangedVariable each in a VariableMatrix against one VariableArray:
+    time to change every pixel and post the frame, and the memory the values take
+    """
+    posted = []
+
+    def send(value, *args):
+        posted.append(value)
+
+    matrix = VariableMatrix(dict((i, RangedVariable(0, 0, 255, send, i)) for i in range(length)))
+    began = time.time()
+    for frame in range(frames):
+        for i in range(length):
+            matrix[i] = (i + frame) % 300
+        matrix.post()
+    per_variable = (time.time() - began) / frames
+    sample = matrix.variables[0]
+    variable_bytes = sys.getsizeof(sample)
+
+    strip = VariableArray(length, 0, 0, 255, 'B', send)
+    began = time.time()
+    for frame in range(frames):
+        strip[:] = [(i + frame) % 300 for i in range(length)]
+        strip.post()
+    per_array = (time.time() - began) / frames
+    print '%d pixels per frame: variables %.2f ms, array %.2f ms; about %d bytes per variable, %d per element' % (
+        length, per_variable * 1e3, per_array * 1e3, variable_bytes, strip.value.itemsize)
+
+
+def resident_memory():
+    """
+    :return: bytes of memory the process is using now
+    """
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+class UnslottedVariable():
+    """
+    an IntegerVariable laid out the way Variables were before __slots__: an instance dictionary, a list per kind of
+    listener and a post argument tuple of its own. Only made by variable_memory, to measure against
+    """
+
+    def __init__(self, initial=0, post_method=echo, *post_arguments):
+        self.postMethod = post_method
+        self.postArgs = post_arguments
+        self.value = initial
+        self.listeners = []
+        self.change_listeners = []
+        self.saved_notifications = 0
+        self.version = 0
+        self.owners = None
+        self.min = None
+        self.max = None
+
+
+def variable_memory(count=1000000):
+    """
+    creates 'count' IntegerVariables, as a pixel strip would, and reports the memory used per variable, next to the
+    memory used by as many UnslottedVariables. Every variable gets the strip name and its own index as post arguments,
+    so the intern table is filled past interned_limit too
+    """
+    import gc
+    results = []
+    for kind in (UnslottedVariable, IntegerVariable):  # each in a process of its own, so neither reuses the other's
+        read, write = os.pipe()
+        if os.fork() == 0:
+            gc.collect()
+            before = resident_memory()
+            variables = [kind(i % 256, echo, 'strip', i) for i in range(count)]
+            used = resident_memory() - before
+            os.write(write, '%f %d %d' % (float(used) / count, sys.getsizeof(variables[0]), len(interned_arguments)))
+            os._exit(0)
+        os.close(write)
+        result = os.read(read, 256).split()
+        os.close(read)
+        os.wait()
+        results.append((float(result[0]), int(result[1])))
+    print '%d IntegerVariables: %.1f bytes each (sys.getsizeof %d), before __slots__ %.1f (sys.getsizeof %d), ' \
+          '%d post argument tuples interned' % ((count,) + results[1] + results[0] + (int(result[2]),))
+
+
+def arithmetic(repeat=200000):
+    """
+    time per operation for the IntegerVariable operators, next to the same operation on a plain int
+    """
+    import timeit
+    setup = 'from Classes import IntegerVariable, echo\n' \
+            'plain = 5\n' \
+            'variable = IntegerVariable(5)\n' \
+            'other = IntegerVariable(2)\n' \
+            'listened = IntegerVariable(5)\n' \
+            'for i in range(4):\n' \
+            '    listened.listen(echo)\n'
+    cases = [
+        ('int + int', 'plain + 1'),
+        ('variable + int', 'variable + 1'),
+        ('int + variable', '1 + variable'),
+        ('variable + float', 'variable + 1.5'),
+        ('variable + variable', 'variable + other'),
+        ('variable * variable', 'variable * other'),
+        ('variable += int', 'variable += 1'),
+        ('listened += int, 4 listeners', 'listened += 1'),
+        ('100 x listened += int, batched', 'with listened.batch_update():\n    for i in range(100):\n'
+                                           '        listened += 1'),
+    ]
+    for label, statement in cases:
+        number = repeat // 100 if 'batched' in label else repeat
+        seconds = min(timeit.repeat(statement, setup, number=number, repeat=3))
+        print '%-32s %8.3f us' % (label, seconds / number * 1e6)
+
+
+def rules(count=10000):
+    """
+    loads a config with 'count' rules over 100 variables, each with two conditions and a command writing to one of
+    100 other variables, and posts some of them
+    """
+    import StringIO
+    import RuleLoader
+    lines = ['<esp>']
+    for i in range(100):
+        lines.append('<variable name="v%d" type="integer" value="%d"/>' % (i, i))
+        lines.append('<variable name="out%d" type="integer" value="0"/>' % i)
+    for i in range(count):
+        lines.append('<rule name="r%d" triggers="v%d"><condition>v%d &gt; %d</condition>'
+                     '<condition>v%d &lt; 1000</condition><command>out%d += v%d.value</command></rule>' % (
+                         i, i % 100, i % 100, i % 7, (i + 1) % 100, i % 100, i % 100))
+    lines.append('</esp>')
+    source = '\n'.join(lines)
+    RuleLoader.code_cache.clear()
+    began = time.time()
+    config = RuleLoader.load(StringIO.StringIO(source))
+    loaded = time.time() - began
+    conditions = config.conditions.values()
+    began = time.time()
+    for i in range(100):
+        config.rules['r%d' % (i * 97 % count)].post()
+    ran = time.time() - began
+    print '%d rules: loaded in %.1f ms, %d conditions, %d code objects; 100 posts %.2f ms, %d evaluations' % (
+        len(config.rules), loaded * 1e3, len(conditions), len(RuleLoader.code_cache), ran * 1e3,
+        sum(condition.evaluations for condition in conditions))
+
+
+def lateness(count=1000, seconds=6):
+    """
+    'count' TimeVariables on one WaitingQueue running in its own thread, each firing every 5 seconds, spread over the
+    seconds: how late their posts are
+    """
+    import threading
+    scheduler = WaitingQueue()
+    timers = []
+    for i in range(count):
+        target_time = ','.join(str(second) for second in range(i % 5, 60, 5))
+        timers.append(TimeVariable(target_time, scheduler, '%S'))
+    thread = threading.Thread(target=scheduler.run, name='scheduler')
+    thread.daemon = True
+    thread.start()
+    time.sleep(seconds)
+    summary = scheduler.lateness.summary()
+    print '%d timers, %d posts: lateness p50 %.2f ms, p99 %.2f ms (recent p99 %.2f ms), max %.2f ms' % (
+        count, summary['count'], summary['p50'] * 1e3, summary['p99'] * 1e3,
+        scheduler.lateness.recent_percentile(.99) * 1e3, summary['max'] * 1e3)
+    for timer in timers:
+        timer.handle.cancel()
+
+
+def blur(values):
+    """
+    a CPU-heavy command for cpu_commands: a three point moving average over values, done in python
+    """
+    return [(values[i - 1] + values[i] + values[i + 1]) // 3 for i in range(1, len(values) - 1)]
+
+
+def cpu_commands(jobs=8, length=200000):
+    """
+    runs 'jobs' blur commands over a VariableArray inline and through the process pool: how long the thread that
+    executed the Event was held up, and how long until every result was back
+    """
+    import threading
+    import ProcessPool
+    strip = VariableArray(length, 7, 0, 255, 'B')
+    register_module('strip', strip)
+    finished = threading.Semaphore(0)
+    command = ProcessPool.cpu_bound(blur, done=lambda result, *modules: finished.release())
+    event = Event([command] * jobs, ['strip'], [], [])
+    began = time.time()
+    for i in range(jobs):  # what the commands cost on the event thread, given the same array the workers get
+        blur(strip.value)
+    inline = time.time() - began
+    pool = ProcessPool.start()
+    began = time.time()
+    event.post()
+    held = time.time() - began
+    for i in range(jobs):
+        finished.acquire()
+    pooled = time.time() - began
+    ProcessPool.stop()
+    print '%d blurs of %d elements on %d processes: inline %.0f ms; pool held the event thread %.2f ms, ' \
+          'done in %.0f ms' % (jobs, length, pool.processes, inline * 1e3, held * 1e3, pooled * 1e3)
+
+
+def bus_node(index, ports, sets, results):
+    """
+    one node of the bus benchmark, run in its own process: sets its own counter 'sets' times, then waits for every
+    other node's counter to arrive at 'sets' too
+    """
+    import Bus
+    bus = Bus.Bus('node%d' % index, ('127.0.0.1', ports[index]),
+                  [('127.0.0.1', port) for port in ports if port != ports[index]])
+    counters = [bus.variable('counter%d' % i) for i in range(len(ports))]
+    bus.start()
+    time.sleep(.5)  # let every node start
+    for i in range(1, sets + 1):
+        counters[index].set(i)
+        time.sleep(.0005)
+    began = time.time()
+    while any(counter.value != sets for counter in counters) and time.time() - began < 10:
+        time.sleep(.001)
+    results.put((index, [counter.value for counter in counters], bus.latency.summary(), bus.sent, bus.applied))
+
+
+def bus(nodes=3, sets=1000):
+    """
+    'nodes' processes on loopback sharing one counter each: whether they all end up with every counter at its last
+    value, how late the batches arrive and how many datagrams it took
+    """
+    import multiprocessing
+    ports = [47300 + i for i in range(nodes)]
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=bus_node, args=(i, ports, sets, results)) for i in range(nodes)]
+    for process in processes:
+        process.start()
+    for i in range(nodes):
+        index, values, latency, sent, applied = results.get(timeout=30)
+        print 'node%d: counters %s, %d datagrams sent for %d sets, applied %d remote sets, latency p50 %.2f ms, ' \
+              'p99 %.2f ms' % (index, values, sent, sets, applied, latency['p50'] * 1e3, latency['p99'] * 1e3)
+    for process in processes:
+        process.join()
+
+
+def metrics(repeat=200000):
+    """
+    time per set() of a listened Variable and per Event post with metrics disabled and enabled
+    """
+    import timeit
+    import Metrics
+    setup = 'from Classes import IntegerVariable, Event, echo\n' \
+            'variable = IntegerVariable(5)\n' \
+            'variable.listen(echo)\n' \
+            'event = Event([echo], [], [], [lambda *modules: True], name="bench")\n'
+    for state in ('disabled', 'enabled'):
+        if state == 'enabled':
+            Metrics.enable()
+        set_time = min(timeit.repeat('variable.set(1)', setup, number=repeat, repeat=3)) / repeat
+        post_time = min(timeit.repeat('event.post()', setup, number=repeat, repeat=3)) / repeat
+        print 'metrics %-8s set() %.3f us, Event.post() %.3f us' % (state, set_time * 1e6, post_time * 1e6)
+    Metrics.disable()
+
+
+def device_frames(posts=8, rate=60, seconds=2, connect_delay=.005, pixels=300):
+    """
+    frames per second a fake LED controller receives from a driver that posts 'posts' times per frame at 'rate' frames
+    per second: connecting for every post, against Transport's pooled connections and coalesced writes. Every new
+    connection takes connect_delay seconds, like the handshake of a device on Wi-Fi
+    """
+    import socket
+    import FakeDevice
+    import Transport
+    frame_size = pixels * 3
+    for mode in ('connect per post', 'transport'):
+        device = FakeDevice.FakeDevice(frame_size=frame_size, connect_delay=connect_delay)
+        device.start()
+        transport = Transport.Transport(frame=1.0 / rate)
+        transport.start()
+        frames = 0
+        post_time = 0.0
+        start = time.time()
+        while time.time() - start < seconds:
+            frame_start = time.time()
+            for i in range(posts):
+                data = chr(frames % 256) * frame_size
+                before = time.time()
+                if mode == 'transport':
+                    transport.write(device.address, data)
+                else:
+                    connection = socket.create_connection(device.address)
+                    connection.sendall(data)
+                    connection.close()
+                post_time += time.time() - before
+            frames += 1
+            time.sleep(max(0.0, 1.0 / rate - (time.time() - frame_start)))
+        elapsed = time.time() - start
+        time.sleep(.1)
+        transport.stop()
+        device.stop()
+        print '%-16s driver %.1f frames/s, post %.3f ms, device got %.1f states/s over %d connections' % (
+            mode, frames / elapsed, post_time / (frames * posts) * 1e3, device.frames() / elapsed, device.connections)
+
+
+def frame_driver(fps=60, seconds=2, sets_per_second=5000, render=.004):
+    """
+    an animation setting a pixel bank 'sets_per_second' times per second through an OutputDriver posted on every set,
+    against a FrameDriver at 'fps'. Each post takes 'render' seconds, like pushing a frame to a strip
+    """
+    from Classes import VariableArray, OutputDriver, FrameDriver
+
+    def push(driver):
+        time.sleep(render)
+
+    for kind in ('post every set', 'FrameDriver'):
+        bank = VariableArray(300, 0, 0, 255, 'B')
+        if kind == 'FrameDriver':
+            driver = FrameDriver({'pixels': bank}, push, fps=fps, name='bench')
+            driver.start()
+        else:
+            driver = OutputDriver({'pixels': bank}, push)
+            bank.listen(driver.post)
+        sets = 0
+        start = time.time()
+        while time.time() - start < seconds:
+            bank[sets % 300] = sets % 256
+            sets += 1
+            time.sleep(max(0.0, start + float(sets) / sets_per_second - time.time()))
+        elapsed = time.time() - start
+        if kind == 'FrameDriver':
+            driver.stop()
+            print '%-15s %.0f sets/s, %.1f frames/s posted, %d merged, %d dropped, render p99 %.2f ms' % (
+                kind, sets / elapsed, driver.frames / elapsed, driver.merged, driver.dropped,
+                driver.render_time.recent_percentile(.99) * 1e3)
+        else:
+            print '%-15s %.0f sets/s, %.1f frames/s posted' % (kind, sets / elapsed, sets / elapsed)
+
+
+def contention(writers=8, sets=20000, keys=64):
+    """
+    'writers' threads doing 'variable += 1' on the variables of one VariableMatrix, adding listeners to them and adding
+    and removing keys, while another thread adds and removes listeners and posts and iterates the matrix. Counts
+    increments, versions and listeners that were lost and errors raised, which should all be 0, and the sets per second
+    """
+    import threading
+    from Classes import IntegerVariable, VariableMatrix, echo
+    matrix = VariableMatrix(dict((key, IntegerVariable(0)) for key in range(keys)))
+    variables = [matrix.variables[key] for key in range(keys)]
+    errors = []
+    running = [True]
+
+    def listener(*args):
+        pass
+
+    def write(index):
+        try:
+            for variable in variables:
+                variable.listen(listener, index)
+            for i in range(sets):
+                variables[(i + index) % keys].__iadd__(1)
+                if not i % 100:
+                    matrix[('writer', index)] = IntegerVariable(i)
+                    del matrix[('writer', index)]
+        except Exception as error:
+            errors.append(error)
+
+    def churn():
+        i = 0
+        while running[0]:
+            try:
+                variable = variables[i % keys]
+                variable.listen(echo)
+                variable.unlisten(echo)
+                matrix.post()
+                for key in matrix:
+                    pass
+            except Exception as error:
+                errors.append(error)
+            i += 1
+
+    threads = [threading.Thread(target=write, args=(index,)) for index in range(writers)]
+    churner = threading.Thread(target=churn)
+    churner.start()
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    running[0] = False
+    churner.join()
+    lost_sets = writers * sets - sum(variable.value for variable in variables)
+    lost_versions = writers * sets - sum(variable.version for variable in variables)
+    lost_listeners = writers * keys - sum(len(variable.listeners) for variable in variables)
+    print '%d writers: %.0f sets/s, %d increments lost, %d versions lost, %d listeners lost, %d errors %s' % (
+        writers, writers * sets / elapsed, lost_sets, lost_versions, lost_listeners, len(errors),
+        sorted(set(repr(error) for error in errors))[:3])
+
+
+def bulk_timers(count=50000):
+    """
+    adds 'count' TimeVariables on 3600 different schedules one at a time and with add_timers(), then times cancelling
+    a tenth of them by id, a tenth by tag, and listing what runs in the next 10 minutes
+    """
+    specs = [{'time': '%d:%d' % (i % 60, i * 7 % 60), 'format': '%M:%S', 'tags': ['group%d' % (i % 10)]}
+             for i in range(count)]
+    scheduler = WaitingQueue()
+    schedule_cache.clear()
+    began = time.time()
+    for spec in specs:
+        TimeVariable(spec['time'], scheduler, spec['format'])
+    single = time.time() - began
+    scheduler = WaitingQueue()
+    schedule_cache.clear()
+    began = time.time()
+    handles = scheduler.add_timers(specs)
+    bulk = time.time() - began
+    began = time.time()
+    cancelled = scheduler.cancel_timers(ids=[handle.id for handle in handles[1::10]])
+    by_id = time.time() - began
+    began = time.time()
+    cancelled += scheduler.cancel_timers(tag='group0')
+    by_tag = time.time() - began
+    began = time.time()
+    upcoming = scheduler.upcoming(600)
+    query = time.time() - began
+    print '%d timers: one at a time %.0f ms, add_timers %.0f ms; cancelled %d by id in %.1f ms and by tag in ' \
+          '%.1f ms; %d runs in the next 10 minutes listed in %.0f ms' % (
+              count, single * 1e3, bulk * 1e3, cancelled, by_id * 1e3, by_tag * 1e3, len(upcoming), query * 1e3)
+
+
+benchmarks = [
+    ('schedule', schedule),
+    ('timer_creation', timer_creation),
+    ('input_latency', input_latency),
+    ('pixel_bank', pixel_bank),
+    ('variable_memory', variable_memory),
+    ('arithmetic', arithmetic),
+    ('rules', rules),
+    ('metrics', metrics),
+    ('lateness', lateness),
+    ('cpu_commands', cpu_commands),
+    ('bus', bus),
+    ('device_frames', device_frames),
+    ('frame_driver', frame_driver),
+    ('contention', contention),
+    ('bulk_timers', bulk_timers),
+]
+
+if __name__ == '__main__':
+    chosen = sys.argv[1:]
+    for name, benchmark in benchmarks:
+        if not chosen or name in chosen:
+            print '--', name
+            benchmark()
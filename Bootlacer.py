@@ -1,15 +1,93 @@
+import sys
+import signal
 import threading
 import time
+import traceback
 
+import Plugins
+import Classes
+import Snapshot
 import OutputDrivers
+import InputDrivers
+import Modules
 
+if '--startup-profile' in sys.argv:  # import every plugin now and report how long each one took
+    for package in (OutputDrivers, InputDrivers, Modules):
+        Plugins.load_all(package.modules)
+        Plugins.profile_report(package.modules)
 
-OutputDriverThread = threading.Thread(target=OutputDrivers.run, name=OutputDrivers.name + '#root')
-OutputDriverThread.start()
+for argument in sys.argv:  # --metrics or --metrics=host:port or --metrics=/path/of/unix/socket, see Metrics.py
+    if argument == '--metrics' or argument.startswith('--metrics='):
+        import Metrics
 
-time.sleep(10)
+        Metrics.enable()
+        if '=' in argument:
+            Metrics.serve(Metrics.parse_address(argument.split('=', 1)[1]))
+        else:
+            Metrics.serve()
 
-# scheduler = Classes.WaitingQueue(10)
-# schedulerThread = threading.Thread(target=scheduler.run, name='scheduler')
-#schedulerThread.start()
+save_period = 60  # seconds between two saves of the state, on top of the save when stopping
 
+scheduler = Classes.WaitingQueue()
+state = Snapshot.Store('esp.state')  # INIT code registers its matrices with state and calls state.restore()
+state.add_queue('scheduler', scheduler)
+state.load()  # warms the schedule cache before any TimeVariable is made
+
+watcher = None
+if '--reload' in sys.argv:  # reload drivers and modules when their files are saved, see Reloader.py
+    import Reloader
+
+    watcher = Reloader.Watcher()
+    for package in (OutputDrivers, InputDrivers, Modules):
+        watcher.add_package(package)
+
+if '--reactor' in sys.argv:  # everything on one thread, see Reactor.py
+    import Reactor
+
+    reactor = Reactor.Reactor()
+    scheduler.attach(reactor)
+    OutputDrivers.attach(reactor)
+    for module in InputDrivers.modules:  # one reactor, and one epoll, for all input drivers
+        driver = getattr(module, 'main', None)
+        if driver is not None:  # polled in the executor unless the driver says its source never blocks
+            driver.attach(reactor, blocking=getattr(driver, 'blocking', True))
+    if watcher is not None:
+        watcher.attach(reactor)
+
+    def save_periodically():
+        reactor.run_in_executor(state.save)  # writing and syncing the file is kept off the reactor thread
+        reactor.call_later(save_period, save_periodically)
+
+    reactor.call_later(save_period, save_periodically)
+    reactor.on_stop(state.save)
+    reactor.on_stop(scheduler.close)
+    signal.signal(signal.SIGINT, lambda *args: reactor.stop())
+    signal.signal(signal.SIGTERM, lambda *args: reactor.stop())
+    reactor.run_forever()
+else:
+    # signals are only handled by the main thread, so it stays here saving the state until the system is stopped
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    if watcher is not None:
+        watcher.start()
+    OutputDriverThread = threading.Thread(target=OutputDrivers.run, name=OutputDrivers.name + '#root')
+    OutputDriverThread.daemon = True  # the main thread below keeps the process running
+    OutputDriverThread.start()
+    try:
+        time.sleep(10)
+
+        schedulerThread = threading.Thread(target=scheduler.run, name='scheduler')
+        schedulerThread.daemon = True
+        schedulerThread.start()
+
+        while True:
+            time.sleep(save_period)
+            try:
+                state.save()
+            except (IOError, OSError):
+                print 'could not save', state.path
+                traceback.print_exc()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        state.save()
+        scheduler.close()
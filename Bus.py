@@ -0,0 +1,302 @@
+"""
+shares Variables between ESP nodes, e.g. several Pis around a building, over UDP to a list of peers or a multicast
+group. A Variable shared under a name on several nodes is kept the same on all of them: setting it on one node sets
+it on the others, where its listeners (and Events) are called as if it had been set locally.
+    bus = Bus('hall', ('0.0.0.0', 5007), group='239.255.42.1')
+    lights = bus.variable('lights', 0)          # or bus.share('lights', an_existing_variable)
+    bus.start()                                 # or bus.attach(reactor)
+Sets are not sent one by one. Each batch holds only the variables set since the last one (a delta of the state),
+collected for 'interval' seconds and packed into as few datagrams as fit. Nobody asks for a value: every node pushes
+its changes to every other node, so a remote listener costs no round trip.
+Every set is versioned with a Lamport clock and the name of the node that made it, and a node only takes a value
+whose version is newer than the one it has, so all nodes settle on the last write whatever order messages arrive in.
+UDP can lose messages, so every 'sync_interval' seconds, and whenever a new node is heard from, a node sends all of
+its shared variables; older ones are ignored by the receivers.
+A node that starts with its clock at 0 would give its first sets versions older than the ones the others already
+have, and they would be ignored. So until it has heard from another node (or sync_interval has passed without any) a
+node holds its sets back; once it hears, its clock is moved past everything in that message and the held sets get new
+versions from it. A node can also be started with the clock it had when it stopped, see Bus.clock.
+Values must be JSON serializable: numbers, strings, lists. Names are the same on every node.
+"""
+import os
+import json
+import time
+import errno
+import select
+import socket
+import struct
+import threading
+
+import Classes
+from Reactor import set_nonblocking
+
+max_datagram = 1400  # bytes, stays under the ethernet MTU so datagrams are not fragmented
+
+
+class Bus():
+    """
+    one node's end of the bus
+    """
+
+    def __init__(self, node, address=('0.0.0.0', 5007), peers=(), group=None, interval=.01, sync_interval=5.0,
+                 clock=0):
+        """
+        :param node: name of this node, different on every node of the bus
+        :param address: (host, port) to receive on
+        :param peers: list of (host, port) of the other nodes, to send to them directly
+        :param group: multicast group to join and send to, on the port of address, e.g. '239.255.42.1'
+        :param interval: seconds sets are collected for before they are sent as one batch
+        :param sync_interval: seconds between sends of every shared variable
+        :param clock: Lamport clock to start from, e.g. the bus.clock saved when this node last stopped
+        """
+        self.node = node
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(address)
+        self.socket.setblocking(False)
+        self.targets = list(peers)
+        if group is not None:
+            membership = struct.pack('4s4s', socket.inet_aton(group), socket.inet_aton('0.0.0.0'))
+            self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+            self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+            self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+            self.targets.append((group, address[1]))
+        self.interval = interval
+        self.sync_interval = sync_interval
+        self.variables = {}  # name: Variable
+        self.versions = {}  # name: (clock, node) of the set the variable's value comes from
+        self.clock = clock  # Lamport clock, higher than every version this node has seen
+        self.synced = False  # True once another node has been heard from, or sync_interval passed without any
+        self.started = time.time()
+        self.dirty = set()  # names set on this node since the last batch
+        self.dirty_since = None  # time.time() the first of them was set
+        self.lock = threading.RLock()
+        self.local = threading.local()  # .applying: (Variable, its version once set) of the set taken from a message
+        self.nodes = {}  # name of each other node: time.time() last heard from
+        self.sync_due = True
+        self.last_sync = 0.0
+        self.wake_read, self.wake_write = os.pipe()  # written to by changed() to start a batch
+        for fd in (self.wake_read, self.wake_write):
+            set_nonblocking(fd)
+        self.reactor = None
+        self.running = False
+        self.latency = Classes.Histogram()  # seconds between a batch being sent and received, by the senders' clocks
+        self.sent = 0  # datagrams
+        self.received = 0
+        self.applied = 0  # sets taken from other nodes
+        self.stale = 0  # sets ignored because the node already had a newer one
+
+    def share(self, name, variable):
+        """
+        keeps variable the same as the variables shared under name on the other nodes
+        :return: variable
+        """
+        with self.lock:
+            self.variables[name] = variable
+            self.versions.setdefault(name, (0, self.node))
+        variable.listen(self.changed, name, changes_only=True)
+        return variable
+
+    def variable(self, name, initial=0, variable_type=Classes.IntegerVariable):
+        """
+        makes a Variable and shares it under name
+        """
+        return self.share(name, variable_type(initial))
+
+    def changed(self, name):
+        """
+        listener of every shared variable: gives the set a new version and adds it to the next batch
+        """
+        applying = getattr(self.local, 'applying', None)
+        if applying is not None and applying[0] is self.variables.get(name) and applying[0].version == applying[1]:
+            return  # the set taken from another node, not a new one. A listener setting the variable again is sent
+        with self.lock:
+            self.clock += 1
+            self.versions[name] = (self.clock, self.node)
+            self.dirty.add(name)
+            if self.dirty_since is not None:
+                return
+            self.dirty_since = time.time()
+        if self.reactor is not None:
+            self.reactor.call_soon_threadsafe(self.reactor.call_later, self.interval, self.tick)
+        else:
+            self.wake()
+
+    def wake(self):
+        try:
+            os.write(self.wake_write, 'x')
+        except OSError as error:
+            if error.errno != errno.EAGAIN:
+                raise
+
+    def flush(self, everything=False):
+        """
+        sends the variables set since the last batch, or every shared variable
+        """
+        with self.lock:
+            names = list(self.variables) if everything else list(self.dirty)
+            if self.synced:  # sets held back until then are versioned again and sent once the node has synced
+                self.dirty.clear()
+                self.dirty_since = None
+            changes = [json.dumps([name, self.versions[name][0], self.versions[name][1], self.variables[name].value],
+                                  separators=(',', ':')) for name in names]
+        prefix = '{"n":%s,"t":%r,"c":[' % (json.dumps(self.node), time.time())
+        batch = []
+        size = len(prefix) + 2
+        for change in changes:
+            if batch and size + len(change) + 1 > max_datagram:
+                self.send(prefix + ','.join(batch) + ']}')
+                batch = []
+                size = len(prefix) + 2
+            batch.append(change)
+            size += len(change) + 1
+        if batch or everything:
+            self.send(prefix + ','.join(batch) + ']}')
+
+    def send(self, datagram):
+        for target in self.targets:
+            try:
+                self.socket.sendto(datagram, target)
+                self.sent += 1
+            except socket.error as error:  # a peer that is down must not stop the others getting the batch
+                if error.args[0] not in (errno.EAGAIN, errno.ECONNREFUSED, errno.ENETUNREACH, errno.EHOSTUNREACH):
+                    raise
+
+    def receive(self):
+        """
+        takes every waiting message and applies the sets in it that are newer than what this node has
+        """
+        while True:
+            try:
+                datagram = self.socket.recv(65536)
+            except socket.error as error:
+                if error.args[0] in (errno.EAGAIN, errno.ECONNREFUSED):
+                    return
+                raise
+            try:
+                message = json.loads(datagram)
+                node = message['n']
+                changes = message['c']
+            except (ValueError, KeyError, TypeError):
+                continue  # not a bus message
+            if node == self.node:
+                continue  # our own, looped back by multicast
+            self.received += 1
+            now = time.time()
+            if node not in self.nodes:
+                self.sync_due = True  # a node that just started, or was restarted: send it everything
+            self.nodes[node] = now
+            self.latency.observe(max(0.0, now - message.get('t', now)))
+            changes = [change for change in changes if isinstance(change, list) and len(change) == 4]
+            newer = []
+            with self.lock:
+                for name, counter, writer, value in changes:
+                    self.clock = max(self.clock, counter)
+                if not self.synced:
+                    self.sync_clock()
+                for name, counter, writer, value in changes:
+                    variable = self.variables.get(name)
+                    if variable is None:
+                        continue
+                    version = (counter, writer)
+                    if version <= self.versions[name]:
+                        self.stale += 1
+                        continue
+                    self.versions[name] = version
+                    newer.append((name, variable, version, value))
+            for name, variable, version, value in newer:  # listeners are called without the bus locked
+                self.apply(name, variable, version, value)
+            if self.sync_due and self.reactor is not None:
+                self.reactor.call_soon(self.tick)
+
+    def apply(self, name, variable, version, value):
+        """
+        sets variable to a value taken from another node, unless it has been set on this node since
+        """
+        if self.versions.get(name) != version:
+            return
+        self.local.applying = (variable, variable.version + 1)
+        try:
+            variable.set(value)
+        finally:
+            self.local.applying = None
+        self.applied += 1
+
+    def sync_clock(self):
+        """
+        called with the lock held when the node first hears from another one, once the clock has been moved past
+        that node's versions: gives the sets held back until now versions from the moved clock
+        """
+        self.synced = True
+        for name in self.dirty:
+            self.clock += 1
+            self.versions[name] = (self.clock, self.node)
+
+    def tick(self):
+        """
+        sends whatever is due: a full sync, or the batch once it has been collected for 'interval' seconds
+        :return: seconds until something is next due, None if nothing is
+        """
+        now = time.time()
+        if not self.synced and now - self.started >= self.sync_interval:
+            with self.lock:  # nobody has answered, this node is alone and its clock is as good as any
+                if not self.synced:
+                    self.sync_clock()
+        if self.sync_due or now - self.last_sync >= self.sync_interval:
+            self.sync_due = False
+            self.last_sync = now
+            self.flush(everything=True)
+        elif self.synced and self.dirty_since is not None and now - self.dirty_since >= self.interval:
+            self.flush()
+        next_sync = self.last_sync + self.sync_interval - now
+        if self.dirty_since is not None and self.synced:
+            return max(0.0, min(next_sync, self.dirty_since + self.interval - now))
+        if self.dirty_since is not None:
+            return max(0.0, min(next_sync, self.started + self.sync_interval - now))
+        return max(0.0, next_sync)
+
+    def run(self):
+        """
+        receives and sends until stop() is called. Should be run in a thread of its own
+        """
+        self.running = True
+        timeout = 0.0
+        while self.running:
+            try:
+                readable = select.select([self.socket, self.wake_read], [], [], timeout)[0]
+            except select.error as error:
+                if error.args[0] != errno.EINTR:
+                    raise
+                continue
+            if self.wake_read in readable:
+                os.read(self.wake_read, 4096)
+            if self.socket in readable:
+                self.receive()
+            timeout = self.tick()
+
+    def start(self):
+        """
+        runs the bus in a daemon thread
+        :return: the thread
+        """
+        thread = threading.Thread(target=self.run, name='bus ' + self.node)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.running = False
+        self.wake()
+
+    def attach(self, reactor):
+        """
+        runs the bus on reactor instead of in a thread of its own
+        """
+        self.reactor = reactor
+        reactor.add_reader(self.socket, self.receive)
+
+        def sync():
+            self.tick()
+            reactor.call_later(self.sync_interval, sync)
+
+        reactor.call_soon_threadsafe(sync)
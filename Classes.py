@@ -1,8 +1,35 @@
 # VEX ROBOTICS RAMP robot
 # noinspection PyPep8
+import sys
 import time
 import datetime
 import math
+import heapq
+import threading
+import bisect
+import calendar
+import collections
+import re
+import Queue
+import traceback
+import os
+import errno
+import fcntl
+import select
+import array
+import numbers
+import operator
+import contextlib
+import gc
+import ctypes
+import ctypes.util
+import weakref
+import itertools
+
+try:
+    import numpy
+except ImportError:  # VariableArray falls back to the array module
+    numpy = None
 
 """Modules
     set()
@@ -34,6 +61,9 @@ OutputDrivers
 """
 
 waitingQue = []
+metrics = None  # Metrics.Registry while metrics are enabled, see Metrics.py. Every hook checks this first
+metric_collectors = []  # functions writing metrics of their own on every scrape, so modules need not import Metrics
+command_pool = None  # ProcessPool that cpu_bound commands run in once ProcessPool.start() is called
 
 
 def date_of_next_weekday(weekday, today=datetime.datetime.today()):
@@ -86,13 +116,59 @@ def echo(*args):
     pass
 
 
-class Variable():
+lock_stripes = 64
+variable_locks = tuple(threading.Lock() for i in range(lock_stripes))
+
+
+def lock_of(variable):
+    """
+    :return: the lock that guards changes to the listeners and owners of variable and its read-modify-write sets.
+    Variables share a fixed set of locks, picked by address, so that each does not need a lock of its own
+    """
+    return variable_locks[(id(variable) >> 4) % lock_stripes]
+
+
+interned_arguments = {}  # post argument tuples shared between variables, see intern_arguments
+interned_limit = 1024  # most tuples kept in interned_arguments
+
+
+def intern_arguments(arguments):
+    """
+    :return: a tuple equal to arguments that is shared with every other variable given equal arguments. Once
+    interned_limit different tuples are kept, new ones are no longer shared, so arguments that are unique to each
+    variable (e.g. an index) do not grow the table without end. Arguments shared by many variables, like the name
+    of a strip, come up early and are interned long before that.
+    """
+    if not arguments:
+        return ()
+    try:
+        shared = interned_arguments.get(arguments)
+        if shared is None:
+            if len(interned_arguments) >= interned_limit:
+                return arguments
+            shared = interned_arguments.setdefault(arguments, arguments)
+        return shared
+    except TypeError:  # unhashable arguments can not be shared
+        return arguments
+
+
+class Variable(object):
     """
     post:   passes post method the value of variable and post_args
     listen: executes the passed function with the optional 'listArgs' whenever the value of this variable is set
     set: sets the value of this variable and executes listening functions
+    Variables use __slots__ to stay small, since there can be a great many of them. Subclasses must declare
+    __slots__ for any attribute they add. listeners and change_listeners are tuples that are replaced, not modified,
+    when a listener is added; a variable nobody listens to shares the empty tuple.
+    Variables can be set and listened to from several threads. listeners, change_listeners and owners are replaced
+    under lock_of(variable), so no change to them is lost, and set() calls them from the tuple it read, so it never
+    sees one half made. Setting swaps the value under the same lock, and update() and the in-place operators read
+    and set it under the lock, so 'variable += 1' from two threads adds 2. Listeners are called outside the lock.
     """
 
+    __slots__ = ('postMethod', 'postArgs', 'value', 'listeners', 'change_listeners', 'saved_notifications',
+                 'version', 'owners', 'batch', '__weakref__')
+
     def __str__(self):
         return str(self.value)
 
@@ -105,9 +181,14 @@ class Variable():
         """
 
         self.postMethod = post_method
-        self.postArgs = post_arguments
+        self.postArgs = intern_arguments(post_arguments)
         self.value = initial
-        self.listeners = []
+        self.listeners = ()
+        self.change_listeners = ()  # listeners that asked to only hear about changes
+        self.saved_notifications = 0
+        self.version = 0  # goes up by one on every set(), used to tell whether cached results are still valid
+        self.owners = None  # tuple of (VariableMatrix, key) this variable is in, made when it is first added to one
+        self.batch = None  # [depth, value before the batch, set during the batch] inside batch_update()
 
     def convert_value(self, value):
         """
@@ -121,20 +202,193 @@ class Variable():
         """
         self.postMethod(self.value, *self.postArgs)
 
-    def listen(self, alert_function, *alertArgs):
+    def listen(self, alert_function, *alertArgs, **options):
         """
         :param alert_function: function to be called when the value of this variable is altered
         :param alertArgs: arguments to pass to alert_function when it is called
+        :param options: optional keyword arguments
+            changes_only: if True, alert_function is only called when set() actually changes the value
+            window: number of seconds. All sets within this many seconds of the first one are answered with a single
+                call at the end of the window, which will see the latest value
+        Calls that are skipped or merged because of these options are counted in self.saved_notifications
+        """
+        listener = (alert_function, alertArgs)
+        if options.get('window'):
+            listener = (CoalescedListener(self, alert_function, alertArgs, options['window']).notify, ())
+        with lock_of(self):
+            if options.get('changes_only'):
+                self.change_listeners += (listener,)
+            else:
+                self.listeners += (listener,)
+
+    def unlisten(self, alert_function):
+        """
+        removes every listener that calls alert_function, including ones added with a window
+        :return: number of listeners removed
+        """
+        def kept(listener):
+            function = listener[0]
+            if isinstance(getattr(function, '__self__', None), CoalescedListener):
+                function = function.__self__.alertFunction
+            return function != alert_function
+
+        with lock_of(self):
+            count = len(self.listeners) + len(self.change_listeners)
+            self.listeners = tuple(listener for listener in self.listeners if kept(listener))
+            self.change_listeners = tuple(listener for listener in self.change_listeners if kept(listener))
+            return count - len(self.listeners) - len(self.change_listeners)
+
+    def migrate_listeners(self, old, new):
         """
-        self.listeners.append((alert_function, alertArgs))
+        points listeners that are methods or function attributes of 'old', or that are passed 'old' as an argument, at
+        'new' instead.
+        Used when a driver's main object is replaced by a reload.
+        :return: number of listeners moved
+        """
+        moved = [0]
+
+        def migrated(function, args):
+            if isinstance(getattr(function, '__self__', None), CoalescedListener):
+                wrapper = function.__self__
+                wrapper.alertFunction, wrapper.alertArgs = migrated(wrapper.alertFunction, wrapper.alertArgs)
+                return function, args
+            name = getattr(function, '__name__', None)
+            if name is not None and hasattr(new, name) and (getattr(function, '__self__', None) is old or
+                                                             getattr(old, name, None) is function):
+                function = getattr(new, name)
+                moved[0] += 1
+            if any(arg is old for arg in args):
+                args = tuple(new if arg is old else arg for arg in args)
+                moved[0] += 1
+            return function, args
+
+        with lock_of(self):
+            self.listeners = tuple(migrated(*listener) for listener in self.listeners)
+            self.change_listeners = tuple(migrated(*listener) for listener in self.change_listeners)
+        return moved[0]
+
+    def add_owner(self, matrix, key):
+        """
+        records that this variable is in matrix at key, so set() can mark it dirty there
+        """
+        with lock_of(self):
+            self.owners = (self.owners or ()) + ((matrix, key),)
+
+    def remove_owner(self, matrix, key):
+        with lock_of(self):
+            if self.owners and (matrix, key) in self.owners:
+                self.owners = tuple(owner for owner in self.owners if owner != (matrix, key)) or None
 
     def set(self, value):
         """
         sets the value of the variable to 'value'
         """
-        self.value = self.convert_value(value)
-        for listener in self.listeners:
+        value = self.convert_value(value)
+        with lock_of(self):
+            old_value = self.value
+            self.value = value
+        self.alert(value != old_value)
+
+    def update(self, function, *args):
+        """
+        sets the variable to function(value, *args), with no set() from another thread in between reading the value
+        and setting it. function is called with the lock held, so it must be quick and must not set variables
+        :return: the new value
+        """
+        with lock_of(self):
+            old_value = self.value
+            self.value = value = self.convert_value(function(old_value, *args))
+        self.alert(value != old_value)
+        return value
+
+    def alert(self, changed=True):
+        """
+        tells the matrices this variable is in and its listeners that it was set
+        :param changed: False if the value is the same as before, listeners with changes_only are then skipped
+        """
+        if self.batch is not None:
+            self.batch[2] = True
+            return
+        with lock_of(self):  # += is a read and a write, sets from two threads would otherwise lose one
+            self.version += 1
+        listeners = self.listeners
+        change_listeners = self.change_listeners
+        owners = self.owners
+        if metrics is not None:
+            metrics.variable_set(self, len(listeners) + len(change_listeners))
+        if owners:
+            for matrix, key in owners:
+                matrix.mark_dirty(key)
+        for listener in listeners:
             listener[0](*listener[1])
+        if change_listeners:
+            if changed:
+                for listener in change_listeners:
+                    listener[0](*listener[1])
+            else:
+                self.saved_notifications += len(change_listeners)
+
+    def snapshot(self):
+        """
+        :return: something to compare with a later snapshot() to tell whether the variable changed in between
+        """
+        return self.value
+
+    def restore(self, value):
+        """
+        sets the value without alerting anyone, for state restored from a snapshot. version still goes up, so results
+        cached for the old value (see Condition) are not taken for current
+        """
+        value = self.convert_value(value)
+        with lock_of(self):
+            self.value = value
+            self.version += 1
+
+    @contextlib.contextmanager
+    def batch_update(self):
+        """
+        holds back alerts while the block runs, then alerts once at the end if the variable was set at all
+        example:
+            with variable.batch_update():
+                variable += 1
+                variable *= 2
+        listeners are called once, after the multiplication
+        """
+        if self.batch is None:
+            self.batch = [0, self.value, False]
+        self.batch[0] += 1
+        try:
+            yield self
+        finally:
+            self.batch[0] -= 1
+            if not self.batch[0]:
+                depth, old_value, was_set = self.batch
+                self.batch = None
+                if was_set:
+                    self.alert(self.value != old_value)
+
+
+def migrate_listeners(old, new):
+    """
+    calls migrate_listeners(old, new) on every Variable there is. Variables are found through the garbage collector,
+    which looks at every object, so this is only meant for rare events like reloads.
+    :return: number of listeners moved
+    """
+    moved = 0
+    for candidate in gc.get_objects():
+        if isinstance(candidate, Variable):
+            moved += candidate.migrate_listeners(old, new)
+    return moved
+
+
+module_index = {}  # name: object, the modules Command.load can give to commands, see register_module
+
+
+def register_module(name, module):
+    """
+    makes module available to Commands that ask for it by name
+    """
+    module_index[name] = module
 
 
 class Command():  # update variables matrix and listener related functions
@@ -186,25 +440,85 @@ class Command():  # update variables matrix and listener related functions
     def load(self, modules):
         """
         takes modules and puts them in a tuple so they may be passed to the functions that are to be executed
+        Names are looked up in module_index, then in the globals of this module. Names found in neither are left out
         :param modules: modules to be loaded
         :return:
         """
-        modules = self.secure(modules)
+        modules = self.secure(list(modules))
         module_object_list = []
         for module in modules:
-            for key in globals().keys():
-                if key == module:
-                    module_object_list.append(module)
-                    break
+            if module in module_index:
+                module_object_list.append(module_index[module])
+            elif module in globals():
+                module_object_list.append(globals()[module])
         return tuple(module_object_list)
 
     def execute(self):
         """
-        runs each command specified in __init__ and runs it with the modules also loaded in __init__
+        runs each command specified in __init__ and runs it with the modules also loaded in __init__. Commands marked
+        with ProcessPool.cpu_bound are handed to the process pool if it has been started
         :return: None
         """
         for command in self.commands:
-            command(*self.modules)
+            if command_pool is not None and getattr(command, 'cpu_bound', False):
+                command_pool.submit_command(command, self.modules)
+            else:
+                command(*self.modules)
+
+
+number_types = (int, long, float, bool)  # checked by type() first, the common case
+
+
+def operand(other):
+    """
+    the number to use when other is on the other side of an IntegerVariable operator
+    :return: other itself for numbers, other.value for Variables, NotImplemented for anything else
+    """
+    if type(other) in number_types:
+        return other
+    if isinstance(other, Variable):
+        return other.value
+    if isinstance(other, numbers.Number):
+        return other
+    return NotImplemented
+
+
+def binary_operator(function):
+    """
+    :return: method for 'variable <op> other', giving function(variable.value, other)
+    """
+    def method(self, other):
+        other = operand(other)
+        if other is NotImplemented:
+            return NotImplemented
+        return function(self.value, other)
+    return method
+
+
+def reflected_operator(function):
+    """
+    :return: method for 'other <op> variable', giving function(other, variable.value)
+    """
+    def method(self, other):
+        other = operand(other)
+        if other is NotImplemented:
+            return NotImplemented
+        return function(other, self.value)
+    return method
+
+
+def in_place_operator(function):
+    """
+    :return: method for 'variable <op>= other', which sets the variable to function(variable.value, other) with
+    update(), so it is atomic, and returns the variable itself, so the name stays bound to it
+    """
+    def method(self, other):
+        other = operand(other)
+        if other is NotImplemented:
+            return NotImplemented
+        self.update(function, other)
+        return self
+    return method
 
 
 class IntegerVariable(Variable):
@@ -232,188 +546,88 @@ class IntegerVariable(Variable):
         be set to a new number without checking that it is within it's limits
     """
 
-    def __add__(self, other):
-        if type(other) == int:
-            return int(self.value) + other
-        if isinstance(other, IntegerVariable):
-            return self.value + other.value
-        return self.value
-
-    def __sub__(self, other):
-        if type(other) == int:
-            return self.value - other
-        if isinstance(other, IntegerVariable):
-            return self.value - other.value
-        return self
-
-    def __mul__(self, other):
-        if type(other) == int:
-            return self.value * other
-        if isinstance(other, IntegerVariable):
-            return self.value * other.value
-        return self
-
-    def __floordiv__(self, other):
-        if type(other) == int:
-            return self.value // other
-        if isinstance(other, IntegerVariable):
-            return self.value // other.value
-        return self
-
-    def __mod__(self, other):
-        if type(other) == int:
-            return self.value % other
-        if isinstance(other, IntegerVariable):
-            return self.value % other.value
-        return self
-
-    def __divmod__(self, other):
-        if type(other) == int:
-            return divmod(self.value, other)
-        if isinstance(other, IntegerVariable):
-            return divmod(self.value, other.value)
-        return self
+    __slots__ = ()
+
+    __add__ = binary_operator(operator.add)
+    __sub__ = binary_operator(operator.sub)
+    __mul__ = binary_operator(operator.mul)
+    __div__ = binary_operator(operator.div)
+    __truediv__ = binary_operator(operator.truediv)
+    __floordiv__ = binary_operator(operator.floordiv)
+    __mod__ = binary_operator(operator.mod)
+    __divmod__ = binary_operator(divmod)
+    __lshift__ = binary_operator(operator.lshift)
+    __rshift__ = binary_operator(operator.rshift)
+    __and__ = binary_operator(operator.and_)
+    __xor__ = binary_operator(operator.xor)
+    __or__ = binary_operator(operator.or_)
+
+    __radd__ = reflected_operator(operator.add)
+    __rsub__ = reflected_operator(operator.sub)
+    __rmul__ = reflected_operator(operator.mul)
+    __rdiv__ = reflected_operator(operator.div)
+    __rtruediv__ = reflected_operator(operator.truediv)
+    __rfloordiv__ = reflected_operator(operator.floordiv)
+    __rmod__ = reflected_operator(operator.mod)
+    __rdivmod__ = reflected_operator(divmod)
+    __rpow__ = reflected_operator(pow)
+    __rlshift__ = reflected_operator(operator.lshift)
+    __rrshift__ = reflected_operator(operator.rshift)
+    __rand__ = reflected_operator(operator.and_)
+    __rxor__ = reflected_operator(operator.xor)
+    __ror__ = reflected_operator(operator.or_)
+
+    __iadd__ = in_place_operator(operator.add)
+    __isub__ = in_place_operator(operator.sub)
+    __imul__ = in_place_operator(operator.mul)
+    __idiv__ = in_place_operator(operator.div)
+    __itruediv__ = in_place_operator(operator.truediv)
+    __ifloordiv__ = in_place_operator(operator.floordiv)
+    __imod__ = in_place_operator(operator.mod)
+    __ilshift__ = in_place_operator(operator.lshift)
+    __irshift__ = in_place_operator(operator.rshift)
+    __iand__ = in_place_operator(operator.and_)
+    __ixor__ = in_place_operator(operator.xor)
+    __ior__ = in_place_operator(operator.or_)
 
     def __pow__(self, other, modulo=None):
-        if type(other) == int:
-            return pow(self.value, other, modulo)
-        if isinstance(other, IntegerVariable):
-            return pow(self.value, other.value)
-        return self, modulo
-
-    def __lshift__(self, other):
-        if type(other) == int:
-            return self.value << other
-        if isinstance(other, IntegerVariable):
-            return self.value << other.value
-        return self
-
-    def __rshift__(self, other):
-        if type(other) == int:
-            return self.value >> other
-        if isinstance(other, IntegerVariable):
-            return self.value >> other.value
-        return self
-
-    def __and__(self, other):
-        if type(other) == int:
-            return self.value & other
-        if isinstance(other, IntegerVariable):
-            return self.value & other.value
-        return self
-
-    def __xor__(self, other):
-        if type(other) == int:
-            return self.value ^ other
-        if isinstance(other, IntegerVariable):
-            return self.value ^ other.value
-        return self
+        other = operand(other)
+        if other is NotImplemented:
+            return NotImplemented
+        if modulo is None:
+            return pow(self.value, other)
+        return pow(self.value, other, operand(modulo))
 
-    def __or__(self, other):
-        if type(other) == int:
-            return self.value | other
-        if isinstance(other, IntegerVariable):
-            return self.value | other.value
+    def __ipow__(self, other, modulo=None):
+        other = operand(other)
+        if other is NotImplemented:
+            return NotImplemented
+        if modulo is not None:
+            modulo = operand(modulo)
+        self.update(pow, other, modulo)
         return self
 
-    def __div__(self, other):
-        if type(other) == int:
-            return self.value / other
-        if isinstance(other, IntegerVariable):
-            return self.value / other.value
-        return self
+    def __neg__(self):
+        return -self.value
 
-    def __truediv__(self, other):
-        if type(other) == int:
-            return self.value / other
-        if isinstance(other, IntegerVariable):
-            return self.value / other.value
-        return self
+    def __pos__(self):
+        return +self.value
 
-    def __iadd__(self, other):
-        if type(other) == int:
-            self.set(self.value + other)
-        if isinstance(other, IntegerVariable):
-            self.set(self.value + other.value)
-
-    def __isub__(self, other):
-        if type(other) == int:
-            self.set(self.value - other)
-        if isinstance(other, IntegerVariable):
-            self.set(self.value - other.value)
-
-    def __imul__(self, other):
-        if type(other) == int:
-            self.set(self.value * other)
-        if isinstance(other, IntegerVariable):
-            self.set(self.value * other.value)
-
-    def __idiv__(self, other):
-        if type(other) == int:
-            self.set(self.value / other)
-        if isinstance(other, IntegerVariable):
-            self.set(self.value / other.value)
-
-    def __itruediv__(self, other):
-        if type(other) == int:
-            self.set(self.value / other)
-        if isinstance(other, IntegerVariable):
-            self.set(self.value / other.value)
-
-    def __ifloordiv__(self, other):
-        if type(other) == int:
-            self.set(self.value // other)
-        if isinstance(other, IntegerVariable):
-            self.set(self.value // other.value)
-
-    def __imod__(self, other):
-        if type(other) == int:
-            self.set(self.value % other)
-        if isinstance(other, IntegerVariable):
-            self.set(self.value % other.value)
+    def __abs__(self):
+        return abs(self.value)
 
-    def __ipow__(self, other, modulo=None):
-        if type(other) == int:
-            self.set(pow(self.value, other, modulo))
-        if isinstance(other, IntegerVariable):
-            self.set(pow(self.value, other.value, modulo))
-
-    def __ilshift__(self, other):
-        if type(other) == int:
-            self.set(self.value << other)
-        if isinstance(other, IntegerVariable):
-            self.set(self.value << other.value)
-
-    def __irshift__(self, other):
-        if type(other) == int:
-            self.set(self.value >> other)
-        if isinstance(other, IntegerVariable):
-            self.set(self.value >> other.value)
-
-    def __iand__(self, other):
-        if type(other) == int:
-            self.set(self.value & other)
-        if isinstance(other, IntegerVariable):
-            self.set(self.value & other.value)
-
-    def __ixor__(self, other):
-        if type(other) == int:
-            self.set(self.value ^ other)
-        if isinstance(other, IntegerVariable):
-            self.set(self.value ^ other.value)
+    def __invert__(self):
+        return ~self.value
 
     def __int__(self):
         return int(self.value)
 
+    def __long__(self):
+        return long(self.value)
+
     def __float__(self):
         return float(self.value)
 
-    def __ior__(self, other):
-        if type(other) == int:
-            self.set(self.value | other)
-        if isinstance(other, IntegerVariable):
-            self.set(self.value | other.value)
-
     def __str__(self):
         return str(self.value)
 
@@ -457,7 +671,9 @@ class RangedVariable(IntegerVariable):
         be set to a new number without checking that it is within it's limits
     """
 
-    def __init__(self, initial=0, min_value=0, max_value=10, post_method=echo(), *post_arguments):
+    __slots__ = ('min', 'max')
+
+    def __init__(self, initial=0, min_value=0, max_value=10, post_method=echo, *post_arguments):
         """
             :param post_method:  a function which will send the variables value to a driver when passed that value
             :param initial:  an integer representing the initial value of the variable
@@ -466,7 +682,6 @@ class RangedVariable(IntegerVariable):
 
         """
 
-        self.post = post_method
         self.max = max_value
         self.min = min_value
         IntegerVariable.__init__(self, initial, post_method, *post_arguments)
@@ -480,12 +695,504 @@ class RangedVariable(IntegerVariable):
         value = max(self.min, value)
         return value
 
-    def set(self, value):
-        self.value = value
-        if not self.max >= self.value >= self.min:
-            self.value = self.convert_value(value)
-        for listener in self.listeners:
-            listener()
+
+class VariableArray(Variable):
+    """
+    a bank of numbers (e.g. the pixels of an LED strip) stored in one array instead of one IntegerVariable each.
+    It is indexed and sliced like a list:
+        strip = VariableArray(300, 0, 0, 255, 'B', send_pixels)
+        strip[10] = 255
+        strip[0:100] = [128] * 100
+    Values are clamped to min_value and max_value, which may be single numbers or one per element, for the whole
+    slice at once (with numpy if it is installed). Every assignment marks the indexes it touched in a dirty bitmap,
+    and post() calls post_method(view, start, *post_arguments) once for each run of dirty elements, where view is a
+    zero copy view of those elements. Listeners are alerted once per assignment, not once per element.
+    """
+
+    __slots__ = ('typecode', 'min', 'max', 'dirty')
+
+    def __init__(self, length, initial=0, min_value=None, max_value=None, typecode='d', post_method=echo,
+                 *post_arguments):
+        """
+        :param length: number of elements
+        :param initial: value every element starts at
+        :param min_value: lowest value allowed, a number or a sequence with one per element. None for no limit
+        :param max_value: highest value allowed, a number or a sequence with one per element. None for no limit
+        :param typecode: array module typecode of the elements, e.g. 'B' for bytes or 'd' for floats
+        :param post_method: called as post_method(view, start, *post_arguments) for each dirty run of elements
+        """
+        Variable.__init__(self, None, post_method, *post_arguments)
+        self.typecode = typecode
+        if numpy is not None:
+            self.value = numpy.empty(length, dtype=numpy.dtype(typecode))
+            self.value.fill(initial)
+        else:
+            self.value = array.array(typecode, [initial]) * length
+        self.min = self.limit(min_value)
+        self.max = self.limit(max_value)
+        self.dirty = 0  # bit i set means element i changed since the last post()
+        self.value[:] = self.convert_slice(self.value[:], 0, length)
+
+    def limit(self, limit):
+        """
+        turns a per-element limit into the storage type, leaves numbers and None as they are
+        """
+        if limit is None or isinstance(limit, (int, long, float)):
+            return limit
+        if len(limit) != len(self):
+            raise ValueError("expected " + str(len(self)) + " limits, got " + str(len(limit)))
+        if numpy is not None:
+            return numpy.array(limit, dtype=self.value.dtype)
+        return array.array(self.typecode, limit)
+
+    def __len__(self):
+        return len(self.value)
+
+    def __getitem__(self, index):
+        return self.value[index]
+
+    def __iter__(self):
+        return iter(self.value)
+
+    def restore(self, values):
+        values = self.convert_value(values)
+        with lock_of(self):
+            self.value[:] = values
+            self.dirty = (1 << len(self)) - 1
+            self.version += 1
+
+    def __str__(self):
+        return str(list(self.value))
+
+    def convert_slice(self, values, start, stop):
+        """
+        clamps values, which are to be stored at start:stop, to the limits of those elements
+        :return: the clamped values, in a form that can be assigned to the slice
+        """
+        low = self.min if self.min is None or isinstance(self.min, (int, long, float)) else self.min[start:stop]
+        high = self.max if self.max is None or isinstance(self.max, (int, long, float)) else self.max[start:stop]
+        if numpy is not None:
+            values = numpy.asarray(values)
+            if low is not None or high is not None:
+                values = numpy.clip(values, low, high)
+            return values
+        values = list(values)
+        if low is not None:
+            if isinstance(low, (int, long, float)):
+                values = [max(low, value) for value in values]
+            else:
+                values = [max(limit, value) for limit, value in zip(low, values)]
+        if high is not None:
+            if isinstance(high, (int, long, float)):
+                values = [min(high, value) for value in values]
+            else:
+                values = [min(limit, value) for limit, value in zip(high, values)]
+        return array.array(self.typecode, values)
+
+    def __setitem__(self, index, values):
+        if not isinstance(index, slice):
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError("VariableArray index out of range")
+            index = slice(index, index + 1)
+            values = [values]
+        start, stop, step = index.indices(len(self))
+        if step != 1:
+            for position, value in zip(range(start, stop, step), values):
+                self[position] = value
+            return
+        if stop <= start:
+            return
+        if isinstance(values, (int, long, float)):
+            values = [values] * (stop - start)
+        elif len(values) != stop - start:
+            raise ValueError("can not assign " + str(len(values)) + " values to " + str(stop - start) + " elements")
+        values = self.convert_slice(values, start, stop)
+        with lock_of(self):
+            if numpy is not None:
+                changed = not numpy.array_equal(self.value[start:stop], values)
+            else:
+                changed = self.value[start:stop] != values  # both array.arrays, compared without a python loop
+            self.value[start:stop] = values
+            self.dirty |= ((1 << (stop - start)) - 1) << start
+        self.alert(changed)
+
+    def set(self, values):
+        """
+        sets every element, values must have one value per element
+        """
+        self[:] = values
+
+    def convert_value(self, value):
+        return self.convert_slice(value, 0, len(self))
+
+    def dirty_ranges(self, mask=None):
+        """
+        :param mask: dirty bits to read, self.dirty by default
+        :return: list of (start, stop) for each run of elements changed since the last post()
+        """
+        ranges = []
+        if mask is None:
+            mask = self.dirty
+        while mask:
+            start = (mask & -mask).bit_length() - 1
+            shifted = mask >> start
+            length = (shifted ^ (shifted + 1)).bit_length() - 1  # number of set bits in a row from start
+            ranges.append((start, start + length))
+            mask &= ~(((1 << length) - 1) << start)
+        return ranges
+
+    def view(self, start=0, stop=None):
+        """
+        :return: a read-only view of elements start:stop that shares memory with the array, no copy is made
+        """
+        if stop is None:
+            stop = len(self)
+        try:
+            return memoryview(self.value)[start:stop]
+        except TypeError:  # the array module only has the old buffer interface in python 2
+            size = self.value.itemsize
+            return buffer(self.value, start * size, (stop - start) * size)
+
+    def snapshot(self):
+        return self.version
+
+    def post(self):
+        """
+        passes post_method a view of each run of elements changed since the last post()
+        """
+        with lock_of(self):
+            mask, self.dirty = self.dirty, 0
+        for start, stop in self.dirty_ranges(mask):
+            self.postMethod(self.view(start, stop), start, *self.postArgs)
+
+
+def next_bit(mask, start):
+    """
+    :return: index of the lowest set bit of mask that is >= start, or None if there is none
+    """
+    mask = mask >> start << start
+    if not mask:
+        return None
+    return (mask & -mask).bit_length() - 1
+
+
+def mask_from_values(values, low, high, symbol):
+    """
+    turns a list of integers into a bitset with bit n set for each value n.
+    An empty list means 'any value' and gives a mask with every bit from low to high set.
+    """
+    if not values:
+        return ((1 << (high + 1)) - 1) >> low << low
+    mask = 0
+    for value in values:
+        value = int(value)
+        if not low <= value <= high:
+            raise ValueError(symbol + " value " + str(value) + " is not between " + str(low) + " and " + str(high))
+        mask |= 1 << value
+    return mask
+
+
+class Schedule():
+    """
+    compiled form of a TimeVariable's targetTime. Every unit of time is stored as a bitset (bit n set means n is a
+    valid value), so the next valid time can be found by scanning bits from the largest unit to the smallest instead of
+    searching and backtracking through lists. Finding the next time takes at most a few bit scans per month that has
+    to be skipped, and the schedule is never modified after it is built.
+    An empty list for a unit means any value is valid for that unit. If both days and weekdays are given, a day is
+    valid if it matches either of them.
+    """
+
+    year_horizon = 400  # the calendar repeats every 400 years, nothing further away can become valid
+
+    def __init__(self, target_time):
+        """
+        :param target_time: dict with '$Y', '$M', '$D', '$W', '%H', '%M' and '%S' tuples of integers, as made by
+        convert_target_time
+        """
+        self.target_time = target_time
+        self.years = tuple(sorted(set(int(year) for year in target_time['$Y'])))
+        self.months = mask_from_values(target_time['$M'], 1, 12, '$M')
+        self.hours = mask_from_values(target_time['%H'], 0, 23, '%H')
+        self.minutes = mask_from_values(target_time['%M'], 0, 59, '%M')
+        self.seconds = mask_from_values(target_time['%S'], 0, 59, '%S')
+        days = target_time['$D']
+        weekdays = target_time['$W']
+        day_mask = mask_from_values(days, 1, 31, '$D')
+        weekday_mask = mask_from_values(weekdays, 0, 6, '$W')
+        # week_days[n] is the set of valid days in a month whose first day has weekday n
+        self.week_days = []
+        for first_weekday in range(7):
+            week_pattern = 0
+            for day in range(1, 32):
+                if weekday_mask >> ((first_weekday + day - 1) % 7) & 1:
+                    week_pattern |= 1 << day
+            if days and weekdays:
+                self.week_days.append(day_mask | week_pattern)
+            elif weekdays:
+                self.week_days.append(week_pattern)
+            else:
+                self.week_days.append(day_mask)
+
+    def days_in(self, year, month):
+        """
+        :return: bitset of the valid days in month of year
+        """
+        first_weekday = datetime.date(year, month, 1).weekday()
+        length = calendar.monthrange(year, month)[1]
+        return self.week_days[first_weekday] & ((1 << (length + 1)) - 1)
+
+    def next_year(self, year):
+        """
+        :return: the first valid year that is >= year, or None
+        """
+        if not self.years:
+            return year
+        index = bisect.bisect_left(self.years, year)
+        if index < len(self.years):
+            return self.years[index]
+        return None
+
+    def next_time(self, after=None):
+        """
+        :param after: datetime to search from, defaults to now. The result is always strictly after it.
+        :return: datetime.datetime of the first valid second after 'after', or None if there never is one
+        """
+        if after is None:
+            after = datetime.datetime.today()
+        return self.search(after.replace(microsecond=0) + datetime.timedelta(seconds=1))
+
+    def search(self, moment):
+        """
+        :return: the first valid second at or after moment, or None if there never is one
+        """
+        year, month, day = moment.year, moment.month, moment.day
+        hour, minute, second = moment.hour, moment.minute, moment.second
+        last_year = min(datetime.MAXYEAR, year + self.year_horizon)
+        while True:
+            valid_year = self.next_year(year)
+            if valid_year is None or valid_year > last_year:
+                return None
+            if valid_year != year:
+                year, month, day, hour, minute, second = valid_year, 1, 1, 0, 0, 0
+            valid_month = next_bit(self.months, month)
+            if valid_month is None:
+                year, month, day, hour, minute, second = year + 1, 1, 1, 0, 0, 0
+                continue
+            if valid_month != month:
+                month, day, hour, minute, second = valid_month, 1, 0, 0, 0
+            valid_day = next_bit(self.days_in(year, month), day)
+            if valid_day is None:
+                month, day, hour, minute, second = month + 1, 1, 0, 0, 0
+                if month > 12:
+                    year, month = year + 1, 1
+                continue
+            if valid_day != day:
+                day, hour, minute, second = valid_day, 0, 0, 0
+            valid_hour = next_bit(self.hours, hour)
+            if valid_hour is None:
+                day, hour, minute, second = day + 1, 0, 0, 0
+                continue  # days_in() drops days past the end of the month, so day + 1 is always safe
+            if valid_hour != hour:
+                hour, minute, second = valid_hour, 0, 0
+            valid_minute = next_bit(self.minutes, minute)
+            if valid_minute is None:
+                hour, minute, second = hour + 1, 0, 0
+                continue
+            if valid_minute != minute:
+                minute, second = valid_minute, 0
+            valid_second = next_bit(self.seconds, second)
+            if valid_second is None:
+                minute, second = minute + 1, 0
+                continue
+            return datetime.datetime(year, month, day, hour, minute, valid_second)
+
+    def next_times(self, count, after=None):
+        """
+        :param count: number of times to find
+        :param after: datetime to search from, defaults to now
+        :return: list of the next 'count' valid datetimes, shorter if the schedule runs out
+        """
+        times = []
+        for i in range(count):
+            after = self.next_time(after)
+            if after is None:
+                break
+            times.append(after)
+        return times
+
+    def matches(self, moment):
+        """
+        :return: True if the second 'moment' falls on is valid for this schedule
+        """
+        if self.years and moment.year not in self.years:
+            return False
+        return bool(self.months >> moment.month & 1 and self.days_in(moment.year, moment.month) >> moment.day & 1 and
+                    self.hours >> moment.hour & 1 and self.minutes >> moment.minute & 1 and
+                    self.seconds >> moment.second & 1)
+
+
+month_converter = {
+    'january': 1,
+    'february': 2,
+    'march': 3,
+    'april': 4,
+    'may': 5,
+    'june': 6,
+    'july': 7,
+    'august': 8,
+    'september': 9,
+    'october': 10,
+    'november': 11,
+    'december': 12
+}
+weekday_converter = {
+    'monday': 0,
+    'tuesday': 1,
+    'wednesday': 2,
+    'thursday': 3,
+    'friday': 4,
+    'saturday': 5,
+    'sunday': 6,
+}
+time_symbols = ('$Y', '$M', '$m', '$D', '$w', '$W', '%H', '%h', '%M', '%S')
+symbol_pattern = re.compile(r'([$%][A-Za-z])')
+
+
+def parse_target_time(time_format, string):
+    """
+    splits the time mask into separators and symbols ('$' or '%' and a letter). It then looks between the end of
+    each separator and the beginning of the next in string and adds the values found there to the target time dict
+    according to the current symbol
+    :param time_format: time format, see TimeVariable
+    :param string: target time in that format
+    :return: dict with a list of values for every symbol in time_symbols
+    """
+    end_cap = '@#@#@#@#'
+    target_time = dict((symbol, []) for symbol in time_symbols)
+    pieces = symbol_pattern.split(end_cap + time_format + end_cap)
+    separators = pieces[0::2]
+    symbols = pieces[1::2]
+    string = end_cap + string + end_cap
+    for i in range(len(symbols)):  # this will look between each set of separators and find the time var there
+        start_slice = string.find(separators[i]) + len(separators[i])
+        string = string[start_slice:]
+        end_slice = string.find(separators[i + 1])
+        values = []
+        for value in string[:end_slice].split(','):
+            value = value.strip().lower()
+            if not value:
+                continue
+            try:
+                value = int(value)
+            except ValueError:
+                pass
+            values.append(value)
+        target_time[symbols[i]] = sorted(values)
+        string = string[end_slice:]
+    return target_time
+
+
+def convert_target_time(target_time):
+    """
+    merges the informal symbols of a parsed target time into the formal ones ($m into $M, %h into %H, $w into $W)
+    :param target_time: dict made by parse_target_time
+    :return: dict with a sorted tuple for each of '$Y', '$M', '$D', '$W', '%H', '%M' and '%S'
+    """
+    months = list(target_time['$M'])
+    for month in target_time['$m']:
+        months.append(month_converter[str(month).lower()])
+    hours = list(target_time['%H'])
+    for hour in target_time['%h']:
+        hours.append(int(hour) % 12)
+        hours.append(int(hour) % 12 + 12)
+    weekdays = list(target_time['$W'])
+    for weekday in target_time['$w']:
+        weekdays.append(weekday_converter[str(weekday).lower()])
+    converted = {
+        '$Y': target_time['$Y'],
+        '$M': months,
+        '$D': target_time['$D'],
+        '$W': weekdays,
+        '%H': hours,
+        '%M': target_time['%M'],
+        '%S': target_time['%S'],
+    }
+    for symbol in converted:
+        converted[symbol] = tuple(sorted(set(int(value) for value in converted[symbol])))
+    return converted
+
+
+class ScheduleCache():
+    """
+    least recently used cache of compiled schedules keyed by (time_format, target_time). Timers created from the same
+    spec share one Schedule, so each distinct spec is only parsed and compiled once.
+    """
+
+    def __init__(self, size=1024):
+        """
+        :param size: number of schedules to keep before the least recently used one is dropped
+        """
+        self.size = size
+        self.schedules = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, time_format, target_time):
+        """
+        :return: the Schedule for target_time in time_format, compiling it if it is not cached
+        """
+        key = (time_format, target_time)
+        with self.lock:
+            schedule = self.schedules.pop(key, None)
+            if schedule is not None:
+                self.schedules[key] = schedule  # re-insert to mark as most recently used
+                self.hits += 1
+                return schedule
+        schedule = Schedule(convert_target_time(parse_target_time(time_format, target_time)))
+        with self.lock:
+            schedule = self.schedules.pop(key, schedule)  # another thread may have compiled it in the meantime
+            self.schedules[key] = schedule
+            self.misses += 1
+            while len(self.schedules) > self.size:
+                self.schedules.popitem(last=False)
+        return schedule
+
+    def put(self, time_format, target_time, schedule):
+        """
+        adds an already compiled schedule, e.g. one restored from a snapshot
+        """
+        with self.lock:
+            self.schedules.pop((time_format, target_time), None)
+            self.schedules[(time_format, target_time)] = schedule
+            while len(self.schedules) > self.size:
+                self.schedules.popitem(last=False)
+
+    def items(self):
+        """
+        :return: list of ((time_format, target_time), Schedule), least recently used first
+        """
+        with self.lock:
+            return self.schedules.items()
+
+    def clear(self):
+        with self.lock:
+            self.schedules.clear()
+
+    def __len__(self):
+        return len(self.schedules)
+
+
+schedule_cache = ScheduleCache()
+
+
+def compile_schedule(time_format, target_time):
+    """
+    :return: the shared Schedule for target_time written in time_format
+    """
+    return schedule_cache.get(time_format, target_time)
 
 
 class TimeVariable(Variable):
@@ -493,6 +1200,12 @@ class TimeVariable(Variable):
     will alert listeners when target_time is reached
     """
 
+    __slots__ = ('format', 'last_run', 'schedule', 'targetTime', 'handle', 'found')
+
+    timeSymbols = time_symbols
+    month_converter = month_converter
+    weekday_converter = weekday_converter
+
     @staticmethod
     def weekday(weekday):
         """
@@ -513,7 +1226,7 @@ class TimeVariable(Variable):
         """
         return TimeVariable(str(hour).strip(')').strip('('), "$H")
 
-    def __init__(self, target_time, scheduler, time_format="%H%M%S", post_method=echo, *postArgs):
+    def __init__(self, target_time, scheduler, time_format="%H%M%S", post_method=echo, *postArgs, **options):
         """
             tokens:
                 $: date value
@@ -533,7 +1246,8 @@ class TimeVariable(Variable):
                 %S second           (e.g. 15)
             if a value is not specified, this function will not automatically set it to zero, nor will it in any way
             account for the value.
-            :param target_time: time, according to format specified. Each variable should be separated with some mark
+            :param target_time: time, according to format specified, or a Schedule already compiled from it. Each
+                variable should be separated with some mark
                 if several numbers are inside a single variable separated by a comma, each will be tested (e.g. 1,2,
                 3,4:30)
                 example
@@ -543,232 +1257,152 @@ class TimeVariable(Variable):
             :param time_format: time format, include any formatting marks (e.g. %H:%M)
             :param post_method: a method that will be run with the postArgs supplied
             :param postArgs: arguments to pass to post_method
+            :param options: optional keyword arguments
+                name: name of the timer in the scheduler, which lets a snapshot of the scheduler be restored into it
+                misfire: what the scheduler does when the timer is late, see WaitingQueue. Defaults to the scheduler's
+                first: datetime of the first run, when it is already known. Found from now otherwise
+            :param scheduler: WaitingQueue to add the timer to, or None to leave it out of any, as
+                WaitingQueue.add_timers() does before adding a whole batch at once. A timer whose schedule has no time
+                left (e.g. a year that is past) has the value None and is not added, its handle is never pending
             """
 
         Variable.__init__(self, 0, post_method, *postArgs)
         self.format = time_format
-        self.last_run = datetime_from_dict(datetime.datetime.today(), True)
-        self.timeSymbols = ['$Y', '$M', '$m', '$D', '$w', '$W', '%H', '%h', '%M', '%S']
-        self.targetTime = {
-            '$Y': [],
-            '$M': [],
-            '$m': [],
-            '$D': [],
-            '$w': [],
-            '$W': [],
-            '%H': [],
-            '%h': [],
-            '%M': [],
-            '%S': [],
-        }
-        self.month_converter = {
-            'january': 1,
-            'february': 2,
-            'march': 3,
-            'april': 4,
-            'may': 5,
-            'june': 6,
-            'july': 7,
-            'august': 8,
-            'september': 9,
-            'october': 10,
-            'november': 11,
-            'december': 12
-        }
-        self.weekday_converter = {
-            'monday': 0,
-            'tuesday': 1,
-            'wednesday': 2,
-            'thursday': 3,
-            'friday': 4,
-            'saturday': 5,
-            'sunday': 6,
-
-        }
+        self.last_run = None
+        self.found = None  # (second searched from, result) of the last get_next_time, see get_next_time
         self.set_target_time(target_time)
-        self.convert_target_time()
-        self.value = self.get_next_time()
-        scheduler.append(self)
+        if 'first' in options:
+            self.value = options['first']
+        else:
+            self.value = self.get_next_time()
+        self.handle = None
+        if scheduler is not None:
+            if self.value is not None:
+                self.handle = scheduler.append(self, name=options.get('name'), misfire=options.get('misfire'))
+            else:  # nothing left to run: a handle that is not in the queue, like the ones add_timers() makes
+                self.handle = TimerHandle(scheduler, self, options.get('name'), options.get('misfire'))
 
     def post(self):
-        self.last_run = datetime_from_dict(self.value, True)
-        self.set(self.get_next_time())
+        """
+        moves to the next time after the one just reached, then posts. The next time is found from the scheduled time
+        rather than from now, so a late post neither drifts nor skips a run; the scheduler decides what to do with runs
+        that are already due, see WaitingQueue.
+        """
+        self.last_run = self.value
+        self.set(self.get_next_time(self.value))
         self.postMethod(self.value, *self.postArgs)
-        self.value = self.get_next_time()
 
-        print self.value
-
-    def get_next_time(self):
+    def skip(self, now):
+        """
+        moves to the first time after now without posting or alerting, for runs the scheduler drops
+        :return: number of runs skipped, counted up to 100
         """
+        skipped = 0
+        while self.value is not None and self.value <= now and skipped < 100:
+            self.value = self.get_next_time(self.value)
+            skipped += 1
+        if self.value is not None and self.value <= now:  # too many to count one by one
+            self.value = self.get_next_time(now)
+        return skipped
+
+    def get_next_time(self, after=None):
+        """
+        :param after: datetime to search from, defaults to now
         :return: datetime.datetime for the next time this object should be posted according to the preset schedule
+        The last result is kept, since post(), skip() and the scheduler often ask for the same time in a row. It is
+        kept here rather than on the Schedule, which is shared and must not change.
         """
-        valid_times = self.targetTime  # times that this object is permitted to run, to be modified in this method
-        today = datetime.datetime.today()  # the time at the moment that the next_time is to be retrieved
-        next_time = datetime_from_dict(today, True)  # 'today' in dictionary form
-        today_dict = datetime_from_dict(today, True)
-        keys = ['$Y', '$M', '$D', '%H', '%M', '%S']  # all of the different units of time to be considered
-        i = -1
-        while i < len(keys) - 1:
-            i += 1
-            key = keys[i]  # the current unit being evaluated
-
-            if key == '$D' and valid_times['$W']:  # if we are deciding the day-of-the-week
-                valid_weekdays = sorted(valid_times['$W'])
-                for weekday in valid_weekdays:
-                    new_date = date_of_next_weekday(weekday,
-                                                    datetime_from_dict(next_time))  # datetime object for next 'weekday'
-                    if new_date >= today:  # if new_date occurs after today
-                        valid_times['$D'].append(int(new_date.day))  # add the new_date to the days
-
-            current_value_list = sorted(valid_times[key])  # should be sorted in ascending order; list of valid values
-            if not current_value_list:
-                """
-                checks if next_time[key] is a float because, if it is, the next key has no valid values.
-                If it is, it will try to add one to the current next_time[key]. To test whether this is a
-                real time or not, a datetime obj will be created. If a valueError is raised, to signal an
-                invalid date/time, done will be set to False and the preceding value will be pushed forward
-                """
-                if next_time[key] != math.ceil(next_time[key]):
-                    next_time[key] = math.ceil(next_time[key])
-
-                    datetime_from_dict(next_time)
-                    done = True
-
-                    """except ValueError:
-                        print ValueError
-                        done = False
-                        next_time[key] -= 1"""
-                else:
-                    done = True
-
-            else:
-                done = False  # a valid date has not yet been found
-                for value in current_value_list:
-                    value = int(value)
-                    if value >= math.floor(next_time[key]):
-                        # if the value being inspected is past now:
-                        if value != next_time[key]:
-                            for lesser_unit in range(i + 1, len(keys)):
-                                # this makes sure that, if it is 11:00 on a monday, 9:00 next tuesday is still valid.
-                                # Without this, 9:00 would be interpreted as before 11:00 and marked invalid
-                                # because that time has already passed. In fact, that time has not passed, and the
-                                # computer must not think that it has. This loop goes through every unit of time smaller
-                                # than the one being edited and sets it's value to 0. Nothing can be before 0, and thus
-                                # the bug is remedied.
-                                lesser_unit = keys[lesser_unit]
-                                next_time[lesser_unit] = .5
-                        next_time[key] = value
-                        done = True
-                        break
-            if key == '%S' and self.last_run == next_time:
-                try:
-                    del valid_times[key][valid_times[key].index(next_time[key])]
-                except:
-                    pass
+        if after is None:
+            after = datetime.datetime.today()
+        after = after.replace(microsecond=0)
+        found = self.found
+        if found is not None and found[0] == after:
+            return found[1]
+        result = self.schedule.next_time(after)
+        self.found = (after, result)
+        return result
+
+    def get_next_times(self, count, after=None):
+        """
+        :param count: number of times to find
+        :param after: datetime to search from, defaults to now
+        :return: list of the next 'count' datetimes this object should be posted at
+        """
+        return self.schedule.next_times(count, after)
 
-            if not done:  # if no valid date has been found,
-                """
-                if no valid date has been found, one must change the unit of time preceding the current unit of
-                time to another value.
-                if there it is 11:00 on monday, monday is a valid day, but 9:00 is not a valid time. If 9:00 is
-                the only option, this function must change the "next time"'s day to another valid_value for day
-                that is after monday.
-                This tries to delete the value that originally set the day to monday,
-                If that is not possible (most likely because '$D' is an empty list and monday is the default because
-                it is today) it will add .5 to the
-                This sets i back one unit to re-evaluate the previous thing
-                if there is an empty list in the valid_times[key], and the next_time entry is a float, one unit of
-                time will be added to the value. if that results in a change in it's parent value, this will happen
-                again
-                """
-                previous_key = keys[i - 1]
-                try:  # this is breaking dupe detection !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
-                    del valid_times[previous_key][valid_times[previous_key].index(next_time[previous_key])]
-                except ValueError:
-                    next_time[previous_key] = float(next_time[previous_key] + .5)
-                # for lesser_unit in range(i, len(keys)):
-                # # this makes sure that, if it is 11:00 on a monday, 9:00 next tuesday is still valid.
-                #     # Without this, 9:00 would be interpreted as before 11:00 and marked invalid
-                #     # because that time has already passed. In fact, that time has not passed, and the
-                #     # computer must not think that it has. This loop goes through every unit of time smaller
-                #     # than the one being edited and sets it's value to 0. Nothing can be before 0, and thus
-                #     # the bug is remedied.
-                #     lesser_unit = keys[lesser_unit]
-                #     next_time[lesser_unit] = .5
-                # the above thingy removes from the valid_times the
-                i -= 2
-        next_time = datetime_from_dict(next_time)
-        return next_time
-
-    def convert_target_time(self):
-        """
-        cleans up target_time dictionary and merges redundant variables. Does not clear days of the week, this
-        is left to the get_next_time function
-        :return:
+    def set_target_time(self, string):
         """
-        if len(self.targetTime['$m']):
-            for month in self.targetTime['$m']:
-                self.targetTime['$M'].append(self.month_converter[month.lower()])
+        compiles string, written in self.format, into self.schedule. Schedules are shared between all TimeVariables
+        with the same format and target time, so neither self.schedule nor self.targetTime should be modified.
+        """
+        self.found = None
+        if isinstance(string, Schedule):
+            self.schedule = string
+            self.targetTime = string.target_time
+            return
+        self.schedule = compile_schedule(self.format, string)
+        self.targetTime = self.schedule.target_time
 
-        if len(self.targetTime['%h']):
-            for hour in self.targetTime['%h']:
-                self.targetTime['%H'].append(int(hour))
-                self.targetTime['%H'].append(int(hour) + 12)
 
-        if len(self.targetTime['$w']):
-            for weekday in self.targetTime['$w']:
-                self.targetTime['$W'].append(self.weekday_converter[weekday])
+class Condition():
+    """
+    a condition for an Event that declares which Variables it reads. The result of the function is cached along with
+    the version of each of those Variables, and it is only called again once one of them has been set. A Condition can
+    be shared by several Events, in which case it is evaluated once per change for all of them.
+    It is called like the plain condition functions it replaces: condition(*modules). The modules are part of the
+    cache as well: a result is only reused when it is called with the same module objects it was computed with, so
+    Events that share a Condition but load different modules each get a result of their own.
+    example:
+        cold = Condition(lambda *modules: temperature.value < 15, [temperature])
+        Event([heat_on], [], [temperature, clock], [cold])
+    clock firing while temperature is unchanged will reuse the cached result of cold.
+    """
 
-        self.timeSymbols.remove('$m')
-        self.timeSymbols.remove('%h')
-        self.timeSymbols.remove('$w')
-        del self.targetTime['$m']
-        del self.targetTime['%h']
-        del self.targetTime['$w']
+    def __init__(self, function, inputs):
+        """
+        :param function: function returning True or False when passed the Event's loaded modules
+        :param inputs: list of Variables that function reads. It must not depend on anything else, or the cached
+        result will go stale
+        """
+        self.function = function
+        self.inputs = tuple(inputs)
+        self.versions = None  # versions of the inputs when result was computed, None if never computed
+        self.modules = ()  # modules result was computed with
+        self.result = None
+        self.evaluations = 0
+        self.reuses = 0
+
+    def valid(self, modules=()):
+        """
+        :param modules: the modules the condition is called with
+        :return: True if none of the inputs have been set since the result was computed with these same modules
+        """
+        if self.versions is None or len(modules) != len(self.modules):
+            return False
+        for module, cached in zip(modules, self.modules):
+            if module is not cached:
+                return False
+        for variable, version in zip(self.inputs, self.versions):
+            if variable.version != version:
+                return False
+        return True
 
-    def set_target_time(self, string):
+    def known_false(self, modules=()):
         """
-        goes through time mask and finds all '$' and '%'. Beginning with the lowest indexes, it lists the separators and
-        symbols in order, in two lists. A for loop begins which iterates through each list. It looks between the end of
-        each separator and the beginning of the next and adds that value to the target time dict according to the
-        current symbol
-        """
-        endCap = '@#@#@#@#'
-        symbols = []
-        separators = []
-        temp_string_mask = endCap + self.format + endCap  # for editing
-        string = endCap + string + endCap
-        while len(temp_string_mask):
-            next_date = max(temp_string_mask.find('$'), -1)
-            next_time = max(temp_string_mask.find('%'), -1)
-            if next_date < 0 or next_time < 0:  # if either % or $ is not found
-                if next_date < 0 and next_time < 0:  # if there are no more of either in the string
-                    separators.append(temp_string_mask)  # add the ending of the mask to the separators
-                    break
-                else:  # if only one has run out, the nextTag is at the higher one
-                    next_tag = max(next_date, next_time)
-            else:
-                next_tag = min(next_date, next_time)
-
-            separators.append(temp_string_mask[0:next_tag])  # add the characters preceding the var to separators
-            symbols.append(temp_string_mask[next_tag:next_tag + 2])  # adds the time var to the symbols list
-            temp_string_mask = temp_string_mask[next_tag + 2:]  # takes the processed code out of the mask
-        # now have a list of separators, and what variables come between those separators
-        for i in range(len(symbols)):  # this will look between each set of separators and find the time var there
-            start_slice = string.find(separators[i]) + len(separators[i])  # TODO: replace find with index (later)
-            string = string[start_slice:]
-            end_slice = string.find(separators[i + 1])
-            # found either side of value
-            values = sorted(string[:end_slice].strip().split(','))  # pulls content out and converts to list form
-            for value in range(len(values)):
-                values[value] = values[value].strip().lower()
-                try:
-                    values[value] = int(values[value])
-                except:
-                    pass
-            self.targetTime[symbols[i]] = values  # modifies the appropriate dictionary entry
-            string = string[end_slice:]
-        print 'nothing'
+        :return: True if the cached result is False and still valid for modules, meaning the Event can not run
+        """
+        return self.result is False and self.valid(modules)
+
+    def __call__(self, *modules):
+        if self.valid(modules):
+            self.reuses += 1
+            return self.result
+        versions = tuple(variable.version for variable in self.inputs)  # taken first so a set during the call counts
+        self.result = bool(self.function(*modules))
+        self.modules = modules
+        self.versions = versions
+        self.evaluations += 1
+        return self.result
 
 
 class Event(Command):
@@ -776,25 +1410,40 @@ class Event(Command):
     checks over conditions upon triggers being activated. Useful for common commands and scheduled objects
     """
     # TODO: must add time conditions handler (new 'Scheduled object' class?)
-    def __init__(self, commands, modules, triggers, conditions, adminPass=False):
+    def __init__(self, commands, modules, triggers, conditions, adminPass=False, name=None):
         """
             :param commands: list of functions to be passed the requested modules and run. recommend define with *args
             :param modules: string list of modules to load
             :param triggers: list of Variable objects to listen to. Time objects must be created and then added
             as triggers
             :param conditions: list of python functions that should return True or False when passed ALL loaded modules
-            ensure all conditions can take enough variables
+            ensure all conditions can take enough variables. Conditions wrapped in Condition are only re-evaluated
+            when the Variables they read have changed
+            :param name: name the event's timings are reported under in Metrics
             """
         Command.__init__(self, commands, modules, adminPass)
-        for variable in triggers:
+        self.name = name
+        self.triggers = list(triggers)
+        for variable in self.triggers:
             variable.listen(self.post)
         self.conditions = conditions
 
+    def detach(self):
+        """
+        stops listening to the triggers, so the event no longer runs
+        """
+        for variable in self.triggers:
+            variable.unlisten(self.post)
+
     def check_conditions(self):
         """
         :return: If all conditions are true, it returns true; otherwise it returns false.
-        checks all of the conditions that exist on this command.
+        checks all of the conditions that exist on this command. A Condition whose cached result is still False stops
+        the check before anything is evaluated.
         """
+        for condition in self.conditions:
+            if isinstance(condition, Condition) and condition.known_false(tuple(self.modules)):
+                return False
         for condition in self.conditions:
             if not condition(*self.modules):
                 return False
@@ -805,8 +1454,23 @@ class Event(Command):
         checks conditions and executes if conditions are met
         :return: None
         """
-        if self.check_conditions():
+        if metrics is not None:
+            self.measured_post()
+        elif self.check_conditions():
+            self.execute()
+
+    def measured_post(self):
+        """
+        post() that reports how long the conditions and the commands took to Metrics
+        """
+        start = time.time()
+        passed = self.check_conditions()
+        checked = time.time()
+        executed = None
+        if passed:
             self.execute()
+            executed = time.time() - checked
+        metrics.event(self, checked - start, executed)
 
 
 class VariableMatrix():
@@ -820,53 +1484,127 @@ class VariableMatrix():
         for IntegerVariable in VariableMatrix
     can use
         VariableMatrix['new variable'] = IntegerVariable(x)
-    post() iterates through variables and posts them each
+    post() posts each variable that changed since the last post(). Variables tell the matrices they are in when
+    they are set, so post() only looks at those instead of checking every variable.
+    Several threads can set the variables of a matrix at once. The keys set since the last post() are kept in
+    'stripes' sets, each with a lock of its own and picked by the hash of the key, so writers of different keys seldom
+    wait for each other. Keys are added and removed under structure_lock. Iterating the matrix goes over a copy of its
+    keys, so it never fails because another thread added or removed one; code that walks self.variables itself should
+    use items() or keys() for the same reason.
     """
 
-    def __init__(self, variables=None):
+    def __init__(self, variables=None, stripes=8):
         """
         :param variables: a dictionary object of variable and their keys
+        :param stripes: number of locks the keys set since the last post() are spread over
         :return:
         """
         if not variables:
             variables = dict()
         self.variables = variables
         self.old_values = {}
+        self.stripes = stripes
+        self.dirty = [set() for i in range(stripes)]  # keys of variables set since the last post(), by stripe
+        self.dirty_locks = [threading.Lock() for i in range(stripes)]
+        self.structure_lock = threading.Lock()
+        for key, variable in variables.items():
+            if isinstance(variable, Variable):
+                variable.add_owner(self, key)
         self.update_old_values()
 
+    def mark_dirty(self, key):
+        """
+        called by the variable at key when it is set
+        """
+        stripe = hash(key) % self.stripes
+        with self.dirty_locks[stripe]:
+            self.dirty[stripe].add(key)
+
+    def take_dirty(self):
+        """
+        :return: the keys set since the last call, which are then forgotten
+        """
+        dirty = set()
+        for stripe, keys in enumerate(self.dirty):
+            if keys:  # a key added after this check is taken by the next call
+                with self.dirty_locks[stripe]:
+                    dirty |= self.dirty[stripe]
+                    self.dirty[stripe] = set()
+        return dirty
+
     def update_old_values(self):
         """
         updates list of old values that is used to detect changes to variables
         """
-        keys = sorted(self.variables.keys())
-        for i in range(len(keys)):
-            value = int(self.variables[keys[i]])
-            self.old_values[keys[i]] = value
+        self.take_dirty()
+        for key, variable in self.variables.items():
+            if isinstance(variable, Variable):
+                self.old_values[key] = variable.snapshot()
 
     def post(self):
         """
-        checks for changes in module variables and posts() any altered variables
+        posts() the variables that were set since the last post() and whose value is not what it was then
         """
-        keys = self.variables.keys()
-        for i in range(len(self.variables)):
-            if self.old_values[keys[i]] != int(self.variables[keys[i]]):
-                self.variables[keys[i]].post()
-        self.update_old_values()
+        for key in self.take_dirty():
+            variable = self.variables.get(key)
+            if variable is None:  # deleted since it was set
+                continue
+            snapshot = variable.snapshot()
+            if key not in self.old_values or self.old_values[key] != snapshot:
+                self.old_values[key] = snapshot
+                variable.post()
+
+    def add(self, key, variable):
+        """
+        puts variable in the matrix at key
+        """
+        with self.structure_lock:
+            self.remove(key)
+            self.variables[key] = variable
+            variable.add_owner(self, key)
+            self.old_values[key] = variable.snapshot()
 
-    def __setitem__(self, key, value):
-        value = value
-        self.variables[key].set(value)
+    def remove(self, key):
+        """
+        takes the variable at key out of the matrix, if there is one. structure_lock must be held
+        """
+        variable = self.variables.pop(key, None)
+        self.old_values.pop(key, None)
+        if isinstance(variable, Variable):
+            variable.remove_owner(self, key)
+        return variable
+
+    def __setitem__(self, key, value):
+        if key not in self.variables and isinstance(value, Variable):
+            self.add(key, value)
+            return
+        self.variables[key].set(value)
 
     def __getitem__(self, key):
         value = self.variables[key].value
         return value
 
     def __delitem__(self, key):
-        del self.variables[key]
+        with self.structure_lock:
+            if key not in self.variables:
+                raise KeyError(key)
+            self.remove(key)
 
     def __len__(self):
         return len(self.variables)
 
+    def __iter__(self):
+        return iter(self.variables.keys())
+
+    def __contains__(self, key):
+        return key in self.variables
+
+    def keys(self):
+        return self.variables.keys()
+
+    def items(self):
+        return self.variables.items()
+
     def listen(self, variable, alert_function):
         """
         will alert_function() whenever specified variable is altered
@@ -881,8 +1619,11 @@ class InputDriver():
     It should be noted that this is a very bare-bones class, the two major methods may require lengthy definitions that
     should be located in separate files, preferably named after the driver. They should be located in the same folder
     as this and will be loaded with it
+    raw_data_source can also be a file descriptor, or a file, socket or pipe with fileno(). The driver then does not
+    sweep at all: the descriptor is watched by a Reactor and data is parsed the moment it arrives, split into pieces
+    at 'separator'. All stream drivers attached to the same Reactor share its one epoll.
     In the boot-lacer, all drivers will be run() simultaneously in separate threads, for this reason a high refresh
-    period is desirable to lower CPU usage. Recommendations
+    period is desirable to lower CPU usage. Recommendations for sweeping drivers
     Direct and spontaneous user interface   :   0.25 seconds
     Direct and continuous user interface    :   0.5 seconds, changed to .1 when interface begins
     Direct and predictable user interface   :   1.5 seconds, changed to .1 when interface begins
@@ -890,25 +1631,78 @@ class InputDriver():
     These should keep usage very low and allow quick responses to unexpected direct interface
     """
 
-    def __init__(self, raw_data_source, command_parser, refresh_period=0):
+    blocking = True  # raw_data_source may block. Set to False on drivers whose source returns at once, see attach()
+    min_refresh_period = .01  # shortest time between two polls on a reactor, so a period of 0 does not starve it
+
+    def __init__(self, raw_data_source, command_parser, refresh_period=0, separator='\n'):
         """
         :param raw_data_source: function to call that will return a list of new raw data
             should take no parameters
             should always return a list of strings of data (even an empty one)
+            or a file descriptor/file/socket/pipe to read raw data from as it arrives
         :param command_parser: function to call that will parse raw data into commands (or sub-class thereof)
-        :param refresh_rate: time to sleep between checking raw_data_source
+        :param refresh_rate: time to sleep between checking raw_data_source, not used for streams
+        :param separator: string that ends each piece of raw data read from a stream. None to parse every read
+        as it comes
         :return:
         """
         self.getRawData = raw_data_source
         self.parse = command_parser
         self.refreshPeriod = refresh_period
+        self.separator = separator
+        self.buffer = ''  # data read from a stream that is not followed by a separator yet
+        self.closed = False  # True once a stream has reached its end
+
+    def is_stream(self):
+        """
+        :return: True if raw_data_source is something to read from rather than a function
+        """
+        return isinstance(self.getRawData, (int, long)) or hasattr(self.getRawData, 'fileno')
+
+    def fileno(self):
+        if isinstance(self.getRawData, (int, long)):
+            return self.getRawData
+        return self.getRawData.fileno()
+
+    def read(self):
+        """
+        reads whatever a stream has ready, without blocking if it is non-blocking
+        :return: list of the complete pieces of raw data read. Closes the driver if the stream has ended
+        """
+        try:
+            if hasattr(self.getRawData, 'recv'):
+                chunk = self.getRawData.recv(65536)
+            else:
+                chunk = os.read(self.fileno(), 65536)
+        except (IOError, OSError) as error:
+            if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            raise
+        if not chunk:
+            self.closed = True
+            chunk, self.buffer = self.buffer, ''
+            return [chunk] if chunk else []
+        if self.separator is None:
+            return [chunk]
+        pieces = (self.buffer + chunk).split(self.separator)
+        self.buffer = pieces.pop()
+        return pieces
 
     def post(self):
         """
         This function checks for new data, creating new command instances if appropriate. Unlike run(), it will end
         :return: None
         """
-        new_raw_data = self.getRawData
+        if self.is_stream():
+            if select.select([self.fileno()], [], [], 0)[0]:
+                self.handle(self.read())
+            return
+        self.handle(self.getRawData())
+
+    def handle(self, new_raw_data):
+        """
+        parses and posts a list of raw data
+        """
         for data in new_raw_data:
             command = self.parse(data)
             command.post()
@@ -918,11 +1712,58 @@ class InputDriver():
         !WARNING! This function will never end. It is meant to be run in a separate thread.
         This function will continually check for new data and create & post new command objects
         To run only once, use the .post() function instead
+        A stream driver runs a Reactor of its own and so sleeps until data arrives; it returns when the stream ends.
         """
+        if self.is_stream():
+            import Reactor
+            reactor = Reactor.Reactor()
+            self.attach(reactor)
+            while not self.closed:
+                reactor.run_once()
+            return
         while True:
             self.post()
             time.sleep(self.refreshPeriod)
 
+    def attach(self, reactor, blocking=False):
+        """
+        checks for new data every refreshPeriod, but no more often than every min_refresh_period, on reactor instead
+        of in a thread of its own with run(). Streams are added to the reactor's readers instead, and are read as
+        soon as they have data. A poll that raises does not stop the polling.
+        :param blocking: True if raw_data_source may block. It is then called in the reactor's executor and the data
+        it returns is parsed back on the reactor thread
+        """
+        if self.is_stream():
+            fd = self.fileno()
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+            def readable():
+                self.handle(self.read())
+                if self.closed:
+                    reactor.remove_reader(fd)
+
+            reactor.add_reader(fd, readable)
+            return
+
+        def poll():
+            if not blocking:
+                try:
+                    self.post()
+                finally:
+                    reactor.call_later(max(self.refreshPeriod, self.min_refresh_period), poll)
+                return
+            future = reactor.run_in_executor(self.getRawData)
+            future.add_done_callback(polled)
+
+        def polled(future):
+            try:
+                if future.error is None:
+                    self.handle(future.value)
+            finally:
+                reactor.call_later(max(self.refreshPeriod, self.min_refresh_period), poll)
+
+        reactor.call_soon(poll)
+
 
 class OutputDriver(VariableMatrix):
     """
@@ -949,15 +1790,15 @@ class OutputDriver(VariableMatrix):
         self.postMethod(self, *self.postArgs)
 
     def __setitem__(self, key, value):
-        value = value
-        try:
-            test = self.variables[key]
-            if isinstance(self.variables[key], IntegerVariable):
-                self.variables[key].set(value)
-            else:
+        variable = self.variables.get(key)
+        if isinstance(variable, IntegerVariable):
+            variable.set(value)
+        elif isinstance(value, Variable):
+            self.add(key, value)
+        else:
+            with self.structure_lock:
+                self.remove(key)  # a Variable that was at key no longer marks the matrix when it is set
                 self.variables[key] = value
-        except ReferenceError:
-            self.variables[key] = value
 
     def __getitem__(self, key):
         target = self.variables[key]
@@ -974,61 +1815,1173 @@ class OutputDriver(VariableMatrix):
             raise (AttributeError, "cannot listen to type " + type(self.variables[variable]))
 
 
+class FrameDriver(OutputDriver):
+    """
+    an OutputDriver that posts to its device at most 'fps' times per second, on a frame clock of its own, however often
+    its variables are set or post() is called. Animations set variables far more often than a strip or display can
+    show them, and every post would otherwise go to the device.
+    Setting a variable of the driver, or calling post(), only adds to the frame buffer: the keys changed since the last
+    frame. At each frame the driver calls post_method once if the buffer is not empty, with self.changed set to the keys
+    in it, then empties it. Everything that came in during a frame is merged into that one post, which sees the latest
+    values. Frames are timed on the monotonic clock, so a change of the wall clock does not skip or repeat any.
+    A post_method that takes longer than a frame does not make the driver post late frames back to back: the frames it
+    overran are dropped and the next frame starts at the next frame boundary.
+    Statistics: frames posted, merged changes, dropped frames and render_time, a RingHistogram of post_method times.
+    example:
+        strip = FrameDriver({'pixels': VariableArray(900, 0, 0, 255, 'B')}, send_strip, fps=60)
+        strip.start()
+    """
+
+    instances = weakref.WeakSet()  # every FrameDriver, for Metrics
+
+    def __init__(self, variables, post_method, *postArgs, **options):
+        """
+        :param options: optional keyword arguments
+            fps: frames per second, 30 by default
+            name: name of the driver in statistics, 'frames' by default. '#2', '#3'... is added to a name another
+            FrameDriver already has, so the statistics of each driver are kept apart
+        """
+        OutputDriver.__init__(self, variables, post_method, *postArgs)
+        self.period = 1.0 / options.get('fps', 30)
+        self.name = name = options.get('name', 'frames')
+        taken = set(driver.name for driver in FrameDriver.instances)
+        number = 1
+        while self.name in taken:
+            number += 1
+            self.name = name + '#' + str(number)
+        self.condition = PipeCondition()
+        self.pending = set()  # the frame buffer: keys changed since the last frame
+        self.requested = False  # whether a frame is to be posted, even with no key changed
+        self.changed = frozenset()  # keys of the frame being posted
+        self.stopped = False  # set by stop(), before or after the thread has started
+        self.thread = None
+        self.frames = 0
+        self.merged = 0  # changes and post() calls that were added to a frame already waiting to be posted
+        self.dropped = 0
+        self.render_time = RingHistogram()
+        FrameDriver.instances.add(self)
+
+    def mark_dirty(self, key):
+        with self.condition:
+            if self.requested:
+                self.merged += 1
+            self.pending.add(key)
+            self.requested = True
+            self.condition.notify()
+
+    def post(self):
+        """
+        asks for a frame to be posted, without saying what changed
+        """
+        with self.condition:
+            if self.requested:
+                self.merged += 1
+            self.requested = True
+            self.condition.notify()
+
+    def __setitem__(self, key, value):
+        OutputDriver.__setitem__(self, key, value)
+        if not isinstance(self.variables.get(key), IntegerVariable):  # IntegerVariables mark themselves when set
+            self.mark_dirty(key)
+
+    def render(self, changed):
+        """
+        posts one frame
+        """
+        self.changed = changed
+        start = monotonic()
+        try:
+            self.postMethod(self, *self.postArgs)
+        except Exception:
+            traceback.print_exc()
+        self.render_time.observe(monotonic() - start)
+        self.frames += 1
+
+    def run(self):
+        """
+        posts frames until stop() is called. Should be run in a thread of its own
+        """
+        next_frame = monotonic()
+        while not self.stopped:
+            with self.condition:
+                if not self.requested:
+                    self.condition.wait()  # nothing to show, sleep until something changes
+                    continue
+                delay = next_frame - monotonic()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                changed, self.pending = frozenset(self.pending), set()
+                self.requested = False
+            slot = max(next_frame, monotonic())  # the frame was due now if the driver had been idle
+            self.render(changed)
+            missed = int((monotonic() - slot) / self.period)  # frame boundaries passed while posting
+            if missed and self.requested:  # frames that would have been posted had this one been quicker
+                self.dropped += missed
+            next_frame = slot + (missed + 1) * self.period
+
+    def start(self):
+        """
+        runs the frame clock in a daemon thread
+        :return: the thread
+        """
+        self.thread = threading.Thread(target=self.run, name=self.name)
+        self.thread.daemon = True
+        self.thread.start()
+        return self.thread
+
+    def stop(self):
+        """
+        stops the frame clock and, once its thread has ended, closes the pipe it waits on. A stopped driver can not be
+        started again
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(1)
+        if self.thread is None or not self.thread.is_alive():
+            self.condition.close()
+
+    def summary(self):
+        return {
+            'frames': self.frames,
+            'merged': self.merged,
+            'dropped': self.dropped,
+            'p50_render': self.render_time.recent_percentile(.5),
+            'p99_render': self.render_time.recent_percentile(.99),
+        }
+
+
+class TimingWheel():
+    """
+    hierarchical timing wheel. Level 0 has one slot per tick, every level above it has slots that are 'slots' times
+    wider than the level below. An item is put in the lowest level that can hold its due tick; when the wheel passes
+    the start of a wider slot, that slot is cascaded down into the levels below. Inserting and firing an item are O(1)
+    and ticks with nothing due cost nothing but the slot lookup.
+    example:
+        wheel = TimingWheel()
+        wheel.insert(driver, 100)
+        wheel.advance()  # returns the items due at tick 1, here []
+    """
+
+    def __init__(self, slots=256, levels=2):
+        """
+        :param slots: number of slots per level
+        :param levels: number of levels. Items more than slots ** levels ticks away wait in the top level
+        """
+        self.slots = slots
+        self.levels = levels
+        self.tick = 0
+        self.wheels = [[[] for i in range(slots)] for level in range(levels)]
+
+    def insert(self, item, due):
+        """
+        schedules item to be returned by advance() at tick 'due'
+        :param due: tick number, must be after the current tick
+        """
+        if due <= self.tick:
+            raise ValueError("tick " + str(due) + " has already passed")
+        delta = due - self.tick
+        width = 1
+        for level in range(self.levels):
+            if delta < width * self.slots or level == self.levels - 1:
+                position = due // width
+                if level and position == self.tick // width:
+                    position += 1  # already cascaded this slot, wait for the next one
+                self.wheels[level][position % self.slots].append((due, item))
+                return
+            width *= self.slots
+
+    def advance(self):
+        """
+        moves the wheel forward one tick
+        :return: list of the items due at the new tick
+        """
+        self.tick += 1
+        width = self.slots
+        for level in range(1, self.levels):
+            if self.tick % width:
+                break
+            slot = self.wheels[level][(self.tick // width) % self.slots]
+            self.wheels[level][(self.tick // width) % self.slots] = []
+            for due, item in slot:
+                if due <= self.tick:
+                    self.wheels[0][self.tick % self.slots].append((due, item))
+                else:
+                    self.insert(item, due)
+            width *= self.slots
+        slot = self.wheels[0][self.tick % self.slots]
+        if not slot:
+            return []
+        self.wheels[0][self.tick % self.slots] = []
+        return [item for due, item in slot]
+
+    def advance_to(self, tick):
+        """
+        moves the wheel forward to 'tick' in one go. Only the ticks with items due or a wider slot to cascade are
+        stepped through, so catching up after a long stall costs the items that fell due, not the ticks that passed
+        :return: list of (due tick, item) for every item due up to and including 'tick', in order
+        """
+        fired = []
+        while True:
+            due = self.next_due()
+            if due is None or due > tick:
+                break
+            self.tick = due - 1
+            fired.extend((due, item) for item in self.advance())
+        self.tick = max(self.tick, tick)
+        return fired
+
+    def next_due(self):
+        """
+        :return: the first tick after the current one at which advance() may return something, or None if the wheel
+        is empty. This is either a tick with items due or a tick where a wider slot is cascaded.
+        """
+        best = None
+        width = 1
+        for level in range(self.levels):
+            position = self.tick // width
+            for offset in range(1, self.slots + 1):
+                if self.wheels[level][(position + offset) % self.slots]:
+                    candidate = (position + offset) * width
+                    if best is None or candidate < best:
+                        best = candidate
+                    break
+            width *= self.slots
+        return best
+
+    def __len__(self):
+        return sum(len(slot) for wheel in self.wheels for slot in wheel)
+
+
+class Histogram():
+    """
+    counts observations in exponentially growing buckets. Recording is a bisect and two additions, so it is cheap
+    enough to use on every post. Percentiles are estimated from the bucket bounds.
+    """
+
+    bounds = tuple(.0001 * 2 ** i for i in range(18))  # 0.1 ms up to about 13 seconds
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)  # the last bucket is everything above the last bound
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        """
+        :param fraction: between 0 and 1, e.g. .99
+        :return: upper bound of the bucket that the 'fraction' observation falls in
+        """
+        target = fraction * self.count
+        seen = 0
+        for i in range(len(self.bounds)):
+            seen += self.counts[i]
+            if seen >= target:
+                return min(self.bounds[i], self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(.5),
+            'p99': self.percentile(.99),
+            'max': self.max,
+        }
+
+
+class RingHistogram(Histogram):
+    """
+    a Histogram that also keeps the last 'size' observations in a ring buffer, for percentiles of what happened
+    recently rather than since boot. Observations from several threads are not locked; one may rarely be lost.
+    """
+
+    def __init__(self, size=1024):
+        Histogram.__init__(self)
+        self.recent = array.array('d', [0.0]) * size
+        self.position = 0  # number of observations ever written to the ring
+
+    def observe(self, value):
+        Histogram.observe(self, value)
+        self.recent[self.position % len(self.recent)] = value
+        self.position += 1
+
+    def recent_percentile(self, fraction):
+        """
+        :param fraction: between 0 and 1, e.g. .99
+        :return: the value that 'fraction' of the observations in the ring are at or under
+        """
+        values = sorted(self.recent[:min(self.position, len(self.recent))])
+        if not values:
+            return 0.0
+        return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class WorkerPool():
+    """
+    a fixed number of threads that run submitted functions from a bounded queue.
+    Submissions are keyed (e.g. by driver) and each key is single-flight: a key is never run by two workers at once.
+    Submitting a key that is already queued does nothing, since the queued run will see the latest state anyway.
+    Submitting a key that is running marks it to run once more when it finishes, no matter how many submissions came
+    in meanwhile. Both of these count as coalesced. When the queue is full, submit() blocks until a worker frees a
+    place, which slows the submitter down instead of letting work pile up.
+    How long each key takes to run is kept in a Histogram per key, in self.latency.
+    """
+
+    def __init__(self, workers=4, queue_size=64, name='worker'):
+        """
+        :param workers: number of threads
+        :param queue_size: number of submissions that may wait for a worker
+        :param name: prefix of the thread names
+        """
+        self.workers = workers
+        self.name = name
+        self.queue = Queue.Queue(queue_size)
+        self.lock = threading.Lock()
+        self.states = {}  # key: 'queued' or 'running'
+        self.again = set()  # running keys that were submitted again
+        self.latency = {}  # key: Histogram of run time
+        self.errors = {}  # key: number of runs that raised
+        self.coalesced = 0
+        self.threads = []
+
+    def start(self):
+        """
+        starts the worker threads, if they are not running already
+        """
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self.work, name=self.name + '#' + str(i))
+                thread.daemon = True
+                self.threads.append(thread)
+                thread.start()
+
+    def submit(self, key, function, *args):
+        """
+        queues function(*args) to be run for key
+        :param key: None to run function without single-flight or latency tracking
+        :return: True if it was queued, False if it was coalesced into a run that is queued or running
+        """
+        if key is None:
+            self.queue.put((key, function, args))
+            return True
+        with self.lock:
+            state = self.states.get(key)
+            if state:
+                if state == 'running':
+                    self.again.add(key)
+                self.coalesced += 1
+                return False
+            self.states[key] = 'queued'
+        self.queue.put((key, function, args))
+        return True
+
+    def work(self):
+        while True:
+            key, function, args = self.queue.get()
+            if key is None:
+                try:
+                    function(*args)
+                except Exception:
+                    traceback.print_exc()
+                continue
+            with self.lock:
+                self.states[key] = 'running'
+                histogram = self.latency.get(key)
+                if histogram is None:
+                    histogram = self.latency[key] = Histogram()
+            while True:
+                start = time.time()
+                try:
+                    function(*args)
+                except Exception:
+                    with self.lock:
+                        self.errors[key] = self.errors.get(key, 0) + 1
+                    traceback.print_exc()
+                histogram.observe(time.time() - start)
+                with self.lock:
+                    if key in self.again:  # submitted while running, run again now rather than re-queueing
+                        self.again.discard(key)
+                        continue
+                    del self.states[key]
+                    break
+
+    def record(self, key, seconds):
+        """
+        adds a run time for key that was measured outside the pool's own workers
+        """
+        with self.lock:
+            histogram = self.latency.get(key)
+            if histogram is None:
+                histogram = self.latency[key] = Histogram()
+        histogram.observe(seconds)
+
+    def slowest(self, count=5):
+        """
+        :return: list of (key, Histogram) for the 'count' keys with the highest p99 run time
+        """
+        with self.lock:
+            latency = self.latency.items()
+        return sorted(latency, key=lambda item: item[1].percentile(.99), reverse=True)[:count]
+
+
+def monotonic_clock():
+    """
+    :return: a function returning seconds on a clock that never goes back or jumps, unlike time.time(). Python 2 has
+    no time.monotonic, so on linux it is read with clock_gettime through ctypes. Elsewhere, or where that is not
+    available, it is time.time, since the number of CLOCK_MONOTONIC differs from one system to the next.
+    """
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    if not sys.platform.startswith('linux'):
+        return time.time
+
+    class TimeSpec(ctypes.Structure):
+        _fields_ = [('seconds', ctypes.c_long), ('nanoseconds', ctypes.c_long)]
+
+    try:
+        library = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+        clock_gettime = library.clock_gettime
+    except (OSError, AttributeError):
+        return time.time
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(TimeSpec)]
+    clock_monotonic = 1  # CLOCK_MONOTONIC on linux
+
+    def monotonic():
+        spec = TimeSpec()
+        if clock_gettime(clock_monotonic, ctypes.byref(spec)):
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        return spec.seconds + spec.nanoseconds * 1e-9
+
+    return monotonic
+
+
+monotonic = monotonic_clock()
+
+
+class PipeCondition():
+    """
+    a condition variable for one waiting thread. wait() sleeps in select() on a pipe that notify() writes to, rather
+    than in the loop of short sleeps that python 2's threading.Condition uses for a wait with a timeout, which can take
+    up to 50 ms to notice a notify(). The timeout is measured by the kernel on the monotonic clock.
+    The pipe is two file descriptors, so an owner that is done with the condition should close() it. notify() does
+    nothing once the condition is closed.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.read_end, self.write_end = os.pipe()
+        for fd in (self.read_end, self.write_end):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.notified = False
+
+    def acquire(self, blocking=True):
+        return self.lock.acquire(blocking)
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        self.lock.acquire()
+        return self
+
+    def __exit__(self, *exception):
+        self.lock.release()
+
+    def notify(self):
+        """
+        wakes the waiting thread. The lock must be held by the caller
+        """
+        if self.notified or self.write_end is None:
+            return
+        self.notified = True
+        try:
+            os.write(self.write_end, 'x')
+        except OSError as error:
+            if error.errno != errno.EAGAIN:
+                raise
+
+    def wait(self, timeout=None):
+        """
+        releases the lock until notify() is called or timeout seconds have passed, then takes it again. The lock must
+        be held by the caller
+        """
+        self.lock.release()
+        try:
+            select.select([self.read_end], [], [], timeout)
+        except select.error as error:
+            if error.args[0] != errno.EINTR:
+                raise
+        finally:
+            self.lock.acquire()
+        if self.notified:
+            self.notified = False
+            try:
+                while os.read(self.read_end, 4096):
+                    pass
+            except OSError as error:
+                if error.errno != errno.EAGAIN:
+                    raise
+
+    def close(self):
+        """
+        closes the pipe. No thread may be waiting on the condition, or wait on it afterwards
+        """
+        with self.lock:
+            for fd in (self.read_end, self.write_end):
+                if fd is not None:
+                    os.close(fd)
+            self.read_end = self.write_end = None
+
+
+def tag_set(tags):
+    """
+    :param tags: one tag, or an iterable of tags
+    :return: frozenset of the tags. A string is a single tag, not a set of letters
+    """
+    if isinstance(tags, basestring):
+        return frozenset((tags,))
+    return frozenset(tags)
+
+
+class TimerHandle():
+    """
+    returned by WaitingQueue.append(). It refers to a single entry in the queue and can be used to cancel that entry
+    or move it to another time without touching the rest of the queue.
+    Each handle has an id, unique in its queue, and may have tags; the queue can find and cancel entries by either.
+    """
+
+    def __init__(self, queue, obj, name=None, misfire=None, tags=()):
+        """
+        :param queue: the WaitingQueue the entry lives in
+        :param obj: the object that will be posted
+        :param name: optional name that identifies the entry across restarts
+        :param misfire: misfire policy for this entry, None for the queue's
+        :param tags: strings to find the entry by, or a single string, see WaitingQueue.tagged() and
+        WaitingQueue.cancel_timers()
+        """
+        self.queue = queue
+        self.obj = obj
+        self.name = name
+        self.misfire = misfire
+        self.id = next(queue.ids)
+        self.tags = tag_set(tags)
+        self.entry = None  # [when, sequence, handle] list currently in the heap, None when not scheduled
+        self.active = False  # True from the time the entry is added until it is cancelled or has run for the last time
+        self.scheduled = None  # datetime the last firing was due at
+        self.fired = None  # datetime the last firing actually happened
+
+    def cancel(self):
+        """
+        removes the entry from the queue. Its post() will not be called unless it is rescheduled. An entry cancelled
+        while it is being posted is not put back in the queue for its next run.
+        :return: True if the entry was still waiting or being posted, otherwise False
+        """
+        return self.queue.cancel(self)
+
+    def reschedule(self, when=None):
+        """
+        moves the entry to a new time.
+        :param when: datetime to run at. If None, the current value of the object is used
+        """
+        self.queue.reschedule(self, when)
+
+    def pending(self):
+        """
+        :return: True if the entry is still waiting to run
+        """
+        return self.entry is not None
+
+    def when(self):
+        """
+        :return: the datetime the entry will run at, or None if it is not scheduled
+        """
+        entry = self.entry
+        if entry is None:
+            return None
+        return entry[0]
+
+
 class WaitingQueue():
     """
     object that, when run(), will wait and execute actions in it's queue at their designated time. Objects can be
-    added to the queue at any time, but it will take a maximum of 10 seconds for them to be properly processed.
-    If they would run at that time, they instead run directly afterwards
+    added to the queue at any time from any thread. The queue is a heap ordered by run time, so adding or removing an
+    entry is O(log n), and run() sleeps on a condition variable until exactly the next deadline. append() wakes it
+    immediately if the new object has to run before whatever it was waiting for.
+    Entries are removed lazily: cancel() only marks the heap entry, which is dropped when it reaches the top.
+    Times are wall clock datetimes, since schedules are. run() waits for them with kernel timeouts measured on the
+    monotonic clock, at most max_wait seconds at a time so that a change of the wall clock is noticed.
+    How late each entry is posted is kept in self.lateness, and on its handle (scheduled, fired). What happens to an
+    entry that is late is its misfire policy, which applies to objects that can skip() runs, like TimeVariables:
+        'coalesce': post once, and skip any further runs that are already due
+        'fire-late': post every run, however late
+        'skip': do not post a run that is more than 'grace' seconds late, wait for the next one
+    Entries are indexed by the id of their handle and by tag. add_timers() makes and adds a whole batch of
+    TimeVariables under one lock, heapifying the batch in with the rest when it is large. cancel_timers() cancels by id
+    or tag, at the cost of marking each entry, and upcoming() lists what runs in the next so many seconds by walking
+    only the part of the heap that is due by then.
     """
 
-    def __init__(self, update_period=10):
+    max_wait = 1.0
+    misfire_policies = ('coalesce', 'fire-late', 'skip')
+    max_repeats = 1000  # most runs of one entry upcoming() lists
+
+    def __init__(self, update_period=10, misfire='coalesce', grace=1.0):
         """
-        :param update_period: number of seconds, to wait before checking for changes to the queue. This should be
-        between 3 and 10 to save CPU, but also preserve responsiveness
+        :param update_period: kept for compatibility with older boot scripts. The queue no longer polls, so it is not
+        used for anything
+        :param misfire: default misfire policy of the entries
+        :param grace: seconds an entry may be late before 'skip' drops it
         :return:
         """
-        self.queue = []
-        self.oldqueue = self.queue
+        if misfire not in self.misfire_policies:
+            raise ValueError('misfire must be one of ' + ', '.join(self.misfire_policies))
+        self.queue = []  # heap of [when, sequence, handle]; handle is None for cancelled entries
+        self.condition = PipeCondition()
+        self.sequence = 0  # breaks ties between objects with the same time, keeps them first in first out
+        self.cancelled = 0  # number of dead entries still sitting in the heap
         self.update_period = datetime.timedelta(seconds=update_period)
-        self.next_time = (datetime.datetime.today() + datetime.timedelta(days=900))
+        self.next_time = None
+        self.reactor = None  # set by attach()
+        self.timer = None  # the reactor Timer for the first entry
+        self.running = False  # True while run() is running
+        self.closed = False  # set by close()
+        self.misfire = misfire
+        self.grace = grace
+        self.lateness = RingHistogram()  # seconds between the time of each entry and its post
+        self.skipped = 0  # runs dropped by 'skip'
+        self.coalesced = 0  # runs merged into another post by 'coalesce'
+        self.ids = itertools.count(1)  # ids of the TimerHandles
+        self.timers = {}  # id: TimerHandle of every active entry
+        self.tags = {}  # tag: set of the active TimerHandles with that tag
+
+    def __len__(self):
+        return len(self.queue) - self.cancelled
 
-    def append(self, obj):
+    def append(self, obj, when=None, name=None, misfire=None):
         """
         adds an action to the queue to run at it's trigger time.
         :param obj: an obj with a datetime obj as a value and some post() function that can be run
-        :return:
+        :param when: datetime to run at, defaults to obj.value
+        :param name: optional name for the entry, see TimerHandle
+        :param misfire: misfire policy of the entry, defaults to the queue's
+        :return: TimerHandle that can cancel or reschedule the action
+        """
+        if misfire is not None and misfire not in self.misfire_policies:
+            raise ValueError('misfire must be one of ' + ', '.join(self.misfire_policies))
+        handle = TimerHandle(self, obj, name, misfire)
+        self.condition.acquire()
+        try:
+            self._push(handle, when)
+        finally:
+            self.condition.release()
+        return handle
+
+    def add_timers(self, specs, time_format="%H%M%S", tags=(), misfire=None):
+        """
+        makes a TimeVariable for each spec and adds them all to the queue at once. The first run of every timer is
+        found from the same moment, so timers that share a schedule only search it once.
+        :param specs: iterable of dictionaries with the keys
+            time: target time of the timer, see TimeVariable
+            format: optional time format, time_format by default
+            callback: optional post_method of the timer, called as callback(time, *args) on each run
+            args: optional tuple of arguments for callback
+            name: optional name of the entry
+            misfire: optional misfire policy of the entry, misfire by default
+            tags: optional tags of the entry, on top of 'tags'. A string is a single tag
+        :param tags: tags given to every timer in the batch, or a single tag
+        :return: list of TimerHandles, one per spec in the same order. handle.obj is the TimeVariable. Timers whose
+        schedule never comes up are not added to the queue
+        """
+        now = datetime.datetime.today()
+        tags = tag_set(tags)
+        schedules = {}  # (format, target time): (Schedule, first run), each found once per batch
+        handles = []
+        collecting = gc.isenabled()
+        gc.disable()  # a batch makes several objects per timer, which would set off one full collection after another
+        try:
+            for spec in specs:
+                policy = spec.get('misfire', misfire)
+                if policy is not None and policy not in self.misfire_policies:
+                    raise ValueError('misfire must be one of ' + ', '.join(self.misfire_policies))
+                key = (spec.get('format', time_format), spec['time'])
+                found = schedules.get(key)
+                if found is None:
+                    schedule = compile_schedule(*key)
+                    found = schedules[key] = (schedule, schedule.next_time(now))
+                timer = TimeVariable(found[0], None, key[0], spec.get('callback', echo), *spec.get('args', ()),
+                                     first=found[1])
+                timer.handle = TimerHandle(self, timer, spec.get('name'), policy,
+                                           tags.union(tag_set(spec['tags'])) if 'tags' in spec else tags)
+                handles.append(timer.handle)
+        finally:
+            if collecting:
+                gc.enable()
+        self.condition.acquire()
+        try:
+            first = self.queue[0] if self.queue else None
+            entries = []
+            for handle in handles:
+                if handle.obj.value is None:
+                    continue
+                self.sequence += 1
+                handle.entry = [handle.obj.value, self.sequence, handle]
+                entries.append(handle.entry)
+                self._register(handle)
+            if len(entries) > len(self.queue) // 4:  # heapify is O(n), cheaper than a push each for a large batch
+                self.queue.extend(entries)
+                heapq.heapify(self.queue)
+            else:
+                for entry in entries:
+                    heapq.heappush(self.queue, entry)
+            if self.queue and self.queue[0] is not first:
+                self.next_time = self.queue[0][0]
+                self.condition.notify()
+                if self.reactor is not None:
+                    self.reactor.call_soon_threadsafe(self.arm)
+        finally:
+            self.condition.release()
+        return handles
+
+    def cancel(self, handle):
+        """
+        removes the entry belonging to handle from the queue
+        :return: True if the entry was still waiting or being posted, otherwise False
+        """
+        self.condition.acquire()
+        try:
+            if not handle.active:
+                return False
+            self._cancel(handle)
+            self.condition.notify()
+            return True
+        finally:
+            self.condition.release()
+
+    def cancel_timers(self, ids=(), tag=None):
+        """
+        cancels many entries at once
+        :param ids: ids of the TimerHandles to cancel
+        :param tag: cancels every entry with this tag as well
+        :return: number of entries cancelled
+        """
+        self.condition.acquire()
+        try:
+            handles = [self.timers[timer_id] for timer_id in ids if timer_id in self.timers]
+            if tag is not None:
+                handles.extend(self.tags.get(tag, ()))
+            cancelled = 0
+            for handle in handles:
+                if handle.active:  # an entry can be both in ids and tagged
+                    self._cancel(handle)
+                    cancelled += 1
+            if cancelled:
+                self.condition.notify()
+            return cancelled
+        finally:
+            self.condition.release()
+
+    def handle(self, timer_id):
+        """
+        :return: the active TimerHandle with id timer_id, or None
         """
-        self.queue.append(obj)
+        return self.timers.get(timer_id)
+
+    def tagged(self, tag):
+        """
+        :return: list of the active TimerHandles with tag
+        """
+        self.condition.acquire()
+        try:
+            return list(self.tags.get(tag, ()))
+        finally:
+            self.condition.release()
+
+    def upcoming(self, seconds, tag=None, repeat=True):
+        """
+        lists what runs in the next 'seconds' seconds, without changing anything
+        :param tag: only list entries with this tag
+        :param repeat: also list the later runs of TimeVariables that run more than once in that time, up to
+        max_repeats each. Otherwise only the run each entry is waiting for is listed
+        :return: list of (datetime, TimerHandle), in the order they run
+        """
+        until = datetime.datetime.today() + datetime.timedelta(seconds=seconds)
+        found = []
+        self.condition.acquire()
+        try:
+            if tag is not None:
+                for handle in self.tags.get(tag, ()):
+                    entry = handle.entry
+                    if entry is not None and entry[0] is not None and entry[0] <= until:
+                        found.append((entry[0], handle))
+            else:
+                # children are never earlier than their parent, so a subtree whose root is after 'until' is skipped
+                queue = self.queue
+                stack = [0] if queue else []
+                while stack:
+                    index = stack.pop()
+                    when, sequence, handle = queue[index]
+                    if when is not None and when > until:
+                        continue
+                    if handle is not None and when is not None:
+                        found.append((when, handle))
+                    for child in (2 * index + 1, 2 * index + 2):
+                        if child < len(queue):
+                            stack.append(child)
+        finally:
+            self.condition.release()
+        if repeat:
+            runs = {}  # (Schedule, time): the runs after it until 'until', for the timers that share a schedule
+            for when, handle in list(found):
+                next_time = getattr(handle.obj, 'get_next_time', None)
+                if next_time is None:
+                    continue
+                key = (getattr(handle.obj, 'schedule', handle), when)
+                times = runs.get(key)
+                if times is None:
+                    times = runs[key] = []
+                    for i in range(self.max_repeats - 1):
+                        when = next_time(when)
+                        if when is None or when > until:
+                            break
+                        times.append(when)
+                found.extend((when, handle) for when in times)
+        found.sort(key=operator.itemgetter(0))
+        return found
+
+    def reschedule(self, handle, when=None):
+        """
+        moves the entry belonging to handle to a new time, or puts it back in the queue if it was cancelled or has
+        already run
+        :param when: datetime to run at, defaults to the object's value
+        """
+        self.condition.acquire()
+        try:
+            if handle.entry is not None:
+                self._remove(handle)
+            self._push(handle, when)
+        finally:
+            self.condition.release()
+
+    def _push(self, handle, when):
+        """
+        pushes a new heap entry for handle and wakes run() if it is now the first thing to do. A handle with no time to
+        run at, such as a TimeVariable whose schedule is used up, is taken out of the queue instead. The condition must
+        be held by the caller
+        """
+        if when is None:
+            when = handle.obj.value
+        if when is None:
+            if handle.active:
+                self._unregister(handle)
+            return
+        if not handle.active:
+            self._register(handle)
+        self.sequence += 1
+        entry = [when, self.sequence, handle]
+        handle.entry = entry
+        heapq.heappush(self.queue, entry)
+        if self.queue[0] is entry:
+            self.next_time = when
+            self.condition.notify()
+            if self.reactor is not None:
+                self.reactor.call_soon_threadsafe(self.arm)
+
+    def _register(self, handle):
+        """
+        adds handle to the indexes by id and tag. The condition must be held by the caller
+        """
+        handle.active = True
+        self.timers[handle.id] = handle
+        for tag in handle.tags:
+            tagged = self.tags.get(tag)
+            if tagged is None:
+                tagged = self.tags[tag] = set()
+            tagged.add(handle)
+
+    def _unregister(self, handle):
+        """
+        takes handle out of the indexes by id and tag. The condition must be held by the caller
+        """
+        handle.active = False
+        self.timers.pop(handle.id, None)
+        for tag in handle.tags:
+            tagged = self.tags.get(tag)
+            if tagged is not None:
+                tagged.discard(handle)
+                if not tagged:
+                    del self.tags[tag]
+
+    def _cancel(self, handle):
+        """
+        removes the entry of an active handle, whether it is waiting or being posted. The condition must be held by
+        the caller
+        """
+        if handle.entry is not None:
+            self._remove(handle)
+        self._unregister(handle)
+
+    def _remove(self, handle):
+        """
+        marks the heap entry of handle as dead. The condition must be held by the caller
+        """
+        handle.entry[2] = None
+        handle.entry = None
+        self.cancelled += 1
+        if self.cancelled > 64 and self.cancelled > len(self.queue) // 2:  # too much garbage, rebuild the heap
+            self.queue = [entry for entry in self.queue if entry[2] is not None]
+            heapq.heapify(self.queue)
+            self.cancelled = 0
+
+    def _peek(self):
+        """
+        drops dead entries from the top of the heap and returns the first live one, or None if the queue is empty.
+        The condition must be held by the caller
+        """
+        while self.queue and self.queue[0][2] is None:
+            heapq.heappop(self.queue)
+            self.cancelled -= 1
+        if self.queue:
+            self.next_time = self.queue[0][0]
+            return self.queue[0]
+        self.next_time = None
+        return None
 
     def run(self):
         """
-        this function should be run in it's own thread as it will never return or end.
-        :return: NEVER
+        this function should be run in it's own thread as it will not return or end until close() is called.
+        :return: None, once the queue is closed
+        """
+        self.running = True
+        try:
+            self.wait_and_fire()
+        finally:
+            self.running = False
+            self.condition.close()
+
+    def wait_and_fire(self):
+        """
+        the loop of run()
+        """
+        now = datetime.datetime.today()
+        while not self.closed:
+            self.condition.acquire()
+            try:
+                if self.closed:
+                    break
+                entry = self._peek()
+                if entry is None:
+                    self.condition.wait()
+                    now = datetime.datetime.today()
+                    continue
+                if entry[0] > now:  # now is only read again when needed, entries due together are fired in a row
+                    now = datetime.datetime.today()
+                    delay = (entry[0] - now).total_seconds()
+                    if delay > 0:
+                        # append() and cancel() notify, so a new first entry is not missed
+                        self.condition.wait(min(delay, self.max_wait))
+                        now = datetime.datetime.today()
+                        continue
+                heapq.heappop(self.queue)
+                handle = entry[2]
+                handle.entry = None
+            finally:
+                self.condition.release()
+            self.fire(handle, entry[0])
+
+    def close(self):
+        """
+        stops run() and closes the pipe it waits on, once run() has returned. Entries that are still waiting are not
+        posted. Call it when the queue is no longer needed, e.g. on shutdown
         """
+        self.condition.acquire()
+        try:
+            self.closed = True
+            running = self.running
+            self.condition.notify()
+        finally:
+            self.condition.release()
+        if not running:  # otherwise run() closes it on its way out
+            self.condition.close()
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def handles(self):
+        """
+        :return: list of the TimerHandles of every entry still waiting
+        """
+        self.condition.acquire()
+        try:
+            return [entry[2] for entry in self.queue if entry[2] is not None]
+        finally:
+            self.condition.release()
+
+    def attach(self, reactor):
+        """
+        runs the queue on reactor instead of in a thread of its own with run(). A reactor timer is kept for the first
+        entry and moved whenever a new first entry is added.
+        """
+        self.reactor = reactor
+        reactor.call_soon_threadsafe(self.arm)
+
+    def arm(self):
+        """
+        sets the reactor timer for the first entry in the queue. Runs on the reactor thread.
+        """
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.closed:
+            return
+        self.condition.acquire()
+        try:
+            entry = self._peek()
+        finally:
+            self.condition.release()
+        if entry is not None:
+            when = entry[0]
+            # reactor timers are on the monotonic clock and entries on the wall clock: wake at least every max_wait
+            # seconds, like run() does, so a change of the wall clock is noticed
+            delay = (when - datetime.datetime.today()).total_seconds()
+            self.timer = self.reactor.call_later(max(0.0, min(delay, self.max_wait)), self.due)
+
+    def due(self):
+        """
+        fires every entry whose time has come, then re-arms the reactor timer. Runs on the reactor thread.
+        """
+        self.timer = None
         while True:
-            idle = True  # if idle remains true, it means no action is being taken and there is no chance of sleeping
-            # through the next event in the queue
-            if len(self.queue):  # if there is nothing in the queue, do nothing, naturally
-                delta_time = self.queue[0].value - datetime.datetime.today()
-                if self.update_period >= delta_time:
-                    idle = False  # if the following code is executed, the event in the queue will change and the
-                    # delta_time will change with it. This means the next event could be 3 seconds away
-                    #               meaning sleeping for the update_period could cause problems
-                    if delta_time > datetime.timedelta():
-                        time.sleep(delta_time.total_seconds())
-                    self.queue[0].post()
-                    time.sleep(.05)
-                    self.update()
-                if self.queue != self.oldqueue:
-                    idle = False
-                    self.update()
-
-            if idle:  # this will not run if either of the above if statements have run. If the first runs, the second
-                # must also run because self.queue will be modified.
-                time.sleep(self.update_period.total_seconds())
+            self.condition.acquire()
+            try:
+                entry = self._peek()
+                if entry is None or entry[0] > datetime.datetime.today():
+                    break
+                heapq.heappop(self.queue)
+                handle = entry[2]
+                handle.entry = None
+            finally:
+                self.condition.release()
+            self.fire(handle, entry[0])
+        self.arm()
+
+    def fire(self, handle, when):
+        """
+        posts the object of handle, unless it is late and its misfire policy says not to. Objects that moved their
+        value past 'when' while posting (TimeVariables do) are put back in the queue for their next time.
+        """
+        obj = handle.obj
+        now = datetime.datetime.today()
+        handle.scheduled = when
+        handle.fired = now
+        lateness = (now - when).total_seconds()
+        self.lateness.observe(max(0.0, lateness))
+        if metrics is not None:
+            metrics.lateness(lateness)
+        policy = handle.misfire or self.misfire
+        skip = getattr(obj, 'skip', None)
+        if skip is not None and policy == 'skip' and lateness > self.grace:
+            self.skipped += skip(now)
+        else:
+            obj.post()
+            if skip is not None and policy == 'coalesce' and obj.value is not None and obj.value <= now:
+                self.coalesced += skip(now)
+        self.condition.acquire()
+        try:
+            if handle.active and handle.entry is None:  # not rescheduled or cancelled by post() or meanwhile
+                if obj.value is not None and obj.value > when:
+                    self._push(handle, obj.value)
+                else:
+                    self._unregister(handle)  # has run for the last time
+        finally:
+            self.condition.release()
 
     def update(self):
-        self.queue.sort(key=lambda waitingObj: waitingObj.value)
-        self.oldqueue = self.queue
-        pass
+        """
+        re-reads the value of every object in the queue. Only needed if values were changed without reschedule().
+        Objects whose value is now None are taken out of the queue
+        """
+        self.condition.acquire()
+        try:
+            finished = []
+            for entry in self.queue:
+                if entry[2] is not None:
+                    if entry[2].obj.value is None:
+                        finished.append(entry[2])
+                    else:
+                        entry[0] = entry[2].obj.value
+            for handle in finished:
+                self._cancel(handle)
+            heapq.heapify(self.queue)
+            self.condition.notify()
+            if self.reactor is not None:
+                self.reactor.call_soon_threadsafe(self.arm)
+        finally:
+            self.condition.release()
+
+
+class CoalescedListener():
+    """
+    wraps a listener so that a burst of notifications is answered with one call, 'window' seconds after the first.
+    The delayed calls are run by the shared notification_queue(), through a single entry that is rescheduled for
+    every burst, so a notification that comes in while the listener is being called is answered exactly once more.
+    """
 
+    def __init__(self, variable, alert_function, alert_args, window):
+        self.variable = variable
+        self.alertFunction = alert_function
+        self.alertArgs = alert_args
+        self.window = datetime.timedelta(seconds=window)
+        self.value = None  # time the pending call is due, so this can sit in a WaitingQueue
+        self.pending = False
+        self.handle = None  # TimerHandle of the entry in notification_queue(), made on the first notification
+        self.lock = threading.Lock()
+
+    def notify(self):
+        with self.lock:
+            if self.pending:
+                self.variable.saved_notifications += 1
+                return
+            self.pending = True
+            self.value = datetime.datetime.today() + self.window
+            if self.handle is None:
+                self.handle = notification_queue().append(self)
+            else:
+                self.handle.reschedule(self.value)
+
+    def post(self):
+        with self.lock:
+            self.pending = False
+        self.alertFunction(*self.alertArgs)
+
+
+notifier = None
+notifier_lock = threading.Lock()
+
+
+def notification_queue():
+    """
+    :return: the WaitingQueue that runs delayed listener calls, started the first time it is needed
+    """
+    global notifier
+    if notifier is None:
+        with notifier_lock:
+            if notifier is None:
+                queue = WaitingQueue()
+                thread = threading.Thread(target=queue.run, name='notifier')
+                thread.daemon = True
+                thread.start()
+                notifier = queue
+    return notifier
@@ -0,0 +1,123 @@
+"""
+a stand-in for a network device such as a Wi-Fi LED controller, to test and benchmark output drivers without the
+hardware. It accepts TCP connections or UDP datagrams and counts what arrives.
+run it on its own with
+    python FakeDevice.py [port] [tcp|udp] [frame size] [connect delay]
+or from python:
+    device = FakeDevice(('127.0.0.1', 0), 'tcp', frame_size=900, connect_delay=.005)
+    device.start()
+    ... write to device.address ...
+    print device.summary()
+connect_delay makes every new TCP connection wait before it is accepted, like the slow handshake of a real device.
+"""
+import sys
+import time
+import errno
+import select
+import socket
+import threading
+
+
+class FakeDevice():
+    def __init__(self, address=('127.0.0.1', 0), protocol='tcp', frame_size=None, connect_delay=0.0):
+        """
+        :param address: (host, port) to listen on. Port 0 picks a free port, see self.address
+        :param protocol: 'tcp' or 'udp'
+        :param frame_size: bytes in one frame, to count frames over TCP where packets are not kept apart
+        :param connect_delay: seconds each new connection waits before it is accepted
+        """
+        self.protocol = protocol
+        self.frame_size = frame_size
+        self.connect_delay = connect_delay
+        if protocol == 'udp':
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        else:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(address)
+        if protocol == 'tcp':
+            self.socket.listen(128)
+        self.address = self.socket.getsockname()
+        self.clients = []
+        self.running = False
+        self.connections = 0
+        self.packets = 0  # datagrams, or reads from a TCP connection
+        self.bytes = 0
+        self.last = None  # the last data received
+        self.started = None
+
+    def frames(self):
+        if self.protocol == 'udp' or not self.frame_size:
+            return self.packets
+        return self.bytes // self.frame_size
+
+    def summary(self):
+        seconds = time.time() - self.started if self.started else 0.0
+        return {
+            'connections': self.connections,
+            'packets': self.packets,
+            'bytes': self.bytes,
+            'frames': self.frames(),
+            'frames_per_second': self.frames() / seconds if seconds else 0.0,
+        }
+
+    def reset(self):
+        self.connections = self.packets = self.bytes = 0
+        self.started = time.time()
+
+    def serve(self):
+        self.running = True
+        self.started = time.time()
+        while self.running:
+            try:
+                readable = select.select([self.socket] + self.clients, [], [], .1)[0]
+            except select.error as error:
+                if error.args[0] != errno.EINTR:
+                    raise
+                continue
+            for source in readable:
+                if source is self.socket and self.protocol == 'tcp':
+                    if self.connect_delay:
+                        time.sleep(self.connect_delay)
+                    client = self.socket.accept()[0]
+                    self.clients.append(client)
+                    self.connections += 1
+                    continue
+                try:
+                    data = source.recv(65536)
+                except socket.error:
+                    data = ''
+                if not data and source is not self.socket:
+                    self.clients.remove(source)
+                    source.close()
+                    continue
+                self.packets += 1
+                self.bytes += len(data)
+                self.last = data
+
+    def start(self):
+        """
+        serves in a daemon thread
+        :return: the thread
+        """
+        thread = threading.Thread(target=self.serve, name='fake device')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.running = False
+
+
+if __name__ == '__main__':
+    arguments = sys.argv[1:]
+    device = FakeDevice(('0.0.0.0', int(arguments[0]) if arguments else 5577),
+                        arguments[1] if len(arguments) > 1 else 'tcp',
+                        int(arguments[2]) if len(arguments) > 2 else None,
+                        float(arguments[3]) if len(arguments) > 3 else 0.0)
+    device.start()
+    print 'listening on', device.address
+    while True:
+        time.sleep(1)
+        print device.summary()
+        device.reset()
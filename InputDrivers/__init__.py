@@ -1 +1,6 @@
 __author__ = 'Sam'
+import Plugins
+
+# every python file in this folder, as lazy Plugins that are imported the first time they are used
+modules = Plugins.discover(__file__, __name__)
+list_of_modules = [module.name for module in modules]
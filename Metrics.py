@@ -0,0 +1,265 @@
+"""
+measures where time goes in the scheduler, events, variables and output drivers, and serves it in the Prometheus text
+format over HTTP, on a TCP port or a unix socket.
+Nothing is measured until enable() is called. The hooks in Classes only check whether Classes.metrics is None, so
+while metrics are disabled they cost one global lookup each.
+example:
+    Metrics.enable()
+    Metrics.serve(('127.0.0.1', 9464))  # curl http://127.0.0.1:9464/metrics
+    Metrics.serve('/tmp/esp.metrics')   # curl --unix-socket /tmp/esp.metrics http://esp/metrics
+Measured:
+    esp_event_condition_seconds, esp_event_execute_seconds
+        how long each Event's conditions and commands took, by the Event's name. Unnamed events are counted together
+    esp_variable_sets_total, esp_variable_listeners_total
+        how often each Variable was set and how many listeners each set called. Variables are named as in
+        Classes.module_index, the others are counted together by type. The counts of a Variable that no longer
+        exists are moved to its type, so the registry only holds an entry per live Variable
+    esp_scheduler_lateness_seconds
+        how long after its time each WaitingQueue entry was posted
+    whatever the functions added with add_collector, or put in Classes.metric_collectors by modules that do not
+    import this one, write, e.g. the tick jitter and overruns of OutputDrivers
+Timings are kept in RingHistograms: the buckets count everything since enable(), the ring holds the last 'window'
+values for the *_recent quantiles.
+"""
+import os
+import weakref
+import threading
+import SocketServer
+import BaseHTTPServer
+
+import Classes
+from Classes import RingHistogram
+
+collectors = Classes.metric_collectors  # functions called with a write function to add their own lines to every scrape
+registry = None
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def labels(**values):
+    """
+    :return: '{name="value",...}' for the label values given, or '' if there are none
+    """
+    if not values:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, escape(values[name])) for name in sorted(values)) + '}'
+
+
+def header(write, name, kind, description):
+    write('# HELP %s %s\n' % (name, description))
+    write('# TYPE %s %s\n' % (name, kind))
+
+
+def histogram(write, name, description, label, histograms):
+    """
+    writes a histogram family, and the recent quantiles of RingHistograms as a gauge family named name + '_recent'
+    :param label: name of the label that tells the histograms apart
+    :param histograms: dict of label value: Histogram
+    """
+    header(write, name, 'histogram', description)
+    for value in sorted(histograms):
+        data = histograms[value]
+        seen = 0
+        for bound, count in zip(data.bounds, data.counts):
+            seen += count
+            write('%s_bucket%s %d\n' % (name, labels(**{label: value, 'le': repr(bound)}), seen))
+        write('%s_bucket%s %d\n' % (name, labels(**{label: value, 'le': '+Inf'}), data.count))
+        write('%s_sum%s %r\n' % (name, labels(**{label: value}), data.total))
+        write('%s_count%s %d\n' % (name, labels(**{label: value}), data.count))
+    rings = dict((value, data) for value, data in histograms.items() if isinstance(data, RingHistogram))
+    if rings:
+        header(write, name + '_recent', 'gauge', 'quantiles of the recent values of ' + name)
+        for value in sorted(rings):
+            for quantile in (.5, .9, .99):
+                write('%s_recent%s %r\n' % (name, labels(**{label: value, 'quantile': quantile}),
+                                            rings[value].recent_percentile(quantile)))
+
+
+def samples(write, name, kind, description, label, values):
+    """
+    writes a counter or gauge family
+    :param values: dict of label value: number. A label value of None writes the sample without labels
+    """
+    header(write, name, kind, description)
+    for value in sorted(values):
+        write('%s%s %r\n' % (name, labels(**{label: value}) if value is not None else '', values[value]))
+
+
+class Registry():
+    """
+    what has been measured since enable(). The methods named after events are the hooks called from Classes.
+    """
+
+    def __init__(self, window=1024):
+        """
+        :param window: number of recent values kept by each RingHistogram
+        """
+        self.window = window
+        self.conditions = {}  # event name: RingHistogram
+        self.executions = {}  # event name: RingHistogram
+        self.variables = {}  # id of a live Variable: [weak reference to it, Variable type name, sets, listeners called]
+        self.retired = {}  # Variable type name: [sets, listeners called] of the Variables that no longer exist
+        self.scheduler = RingHistogram(window)
+
+    def timing(self, histograms, key, seconds):
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms.setdefault(key, RingHistogram(self.window))
+        histogram.observe(seconds)
+
+    def event(self, event, condition_seconds, execute_seconds):
+        name = event.name or 'unnamed'
+        self.timing(self.conditions, name, condition_seconds)
+        if execute_seconds is not None:
+            self.timing(self.executions, name, execute_seconds)
+
+    def variable_set(self, variable, listeners):
+        counts = self.variables.get(id(variable))
+        if counts is None:
+            key = id(variable)
+            reference = weakref.ref(variable, lambda reference: self.variable_gone(key, reference))
+            counts = self.variables.setdefault(key, [reference, type(variable).__name__, 0, 0])
+        counts[2] += 1
+        counts[3] += listeners
+
+    def variable_gone(self, key, reference):
+        """
+        moves the counts of a Variable that was garbage collected to its type
+        """
+        counts = self.variables.get(key)
+        if counts is None or counts[0] is not reference:
+            return
+        del self.variables[key]
+        retired = self.retired.setdefault(counts[1], [0, 0])
+        retired[0] += counts[2]
+        retired[1] += counts[3]
+
+    def lateness(self, seconds):
+        self.scheduler.observe(max(0.0, seconds))
+
+    def render(self):
+        """
+        :return: everything measured, in the Prometheus text format
+        """
+        lines = []
+        write = lines.append
+        histogram(write, 'esp_event_condition_seconds', 'time spent checking the conditions of an Event', 'event',
+                  self.conditions)
+        histogram(write, 'esp_event_execute_seconds', 'time spent running the commands of an Event', 'event',
+                  self.executions)
+        names = dict((id(module), name) for name, module in Classes.module_index.items())
+        sets = {}
+        listeners = {}
+        for type_name, (count, called) in self.retired.items():
+            sets['<' + type_name + '>'] = count
+            listeners['<' + type_name + '>'] = called
+        for key, (reference, type_name, count, called) in self.variables.items():
+            name = names.get(key, '<' + type_name + '>')
+            sets[name] = sets.get(name, 0) + count
+            listeners[name] = listeners.get(name, 0) + called
+        samples(write, 'esp_variable_sets_total', 'counter', 'number of times a Variable was set', 'variable', sets)
+        samples(write, 'esp_variable_listeners_total', 'counter', 'listener calls made by setting a Variable',
+                'variable', listeners)
+        histogram(write, 'esp_scheduler_lateness_seconds', 'time between when a scheduled entry was due and its post',
+                  'queue', {'scheduler': self.scheduler})
+        for collector in collectors:
+            collector(write)
+        return ''.join(lines)
+
+
+def enable(window=1024):
+    """
+    starts measuring. Does nothing if metrics are already enabled.
+    :return: the Registry
+    """
+    global registry
+    if registry is None:
+        registry = Registry(window)
+    Classes.metrics = registry
+    return registry
+
+
+def disable():
+    """
+    stops measuring. What was measured is kept and still served.
+    """
+    Classes.metrics = None
+
+
+def add_collector(collector):
+    """
+    :param collector: function called with a write function on every scrape, see samples() and histogram()
+    """
+    collectors.append(collector)
+
+
+def render():
+    if registry is None:
+        return ''
+    return registry.render()
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        return str(self.client_address)
+
+    def log_message(self, *args):
+        pass  # scrapes are not worth a line each
+
+
+class TCPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        try:
+            os.unlink(self.server_address)  # left over from a previous run
+        except OSError:
+            pass
+        SocketServer.UnixStreamServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+def serve(address=('127.0.0.1', 9464)):
+    """
+    serves the metrics from a daemon thread
+    :param address: (host, port) to listen on, or the path of a unix socket
+    :return: the server, whose shutdown() stops it
+    """
+    if isinstance(address, basestring):
+        server = UnixServer(address, Handler)
+    else:
+        server = TCPServer(address, Handler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def parse_address(text):
+    """
+    :param text: 'host:port', ':port' or the path of a unix socket
+    :return: address for serve()
+    """
+    if '/' in text:
+        return text
+    host, port = text.rsplit(':', 1)
+    return host or '127.0.0.1', int(port)
@@ -1,70 +1,203 @@
-import glob
 import time
-import threading
+
+import Plugins
+from Classes import TimingWheel, WorkerPool, FrameDriver, RingHistogram, metric_collectors
 
 
-__file__ = __file__.replace('/', '\\')
-print __file__
-pos = len(__file__) - __file__[::-1].index('\\')
-parent_folder = __file__[:pos] + '*.py'
 name = 'OutDrivers'
-list_of_modules = glob.glob(parent_folder)  # gets a list of all python files in this folder
-print list_of_modules  # DO NOT REMOVE
-print __file__  # bug where all variables are none because this is still initiating or something.
-# print statement makes this pause for a sec and collect these variables/wait for them to get into ram/do magic
-# honestly, this is the weirdest bug ever, just don't get rid of these
-try:
-    list_of_modules.remove(__file__)
-except:
-    list_of_modules.remove(__file__[:-1])  # removes this module from the list of files in this folder
+# every python file in this folder, as lazy Plugins. A driver is imported the first time it is posted, unless its
+# update_period is not in the folder's plugin index yet, in which case it is imported when run() schedules it
+modules = Plugins.discover(__file__, __name__)
+list_of_modules = [module.name for module in modules]
+
+tick_length = .001  # seconds per tick
+
+
+class TickStats(RingHistogram):
+    """
+    keeps track of how late run() fires its drivers, as a RingHistogram of jitters.
+    jitter: seconds between the time a slot was due and the time its drivers were posted
+    overrun: a slot that was fired more than one tick late, usually because the posts before it took too long
+    Only the last 'window' jitters are kept for recent percentiles, the buckets and totals are kept forever.
+    """
+
+    def __init__(self, window=4096):
+        RingHistogram.__init__(self, window)
+        self.overruns = 0
+
+    def record(self, jitter):
+        self.observe(jitter)
+        if jitter > tick_length:
+            self.overruns += 1
+
+    def summary(self):
+        return {
+            'fired': self.count,
+            'overruns': self.overruns,
+            'mean_jitter': self.total / self.count if self.count else 0.0,
+            'p99_jitter': self.recent_percentile(.99),
+            'max_jitter': self.max,
+        }
+
 
-for i in range(len(list_of_modules)):
-    list_of_modules[i] = list_of_modules[i][len(parent_folder) - 4:-3]  # removes the parent folder and '.py'
-    __import__(list_of_modules[i], globals(), locals(), [], -1)  # imports the modules
+stats = TickStats()
+pool = WorkerPool(workers=4, queue_size=64, name=name)  # pool.latency has a post time Histogram per driver
 
 
-class DummyThread():
-    def __init__(self):
-        self.live = False
+def collect(write):
+    """
+    writes the tick loop's statistics, each driver's post times and the frame statistics of FrameDrivers for Metrics.
+    Only called once Metrics is in use, so it is only imported then
+    """
+    import Metrics
+    Metrics.samples(write, 'esp_output_ticks_total', 'counter', 'driver slots fired by the tick loop', None,
+                    {None: stats.count})
+    Metrics.samples(write, 'esp_output_tick_overruns_total', 'counter', 'slots fired more than one tick late', None,
+                    {None: stats.overruns})
+    Metrics.samples(write, 'esp_output_tick_jitter_seconds', 'gauge', 'how late recent slots were fired', 'quantile',
+                    dict((quantile, stats.recent_percentile(quantile)) for quantile in (.5, .9, .99, 1)))
+    Metrics.samples(write, 'esp_output_coalesced_total', 'counter', 'posts skipped because the driver was posting',
+                    None, {None: pool.coalesced})
+    Metrics.histogram(write, 'esp_output_post_seconds', 'time each driver took to post', 'driver', dict(pool.latency))
+    drivers = list(FrameDriver.instances)
+    if drivers:
+        Metrics.samples(write, 'esp_frame_driver_frames_total', 'counter', 'frames posted by a FrameDriver', 'driver',
+                        dict((driver.name, driver.frames) for driver in drivers))
+        Metrics.samples(write, 'esp_frame_driver_merged_total', 'counter',
+                        'changes merged into a frame that was already waiting', 'driver',
+                        dict((driver.name, driver.merged) for driver in drivers))
+        Metrics.samples(write, 'esp_frame_driver_dropped_total', 'counter',
+                        'frames not posted because the frame before took too long', 'driver',
+                        dict((driver.name, driver.dropped) for driver in drivers))
+        Metrics.histogram(write, 'esp_frame_driver_render_seconds', 'time a FrameDriver took to post a frame',
+                          'driver', dict((driver.name, driver.render_time) for driver in drivers))
+
+
+metric_collectors.append(collect)
+
+
+def period_of(module):
+    """
+    :return: update_period of the driver in module, in ticks. 0 is treated as every tick. None if the driver failed
+    to import
+    """
+    period = module.period()
+    if period is None:
+        return None
+    return max(1, int(period))
 
-    def is_alive(self):
-        return self.live
 
-    def isAlive(self):
-        return self.live
+periods = {}  # driver name: the last period period_of() gave for it, in ticks
+
+
+def next_period(module):
+    """
+    :return: period_of(module), or the last period it had if it has none now, e.g. because a reload of the driver
+    failed. None only if it never had one, so a driver that was put in the timing wheel always gets a period
+    """
+    period = period_of(module)
+    if period is None:
+        return periods.get(module.name)
+    periods[module.name] = period
+    return period
 
 
 def run():
     """
     WARNING: this is the call that never eeeennnds
     it just goes on an on forever
-    This function should always be run in a thread. It will, every 1 'tick', update each output driver
-    Modules will be ignored until their update_period has passed. All modules must have an update_period
+    This function should always be run in a thread. It posts each output driver every update_period ticks.
+    All modules must have an update_period
     the update period should be an integer between 0 and ten thousand inclusively
-    under no load, 1 'tick' is one millisecond
-    under high load, it is expected to grow to possibly 5 or 6
-    in will NEVER dip below one millisecond, even with no load at all, this is to save CPU for other things
-    ^ To justify the above, recall that this is to run on a raspberry pi
+    1 'tick' is one millisecond (tick_length)
+    Drivers are kept in a TimingWheel keyed on the tick they are next due, and the thread sleeps until the next due
+    tick instead of waking every tick, so drivers that are not due cost nothing. This matters because this is to run
+    on a raspberry pi.
+    How late each tick is fired is recorded in 'stats'.
+    Posts run in 'pool', so one slow driver does not hold up the others. A driver is never posted twice at once; if
+    it is still posting when it is due again, it posts once more when it finishes.
     :return:
     """
-    cur_tick = 0
-    running_inputs = []
-    for i in range(len(list_of_modules)):
-        running_inputs.append(DummyThread())
-
+    pool.start()
+    wheel = TimingWheel()
+    for module in modules:
+        period = next_period(module)
+        if period is not None:
+            wheel.insert(module, period)
+    start = time.time()
     while True:
-        start = time.time()
-        cur_tick += 1
-        if cur_tick > 10000:
-            cur_tick = 0
-        i = -1
-        for module in list_of_modules:
-            i += 1
-            exec "module = " + module + ".main"  # my solution to not putting this whole thing in an exec  string
-            if not cur_tick % module.update_period and not running_inputs[i].is_alive():
-                running_inputs.append(threading.Thread(target=module.post, name=name + str(i)))
-                module.post()
-            else:
-                pass
-        time.sleep(min(0, .01 - (time.time() - start)))
+        due = wheel.next_due()
+        if due is None:
+            return  # no drivers
+        delay = start + due * tick_length - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        now = max(due, int((time.time() - start) / tick_length))
+        for tick, module in wheel.advance_to(now):
+            stats.record(time.time() - (start + tick * tick_length))
+            pool.submit(module.name, module.post)
+            # a driver whose post made the loop fall behind is not fired again for the ticks it missed
+            wheel.insert(module, max(tick + next_period(module), now + 1))
+
+
+def attach(reactor):
+    """
+    runs the drivers on reactor instead of in a thread of its own with run(). The timing wheel is advanced by reactor
+    timers. Each post runs in the reactor's executor, so a blocking driver holds up neither the reactor nor the other
+    drivers, and gives a Future that is kept in 'posting' until it is done. A driver that is still posting when it is
+    due again is skipped for that tick. Drivers whose main object has post_async(reactor), returning a Future, are
+    posted that way on the reactor thread instead of through the executor.
+    """
+    wheel = TimingWheel()
+    for module in modules:
+        period = next_period(module)
+        if period is not None:
+            wheel.insert(module, period)
+    start = reactor.time()
+
+    def arm():
+        due = wheel.next_due()
+        if due is not None:
+            reactor.call_at(start + due * tick_length, fire, due)
+
+    def fire(due):
+        now = max(due, int((reactor.time() - start) / tick_length))
+        for tick, module in wheel.advance_to(now):
+            stats.record(reactor.time() - (start + tick * tick_length))
+            post(reactor, module)
+            wheel.insert(module, max(tick + next_period(module), now + 1))
+        arm()
+
+    reactor.call_soon(arm)
 
+
+posting = {}  # driver name: Future of the post that is running, for drivers run on a reactor
+
+
+def post(reactor, module):
+    """
+    posts one driver on reactor
+    :return: Future of the post, or None if the driver was still posting
+    """
+    if module.name in posting:
+        pool.coalesced += 1
+        return None
+    main = module.main if module.loaded() else None
+    if main is not None and hasattr(main, 'post_async'):
+        future = main.post_async(reactor)
+    else:
+        future = reactor.run_in_executor(timed_post, module)
+    posting[module.name] = future
+    future.add_done_callback(lambda done: posting.pop(module.name, None))
+    return future
+
+
+def timed_post(module):
+    """
+    posts module and records how long it took in pool.latency, like the pool does for its own posts
+    """
+    start = time.time()
+    try:
+        module.post()
+    finally:
+        pool.record(module.name, time.time() - start)
@@ -0,0 +1,258 @@
+"""
+finds and loads the driver/module files in the OutputDrivers, InputDrivers and Modules folders.
+Each file becomes a Plugin, a stand-in for the module that only imports it the first time something is needed from
+it. What is learned from a file (its update_period, how long it took to import) is kept in an index file in the
+folder, keyed by file name and modification time, so the next boot can schedule the plugin without importing it.
+A file that fails to import is reported and skipped; it does not stop the rest from loading.
+A plugin can be reloaded after its file changes, see Plugin.reload and Reloader.py.
+"""
+import os
+import imp
+import sys
+import json
+import time
+import threading
+import importlib
+import traceback
+
+import Classes
+
+index_name = '.plugins.json'
+
+
+class PluginIndex():
+    """
+    what is known about each file of a folder, saved as json in the folder itself
+    """
+
+    def __init__(self, folder):
+        self.path = os.path.join(folder, index_name)
+        self.lock = threading.Lock()
+        try:
+            with open(self.path) as index_file:
+                self.entries = json.load(index_file)
+        except (IOError, ValueError):
+            self.entries = {}
+
+    def entry(self, name, mtime):
+        """
+        :return: the saved entry for name, or None if there is none or the file changed since it was saved
+        """
+        entry = self.entries.get(name)
+        if entry is None or entry.get('mtime') != mtime:
+            return None
+        return entry
+
+    def update(self, name, mtime, **values):
+        """
+        saves values for name, replacing whatever was saved for an older version of the file
+        """
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is None or entry.get('mtime') != mtime:
+                entry = self.entries[name] = {'mtime': mtime}
+            entry.update(values)
+            self.save()
+
+    def save(self):
+        """
+        writes the index next to the plugins. A read-only folder just means the next boot imports everything again.
+        """
+        temporary = self.path + '.tmp'
+        try:
+            with open(temporary, 'w') as index_file:
+                json.dump(self.entries, index_file, indent=1, sort_keys=True)
+            os.rename(temporary, self.path)
+        except (IOError, OSError):
+            pass
+
+
+class Plugin():
+    """
+    lazy stand-in for one module of a plugin folder. Any attribute that is not the plugin's own (e.g. plugin.main)
+    imports the module and is looked up on it.
+    """
+
+    def __init__(self, package, name, path, mtime, index):
+        """
+        :param package: name of the package the file is in, e.g. 'OutputDrivers'
+        :param name: module name, e.g. 'Lights'
+        :param path: path of the file
+        :param mtime: modification time of the file
+        :param index: PluginIndex of the folder
+        """
+        self.package = package
+        self.name = name
+        self.path = path
+        self.mtime = mtime
+        self.index = index
+        self.module = None
+        self.error = None  # the exception raised by importing, if it failed
+        self.import_time = None  # seconds spent importing, None until imported
+        self.lock = threading.Lock()
+
+    def __getattr__(self, attribute):
+        if attribute.startswith('__'):
+            raise AttributeError(attribute)
+        module = self.load()
+        if module is None:
+            raise AttributeError(self.package + '.' + self.name + ' failed to import, it has no ' + attribute)
+        return getattr(module, attribute)
+
+    def __repr__(self):
+        return '<Plugin ' + self.package + '.' + self.name + '>'
+
+    def load(self):
+        """
+        imports the module if it is not already
+        :return: the module, or None if it failed to import
+        """
+        if self.module is not None or self.error is not None:
+            return self.module
+        with self.lock:
+            if self.module is not None or self.error is not None:
+                return self.module
+            start = time.time()
+            try:
+                module = importlib.import_module(self.package + '.' + self.name)
+            except Exception as error:
+                self.import_time = time.time() - start
+                self.error = error
+                print 'could not import', self.package + '.' + self.name
+                traceback.print_exc()
+                return None
+            self.import_time = time.time() - start
+            self.module = module
+        values = {'import_time': self.import_time}
+        main = getattr(module, 'main', None)
+        if main is not None and hasattr(main, 'update_period'):
+            values['update_period'] = main.update_period
+        self.index.update(self.name, self.mtime, **values)
+        return module
+
+    def reload(self):
+        """
+        imports the file again, into a new module object, and swaps it in for the old one in a single assignment, so
+        the tick loop sees either the old main object or the new one. The old module stays in use if the new one fails
+        to import. Listeners that were registered as methods of the old main object are moved to the new one.
+        A plugin that was never imported only forgets what it knew about the file, the next use imports the new one.
+        :return: True if the new module is in use
+        """
+        mtime = os.path.getmtime(self.path)
+        with self.lock:
+            old = self.module
+            if old is None:
+                self.mtime = mtime
+                self.error = None
+                return True
+            full_name = self.package + '.' + self.name
+            module = imp.new_module(full_name)
+            module.__file__ = self.path
+            module.__package__ = self.package
+            start = time.time()
+            try:
+                with open(self.path) as source:
+                    code = compile(source.read(), self.path, 'exec')
+                exec code in module.__dict__
+            except Exception:
+                print 'could not reload', full_name + ', keeping the old version'
+                traceback.print_exc()
+                return False
+            self.import_time = time.time() - start
+            self.mtime = mtime
+            self.module = module
+            sys.modules[full_name] = module
+            package = sys.modules.get(self.package)
+            if package is not None:
+                setattr(package, self.name, module)
+        old_main = getattr(old, 'main', None)
+        new_main = getattr(module, 'main', None)
+        if old_main is not None and new_main is not None:
+            Classes.migrate_listeners(old_main, new_main)
+        values = {'import_time': self.import_time}
+        if new_main is not None and hasattr(new_main, 'update_period'):
+            values['update_period'] = new_main.update_period
+        self.index.update(self.name, self.mtime, **values)
+        return True
+
+    def loaded(self):
+        return self.module is not None
+
+    def period(self):
+        """
+        :return: update_period of the plugin's main object. Taken from the index if the file has not changed, so the
+        module does not have to be imported to be scheduled. None if the plugin has no update_period or is broken.
+        """
+        entry = self.index.entry(self.name, self.mtime)
+        if self.module is None and entry is not None and 'update_period' in entry:
+            return entry['update_period']
+        module = self.load()
+        if module is None:
+            return None
+        return getattr(getattr(module, 'main', None), 'update_period', None)
+
+    def post(self):
+        """
+        imports the module if needed and posts its main object. Does nothing if the module failed to import.
+        """
+        module = self.load()
+        if module is not None:
+            module.main.post()
+
+
+def discover(init_file, package):
+    """
+    lists the plugins of a package folder. Nothing is imported.
+    :param init_file: __file__ of the package's __init__
+    :param package: __name__ of the package
+    :return: list of Plugins, sorted by name
+    """
+    folder = os.path.dirname(os.path.abspath(init_file))
+    index = PluginIndex(folder)
+    plugins = []
+    for file_name in sorted(os.listdir(folder)):
+        if not file_name.endswith('.py') or file_name.startswith(('_', '.')):
+            continue
+        path = os.path.join(folder, file_name)
+        plugins.append(Plugin(package, file_name[:-3], path, os.path.getmtime(path), index))
+    return plugins
+
+
+def load_all(plugins, parallel=False):
+    """
+    imports every plugin now instead of when it is first used
+    :param parallel: if True, imports in background threads and returns them without waiting, so the rest of the
+    boot goes on while the plugins import. Python only lets one import run at a time, so this overlaps imports with
+    other work, not with each other.
+    :return: list of threads started, empty if not parallel
+    """
+    if not parallel:
+        for plugin in plugins:
+            plugin.load()
+        return []
+    threads = []
+    for plugin in plugins:
+        thread = threading.Thread(target=plugin.load, name='import ' + plugin.name)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    return threads
+
+
+def profile_report(plugins, out=sys.stdout):
+    """
+    prints how long each plugin took to import, slowest first
+    """
+    rows = sorted(plugins, key=lambda plugin: plugin.import_time or 0, reverse=True)
+    total = 0.0
+    for plugin in rows:
+        if plugin.error is not None:
+            status = 'FAILED ' + repr(plugin.error)
+        elif plugin.loaded():
+            status = ''
+        else:
+            status = 'not imported'
+        import_time = plugin.import_time or 0.0
+        total += import_time
+        out.write('%-40s %9.2f ms  %s\n' % (plugin.package + '.' + plugin.name, import_time * 1e3, status))
+    out.write('%-40s %9.2f ms\n' % ('total', total * 1e3))
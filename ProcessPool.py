@@ -0,0 +1,418 @@
+"""
+runs CPU-heavy commands in worker processes, so they use the other cores and do not hold the GIL that the scheduler,
+drivers and listeners need.
+A command is marked with cpu_bound and otherwise written like any other command:
+    def render(strip, text):  # strip arrives as an array, text as the value of the Variable
+        ...
+        return frame
+    def show(frame, strip, text):  # called with the result, back on the event thread
+        strip[:] = frame
+    Event([cpu_bound(render, done=show, timeout=2)], ['strip', 'text'], [text], [])
+    ProcessPool.start()
+Once start() has been called, Command.execute hands cpu_bound commands to the pool instead of calling them. Before
+that, or if the pool is stopped, they run inline as before.
+Arguments are made picklable: a Variable is passed as its value. A VariableArray is copied into a memory arena that is
+shared with the workers and arrives as a numpy array (or an array.array without numpy) read from it, so large banks
+are not pickled. The command itself must be a function defined at the top level of a module, so it can be found by
+name in the worker.
+Results, and exceptions, come back as Futures (see Reactor.py). The done callbacks run on the pool's dispatcher
+thread, or on the reactor thread once the pool is attached to a Reactor.
+A job that runs past its timeout, or that is cancelled while running, has its worker process killed and replaced.
+"""
+import os
+import mmap
+import time
+import array
+import errno
+import select
+import threading
+import traceback
+import collections
+import multiprocessing
+
+import Classes
+from Reactor import Future, set_nonblocking
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobTimeout(Exception):
+    pass
+
+
+def cpu_bound(function, done=None, timeout=None):
+    """
+    marks function as a command to run in the process pool
+    :param function: command, called as function(*arguments) where the arguments are made from the Event's modules
+    :param done: optional function called as done(result, *modules) on the event thread once function returns
+    :param timeout: seconds after which the job is stopped, None for no limit
+    :return: function
+    """
+    function.cpu_bound = True
+    function.done = done
+    function.timeout = timeout
+    return function
+
+
+class Arena():
+    """
+    a block of memory shared with the worker processes, split into equal slots. It is made before the workers are
+    forked, so they all inherit it.
+    """
+
+    def __init__(self, size, slot_size):
+        self.memory = mmap.mmap(-1, size)
+        self.slot_size = slot_size
+        self.free = list(range(0, size - slot_size + 1, slot_size))
+        self.lock = threading.Lock()
+
+    def allocate(self, length):
+        """
+        :return: offset of a free slot of at least length bytes, or None if there is none
+        """
+        if length > self.slot_size:
+            return None
+        with self.lock:
+            if not self.free:
+                return None
+            return self.free.pop()
+
+    def release(self, offset):
+        with self.lock:
+            self.free.append(offset)
+
+
+class SharedArgument():
+    """
+    stands in for an array that was copied into the arena, and becomes an array again in the worker
+    """
+
+    def __init__(self, offset, length, typecode):
+        self.offset = offset
+        self.length = length  # bytes
+        self.typecode = typecode
+
+    def open(self, arena):
+        if numpy is not None:
+            return numpy.frombuffer(arena.memory, numpy.dtype(self.typecode), self.length // array.array(
+                self.typecode).itemsize, self.offset)
+        return array.array(self.typecode, arena.memory[self.offset:self.offset + self.length])
+
+
+def work(connection, arena):
+    """
+    the loop of a worker process: receives (function, arguments), sends back (True, result) or (False, error)
+    """
+    while True:
+        try:
+            job = connection.recv()
+        except (EOFError, IOError):
+            return
+        if job is None:
+            return
+        function, arguments = job
+        arguments = [argument.open(arena) if isinstance(argument, SharedArgument) else argument
+                     for argument in arguments]
+        try:
+            reply = (True, function(*arguments))
+        except Exception as error:
+            reply = (False, error)
+        try:
+            connection.send(reply)
+        except Exception:  # the result or the error could not be pickled
+            connection.send((False, RuntimeError(''.join(traceback.format_exc()))))
+
+
+class Job(Future):
+    """
+    Future of one function run in the pool, which can also be cancelled
+    """
+
+    def __init__(self, pool, function, arguments, timeout):
+        Future.__init__(self)
+        self.pool = pool
+        self.function = function
+        self.arguments = arguments
+        self.timeout = timeout
+        self.started = time.time()
+        self.deadline = None  # time.time() the job must finish by, set when a worker starts it
+        self.slots = []  # arena offsets to release once the job is done
+
+    def cancel(self):
+        """
+        stops the job, killing its worker if it has started
+        :return: True if the job had not finished yet
+        """
+        return self.pool.cancel(self)
+
+
+class Worker():
+    def __init__(self, pool):
+        self.connection, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=work, args=(child, pool.arena), name=pool.name + ' worker')
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+        self.job = None
+
+    def fileno(self):
+        return self.connection.fileno()
+
+    def stop(self, kill=False):
+        try:
+            if kill:
+                self.process.terminate()
+            else:
+                self.connection.send(None)
+        except (IOError, OSError):
+            pass
+        self.connection.close()
+
+
+class ProcessPool():
+    """
+    worker processes, one per core unless told otherwise, and the dispatcher thread that hands them jobs and collects
+    their results
+    """
+
+    def __init__(self, processes=None, arena_size=16 << 20, slot_size=1 << 20, name='processes'):
+        """
+        :param processes: number of worker processes, defaults to the number of cores
+        :param arena_size: bytes of memory shared with the workers for array arguments
+        :param slot_size: largest array, in bytes, passed through shared memory. Larger ones are pickled
+        """
+        self.processes = processes or multiprocessing.cpu_count()
+        self.name = name
+        self.arena = Arena(arena_size, slot_size)
+        self.reactor = None
+        self.pending = collections.deque()  # Jobs not given to a worker yet
+        self.workers = []
+        self.lock = threading.Lock()
+        self.wake_read, self.wake_write = os.pipe()
+        for fd in (self.wake_read, self.wake_write):
+            set_nonblocking(fd)
+        self.thread = None
+        self.running = False
+        self.timeouts = 0
+        self.cancelled = 0
+        self.latency = Classes.Histogram()  # seconds from submit to result
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.workers = [Worker(self) for i in range(self.processes)]
+        self.thread = threading.Thread(target=self.dispatch, name=self.name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        stops the workers. Jobs that have not finished fail with JobCancelled.
+        """
+        with self.lock:
+            self.running = False
+            jobs = list(self.pending) + [worker.job for worker in self.workers if worker.job is not None]
+            self.pending.clear()
+            for worker in self.workers:
+                worker.stop(kill=worker.job is not None)
+            self.workers = []
+        for job in jobs:
+            self.finish(job, False, JobCancelled('pool stopped'))
+        self.wake()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(1)
+
+    def attach(self, reactor):
+        """
+        delivers results on the reactor thread instead of the dispatcher thread
+        """
+        self.reactor = reactor
+
+    def submit(self, function, *arguments, **options):
+        """
+        runs function(*arguments) in a worker
+        :param options: optional keyword arguments
+            timeout: seconds the job may run for before it is stopped and fails with JobTimeout
+        :return: Job
+        """
+        job = Job(self, function, arguments, options.get('timeout'))
+        job.arguments = tuple(self.share(job, argument) for argument in arguments)
+        with self.lock:
+            if not self.running:
+                raise RuntimeError(self.name + ' is not running')
+            self.pending.append(job)
+        self.wake()
+        return job
+
+    def share(self, job, argument):
+        """
+        :return: argument as it is sent to the worker. Variables become their value, arrays go through the arena
+        """
+        if isinstance(argument, Classes.Variable):
+            argument = argument.value
+        if isinstance(argument, array.array) or (numpy is not None and isinstance(argument, numpy.ndarray)):
+            data = argument.tostring()
+            offset = self.arena.allocate(len(data))
+            if offset is not None:
+                self.arena.memory[offset:offset + len(data)] = data
+                job.slots.append(offset)
+                typecode = argument.typecode if isinstance(argument, array.array) else argument.dtype.char
+                return SharedArgument(offset, len(data), typecode)
+        return argument
+
+    def submit_command(self, command, modules):
+        """
+        runs a cpu_bound command with the modules of a Command, then calls its done callback with the result
+        :return: Job
+        """
+        job = self.submit(command, *modules, timeout=getattr(command, 'timeout', None))
+        done = getattr(command, 'done', None)
+        if done is not None:
+            def deliver(finished):
+                if finished.error is None:
+                    done(finished.value, *modules)
+                else:
+                    print 'command', command.__name__, 'failed:', repr(finished.error)
+            job.add_done_callback(deliver)
+        return job
+
+    def cancel(self, job):
+        with self.lock:
+            if job.done():
+                return False
+            if job in self.pending:
+                self.pending.remove(job)
+            else:
+                for worker in self.workers:
+                    if worker.job is job:
+                        self.replace(worker)
+                        break
+            self.cancelled += 1
+        self.finish(job, False, JobCancelled(job.function.__name__ + ' was cancelled'))
+        self.wake()
+        return True
+
+    def replace(self, worker):
+        """
+        kills a worker that is running a job that has to stop, and starts a new one. The lock must be held
+        """
+        worker.stop(kill=True)
+        self.workers[self.workers.index(worker)] = Worker(self)
+
+    def finish(self, job, succeeded, value):
+        for offset in job.slots:
+            self.arena.release(offset)
+        job.slots = []
+        self.latency.observe(time.time() - job.started)
+        if self.reactor is not None:
+            if succeeded:
+                self.reactor.call_soon_threadsafe(job.set_result, value)
+            else:
+                self.reactor.call_soon_threadsafe(job.set_exception, value)
+        elif succeeded:
+            job.set_result(value)
+        else:
+            job.set_exception(value)
+
+    def wake(self):
+        try:
+            os.write(self.wake_write, 'x')
+        except OSError as error:
+            if error.errno != errno.EAGAIN:
+                raise
+
+    def dispatch(self):
+        """
+        the dispatcher thread: gives pending jobs to idle workers, collects results, and stops jobs that run too long
+        """
+        while self.running:
+            finished = []
+            with self.lock:
+                now = time.time()
+                for worker in list(self.workers):
+                    job = worker.job
+                    if job is not None and job.deadline is not None and job.deadline <= now:
+                        self.replace(worker)
+                        self.timeouts += 1
+                        finished.append((job, False, JobTimeout(job.function.__name__ + ' took more than ' +
+                                                                str(job.timeout) + ' seconds')))
+                for worker in self.workers:
+                    if worker.job is None and self.pending:
+                        job = self.pending.popleft()
+                        try:
+                            worker.connection.send((job.function, job.arguments))
+                        except Exception as error:  # usually a function or argument that can not be pickled
+                            finished.append((job, False, error))
+                            continue
+                        worker.job = job
+                        if job.timeout is not None:
+                            job.deadline = now + job.timeout
+                busy = [worker for worker in self.workers if worker.job is not None]
+                deadlines = [worker.job.deadline for worker in busy if worker.job.deadline is not None]
+            for job, succeeded, value in finished:
+                self.finish(job, succeeded, value)
+            timeout = max(0.0, min(deadlines) - time.time()) if deadlines else None
+            try:
+                readable = select.select([self.wake_read] + busy, [], [], timeout)[0]
+            except (select.error, IOError, ValueError):  # interrupted, or a worker was replaced meanwhile
+                continue
+            for source in readable:
+                if source == self.wake_read:
+                    try:
+                        while os.read(self.wake_read, 4096):
+                            pass
+                    except OSError as error:
+                        if error.errno != errno.EAGAIN:
+                            raise
+                    continue
+                self.collect(source)
+
+    def collect(self, worker):
+        """
+        reads the reply of a worker that has one
+        """
+        try:
+            succeeded, value = worker.connection.recv()
+        except (EOFError, IOError) as error:  # the worker died, or was replaced while the select was waiting
+            with self.lock:
+                job = worker.job
+                if worker not in self.workers or job is None:
+                    return
+                self.replace(worker)
+            self.finish(job, False, RuntimeError('worker process died: ' + repr(error)))
+            return
+        with self.lock:
+            job = worker.job
+            worker.job = None
+        if job is not None and not job.done():
+            self.finish(job, succeeded, value)
+
+
+pool = None
+
+
+def start(processes=None, **options):
+    """
+    starts the shared pool and makes Command.execute run cpu_bound commands in it
+    :return: the pool
+    """
+    global pool
+    if pool is None:
+        pool = ProcessPool(processes, **options)
+    pool.start()
+    Classes.command_pool = pool
+    return pool
+
+
+def stop():
+    if pool is not None:
+        Classes.command_pool = None
+        pool.stop()
@@ -0,0 +1,299 @@
+"""
+single threaded runtime that the scheduler, input drivers and output drivers can all run on instead of each having
+their own thread with a 'while True' and time.sleep().
+Everything attached to a Reactor runs on the thread that called run_forever(). Timers are kept in a heap and the
+thread sleeps in epoll/select() until the next one is due, a file descriptor added with add_reader() has data, or
+another thread wakes it. Timers are kept on the monotonic clock (see Reactor.time()), so a step of the wall clock,
+e.g. by NTP or at boot, does not move them. Anything that blocks (legacy drivers, slow posts) is handed to a
+WorkerPool with run_in_executor() and its result comes back to the reactor thread through a Future.
+example:
+    reactor = Reactor()
+    scheduler.attach(reactor)
+    OutputDrivers.attach(reactor)
+    reactor.run_forever()  # returns once reactor.stop() is called
+"""
+import os
+import errno
+import fcntl
+import heapq
+import select
+import threading
+import traceback
+import collections
+
+from Classes import WorkerPool, monotonic
+
+
+def set_nonblocking(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+
+def fileno(source):
+    """
+    :return: the file descriptor of source, which may be a file descriptor already or anything with fileno()
+    """
+    if isinstance(source, (int, long)):
+        return source
+    return source.fileno()
+
+
+class Future():
+    """
+    the result of something that finishes later, e.g. a call run in the executor.
+    Callbacks added with add_done_callback are called with the Future once it is done.
+    """
+
+    def __init__(self):
+        self.finished = threading.Event()
+        self.value = None
+        self.error = None
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    def done(self):
+        return self.finished.is_set()
+
+    def set_result(self, value):
+        self.value = value
+        self.finish()
+
+    def set_exception(self, error):
+        self.error = error
+        self.finish()
+
+    def finish(self):
+        with self.lock:
+            self.finished.set()
+            callbacks = self.callbacks
+            self.callbacks = []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        with self.lock:
+            if not self.finished.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def result(self, timeout=None):
+        """
+        waits for the result. Must not be called on the reactor thread before the Future is done, it would wait for
+        itself forever.
+        :return: the result, or raises the exception it finished with
+        """
+        if not self.finished.wait(timeout):
+            raise RuntimeError('future not done after ' + str(timeout) + ' seconds')
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class Timer():
+    """
+    returned by Reactor.call_at() and call_later(). cancel() stops the call from happening.
+    """
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Reactor():
+    """
+    event loop. All methods except call_soon_threadsafe(), run_in_executor() and stop() must be called from the
+    reactor thread, or before run_forever() is called.
+    """
+
+    def __init__(self, executor=None):
+        """
+        :param executor: WorkerPool used by run_in_executor. A pool with 4 workers is made if none is given
+        """
+        self.executor = executor or WorkerPool(workers=4, queue_size=256, name='reactor')
+        self.timers = []  # heap of (when, sequence, Timer)
+        self.sequence = 0
+        self.ready = collections.deque()  # (callback, args) to call on the next pass
+        self.stopping = False
+        self.running = False
+        self.stop_callbacks = []
+        self.wake_read, self.wake_write = os.pipe()  # written to by other threads to wake select()
+        for fd in (self.wake_read, self.wake_write):
+            set_nonblocking(fd)
+        self.readers = {}  # file descriptor: (callback, args)
+        self.epoll = None
+        if hasattr(select, 'epoll'):  # linux, scales with the number of readers unlike select()
+            self.epoll = select.epoll()
+            self.epoll.register(self.wake_read, select.EPOLLIN)
+
+    def time(self):
+        """
+        :return: seconds on the monotonic clock, which timers are set on. Not the wall clock, so only differences
+        between two of these mean anything
+        """
+        return monotonic()
+
+    def call_soon(self, callback, *args):
+        self.ready.append((callback, args))
+
+    def call_soon_threadsafe(self, callback, *args):
+        """
+        like call_soon, but can be called from any thread
+        """
+        self.ready.append((callback, args))  # deque.append is atomic
+        self.wake()
+
+    def call_at(self, when, callback, *args):
+        """
+        :param when: self.time() at which to call callback(*args)
+        :return: Timer
+        """
+        timer = Timer(when, callback, args)
+        self.sequence += 1
+        heapq.heappush(self.timers, (when, self.sequence, timer))
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(self.time() + delay, callback, *args)
+
+    def run_in_executor(self, function, *args):
+        """
+        runs function(*args) in the executor, so something that blocks does not hold up the reactor
+        :return: Future, whose done callbacks are called on the reactor thread
+        """
+        future = Future()
+
+        def call():
+            try:
+                value = function(*args)
+            except Exception as error:
+                self.call_soon_threadsafe(future.set_exception, error)
+            else:
+                self.call_soon_threadsafe(future.set_result, value)
+
+        self.executor.start()
+        self.executor.submit(None, call)
+        return future
+
+    def add_reader(self, source, callback, *args):
+        """
+        calls callback(*args) on the reactor thread whenever source has data to read
+        :param source: file descriptor, or a file, socket or pipe with fileno()
+        """
+        fd = fileno(source)
+        if self.epoll is not None:
+            if fd in self.readers:
+                self.epoll.modify(fd, select.EPOLLIN)
+            else:
+                self.epoll.register(fd, select.EPOLLIN)
+        self.readers[fd] = (callback, args)
+        self.wake()  # in case this was called from another thread while the reactor is waiting
+
+    def remove_reader(self, source):
+        """
+        stops watching source
+        :return: True if it was being watched
+        """
+        fd = fileno(source)
+        if self.readers.pop(fd, None) is None:
+            return False
+        if self.epoll is not None:
+            try:
+                self.epoll.unregister(fd)
+            except (IOError, OSError, ValueError):
+                pass  # already closed
+        return True
+
+    def on_stop(self, callback, *args):
+        """
+        calls callback(*args) on the reactor thread when it stops, before run_forever() returns
+        """
+        self.stop_callbacks.append((callback, args))
+
+    def stop(self):
+        """
+        makes run_forever() return after the current pass. Can be called from any thread or a signal handler.
+        """
+        self.stopping = True
+        self.wake()
+
+    def wake(self):
+        try:
+            os.write(self.wake_write, 'x')
+        except OSError as error:
+            if error.errno != errno.EAGAIN:  # a full pipe will wake select() anyway
+                raise
+
+    def run_forever(self):
+        self.running = True
+        self.stopping = False
+        try:
+            while not self.stopping:
+                self.run_once()
+            for callback, args in self.stop_callbacks:
+                self.call(callback, args)
+        finally:
+            self.running = False
+
+    def run_once(self):
+        """
+        calls everything that is ready, then waits for the next timer or for a wake up
+        """
+        ready = self.ready
+        for i in range(len(ready)):
+            callback, args = ready.popleft()
+            self.call(callback, args)
+        timeout = None
+        if self.ready or self.stopping:
+            timeout = 0
+        elif self.timers:
+            timeout = max(0.0, self.timers[0][0] - self.time())
+        self.wait(timeout)
+        now = self.time()
+        while self.timers and self.timers[0][0] <= now:
+            timer = heapq.heappop(self.timers)[2]
+            if not timer.cancelled:
+                self.ready.append((timer.callback, timer.args))
+
+    def wait(self, timeout):
+        """
+        sleeps in epoll (or select() where there is no epoll) for up to timeout seconds, until woken or until a reader
+        has data. Readers with data are called straight away.
+        """
+        try:
+            if self.epoll is not None:
+                readable = [fd for fd, event in self.epoll.poll(-1 if timeout is None else timeout)]
+            else:
+                readable = select.select([self.wake_read] + list(self.readers), [], [], timeout)[0]
+        except (select.error, IOError) as error:
+            if error.args[0] != errno.EINTR:
+                raise
+            return
+        for fd in readable:
+            if fd == self.wake_read:
+                self.drain()
+                continue
+            reader = self.readers.get(fd)
+            if reader is not None:
+                self.call(reader[0], reader[1])
+
+    def drain(self):
+        try:
+            while os.read(self.wake_read, 4096):
+                pass
+        except OSError as error:
+            if error.errno != errno.EAGAIN:
+                raise
+
+    def call(self, callback, args):
+        """
+        calls callback(*args), printing anything it raises instead of letting it stop the reactor
+        """
+        try:
+            callback(*args)
+        except Exception:
+            traceback.print_exc()
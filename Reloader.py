@@ -0,0 +1,234 @@
+"""
+reloads drivers, modules and rule files while the system runs, when their files are saved, instead of restarting
+everything. Only the plugin whose file changed is reloaded (see Plugin.reload); variables, the scheduler and its timers
+stay as they are. A rule file is loaded again with Config.reload.
+Changes are found with inotify, through ctypes since python 2 has no binding for it. Where inotify is not available
+the files' modification times are checked every 'interval' seconds instead.
+How long each reload took is printed and kept in 'latency'.
+example:
+    watcher = Watcher()
+    for package in (OutputDrivers, InputDrivers, Modules):
+        watcher.add_package(package)
+    watcher.add_config('rules.xml', config)
+    watcher.attach(reactor)  # or run watcher.run in a thread
+New files are not picked up until the next restart.
+"""
+import os
+import time
+import errno
+import struct
+import select
+import ctypes
+import ctypes.util
+import threading
+import traceback
+
+import Classes
+
+IN_CLOSE_WRITE = 0x00000008  # a file opened for writing was closed
+IN_MOVED_TO = 0x00000080  # a file was renamed into the folder, as editors that save to a temporary file do
+event_header = struct.Struct('iIII')  # struct inotify_event without its name: wd, mask, cookie, len
+
+
+def load_libc():
+    """
+    :return: libc through ctypes if it has inotify, otherwise None
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.inotify_init1
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class Inotify():
+    """
+    the files saved in a set of folders, read from an inotify file descriptor
+    """
+
+    def __init__(self, libc):
+        self.libc = libc
+        self.fd = libc.inotify_init1(os.O_NONBLOCK)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self.folders = {}  # watch descriptor: folder
+
+    def watch(self, folder):
+        descriptor = self.libc.inotify_add_watch(self.fd, folder, IN_CLOSE_WRITE | IN_MOVED_TO)
+        if descriptor < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), folder)
+        self.folders[descriptor] = folder
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        """
+        :return: list of paths saved since the last read, without waiting
+        """
+        paths = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as error:
+                if error.errno == errno.EAGAIN:
+                    return paths
+                raise
+            offset = 0
+            while offset < len(data):
+                descriptor, mask, cookie, length = event_header.unpack_from(data, offset)
+                offset += event_header.size
+                name = data[offset:offset + length].rstrip('\0')
+                offset += length
+                if descriptor in self.folders and name:
+                    paths.append(os.path.join(self.folders[descriptor], name))
+
+
+class Watcher():
+    """
+    reloads the plugins and rule files it has been given when their files are saved
+    """
+
+    def __init__(self, interval=1.0):
+        """
+        :param interval: seconds between checks of the modification times, when there is no inotify
+        """
+        self.interval = interval
+        self.plugins = {}  # path: Plugin
+        self.configs = {}  # path: RuleLoader.Config
+        self.mtimes = {}  # path: modification time last seen, for polling
+        self.folders = set()
+        self.latency = Classes.Histogram()
+        self.reloads = 0
+        self.failures = 0
+        libc = load_libc()
+        self.inotify = None
+        if libc is not None:
+            try:
+                self.inotify = Inotify(libc)
+            except OSError:
+                pass
+
+    def add_package(self, package):
+        """
+        watches every plugin of a package, e.g. OutputDrivers
+        """
+        for plugin in package.modules:
+            self.add(plugin.path, self.plugins, plugin)
+
+    def add_config(self, path, config):
+        """
+        watches a rule file loaded into config
+        """
+        self.add(path, self.configs, config)
+
+    def add(self, path, kind, item):
+        path = os.path.abspath(path)
+        kind[path] = item
+        self.mtimes[path] = self.mtime(path)
+        folder = os.path.dirname(path)
+        if folder not in self.folders:
+            self.folders.add(folder)
+            if self.inotify is not None:
+                self.inotify.watch(folder)
+
+    def mtime(self, path):
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return None
+
+    def changed_paths(self):
+        """
+        :return: watched paths saved since the last call
+        """
+        if self.inotify is not None:
+            paths = self.inotify.read()
+        else:
+            paths = list(self.mtimes)
+        changed = []
+        for path in paths:
+            if path not in self.mtimes:
+                continue
+            mtime = self.mtime(path)
+            if mtime is None or (self.inotify is None and mtime == self.mtimes[path]) or path in changed:
+                continue
+            self.mtimes[path] = mtime
+            changed.append(path)
+        return changed
+
+    def check(self):
+        """
+        reloads whatever was saved since the last check
+        """
+        for path in self.changed_paths():
+            self.reload(path)
+
+    def reload(self, path):
+        """
+        reloads the plugin or rule file at path, printing how long it took
+        :return: True if it was reloaded
+        """
+        start = time.time()
+        try:
+            if path in self.plugins:
+                reloaded = self.plugins[path].reload()
+            else:
+                self.configs[path].reload(path)
+                reloaded = True
+        except Exception:
+            print 'could not reload', path
+            traceback.print_exc()
+            reloaded = False
+        took = time.time() - start
+        if reloaded:
+            self.reloads += 1
+            self.latency.observe(took)
+            print 'reloaded %s in %.1f ms' % (path, took * 1e3)
+        else:
+            self.failures += 1
+        return reloaded
+
+    def run(self):
+        """
+        checks for saved files forever. Should be run in a thread of its own
+        """
+        while True:
+            if self.inotify is not None:
+                try:
+                    select.select([self.inotify], [], [])
+                except select.error as error:
+                    if error.args[0] != errno.EINTR:
+                        raise
+                    continue
+            else:
+                time.sleep(self.interval)
+            self.check()
+
+    def start(self):
+        """
+        runs the watcher in a daemon thread
+        :return: the thread
+        """
+        thread = threading.Thread(target=self.run, name='reloader')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def attach(self, reactor):
+        """
+        checks for saved files on reactor instead of in a thread. Reloads then run on the reactor thread, between
+        posts, so nothing posts while a plugin is being swapped.
+        """
+        if self.inotify is not None:
+            reactor.add_reader(self.inotify, self.check)
+            return
+
+        def poll():
+            self.check()
+            reactor.call_later(self.interval, poll)
+
+        reactor.call_later(self.interval, poll)
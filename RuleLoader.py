@@ -0,0 +1,235 @@
+"""
+loads variables, timers and rules (Events) from an XML file instead of INIT code.
+    <esp>
+        <variable name="temperature" type="integer" value="20"/>
+        <variable name="heater" type="ranged" value="0" min="0" max="100"/>
+        <timer name="morning" format="%H:%M:%S" time="7:0:0"/>
+        <rule name="heat" triggers="temperature morning">
+            <condition>temperature &lt; 15</condition>
+            <condition>heater &lt; 100</condition>
+            <command>heater.set(100)</command>
+        </rule>
+    </esp>
+variable types are 'variable', 'integer' and 'ranged'. Names must be valid python names.
+Conditions are python expressions. They see the value of each variable they name, and only the variables they name
+are read, so each condition becomes a Classes.Condition with those variables as inputs and is only evaluated again
+when one of them changes. Rules with the same condition text share one Condition.
+Commands are python statements. They see the variable and timer objects themselves, so they can set() them. Each
+run gets a fresh copy of the names, so a name a command assigns to does not leak into the config or the next run.
+Rules are made once the whole file is read, so they can name variables and timers defined after them.
+Every expression is compiled once per distinct text and the code object is reused.
+The file is read with iterparse and each element is dropped once it is loaded, so large files are not held in
+memory.
+A running config can be loaded again from an edited file with Config.reload, see Reloader.py.
+"""
+import xml.etree.cElementTree as ElementTree
+
+import Classes
+
+variable_types = {
+    'variable': Classes.Variable,
+    'integer': Classes.IntegerVariable,
+    'ranged': Classes.RangedVariable,
+}
+code_cache = {}  # (text, mode): code object
+
+
+def compiled(text, mode, name):
+    """
+    :return: the code object for text, compiled the first time it is asked for
+    """
+    code = code_cache.get((text, mode))
+    if code is None:
+        code = code_cache[(text, mode)] = compile(text, '<' + name + '>', mode)
+    return code
+
+
+def number(text):
+    """
+    :return: text as an int if it is one, otherwise as a float
+    """
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
+class Config():
+    """
+    everything loaded from one file, by name
+    """
+
+    def __init__(self, scheduler=None):
+        """
+        :param scheduler: WaitingQueue for the timers. Only needed if the file has timers
+        """
+        self.scheduler = scheduler
+        self.variables = {}  # name: Variable, including timers
+        self.timers = {}  # name: TimeVariable
+        self.rules = {}  # name: Event
+        self.conditions = {}  # condition text: Condition, shared by every rule using it
+        self.timer_specs = {}  # name: (format, time) each timer was made from
+        self.previous = {}  # name: Variable from before a reload, reused if it is defined the same way again
+        self.previous_specs = {}  # timer_specs from before a reload
+
+    def load(self, source):
+        """
+        reads a file and adds what it defines
+        :param source: path or open file
+        :return: self
+        """
+        rules = []  # (name, triggers, conditions, commands, modules) of each rule, made once every name is known
+        for event, element in ElementTree.iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                continue
+            if element.tag == 'variable':
+                self.add_variable(element)
+            elif element.tag == 'timer':
+                self.add_timer(element)
+            elif element.tag == 'rule':
+                rules.append(self.read_rule(element, len(self.rules) + len(rules)))
+            else:
+                continue
+            element.clear()
+        for rule in rules:
+            self.add_rule(*rule)
+        return self
+
+    def reload(self, source):
+        """
+        loads an edited file in place of what was loaded before. Variables and timers defined the same way as before
+        keep their objects, so their values, listeners and place in the scheduler are kept. Rules are all made again.
+        Timers that are gone or changed are cancelled. If the file fails to load, everything is left as it was.
+        :param source: path or open file
+        :return: self
+        """
+        new = Config(self.scheduler)
+        new.previous = self.variables
+        new.previous_specs = self.timer_specs
+        try:
+            new.load(source)
+        except Exception:
+            new.detach()
+            for name, timer in new.timers.items():
+                if self.timers.get(name) is not timer:
+                    timer.handle.cancel()
+            for name, variable in self.variables.items():
+                Classes.register_module(name, variable)
+            raise
+        self.detach()
+        for name, timer in self.timers.items():
+            if new.timers.get(name) is not timer:
+                timer.handle.cancel()
+        for name, variable in self.variables.items():
+            if name not in new.variables and Classes.module_index.get(name) is variable:
+                del Classes.module_index[name]
+        self.variables = new.variables
+        self.timers = new.timers
+        self.timer_specs = new.timer_specs
+        self.rules = new.rules
+        self.conditions = new.conditions
+        return self
+
+    def detach(self):
+        """
+        stops every rule from running
+        """
+        for event in self.rules.values():
+            event.detach()
+
+    def add_variable(self, element):
+        name = element.get('name')
+        variable_type = variable_types.get(element.get('type', 'integer'))
+        if variable_type is None:
+            raise ValueError('variable ' + name + ' has unknown type ' + element.get('type'))
+        value = number(element.get('value', '0'))
+        variable = self.previous.get(name)
+        if type(variable) is variable_type:  # keeps its value and listeners
+            if variable_type is Classes.RangedVariable:
+                variable.min = number(element.get('min', '0'))
+                variable.max = number(element.get('max', '10'))
+        elif variable_type is Classes.RangedVariable:
+            variable = variable_type(value, number(element.get('min', '0')), number(element.get('max', '10')))
+        else:
+            variable = variable_type(value)
+        self.name(name, variable)
+
+    def add_timer(self, element):
+        if self.scheduler is None:
+            raise ValueError('timer ' + element.get('name') + ' needs a scheduler')
+        name = element.get('name')
+        spec = (element.get('format', '%H:%M:%S'), element.get('time'))
+        timer = self.previous.get(name)
+        if not isinstance(timer, Classes.TimeVariable) or self.previous_specs.get(name) != spec:
+            timer = Classes.TimeVariable(spec[1], self.scheduler, spec[0], name=name)
+        self.timers[name] = timer
+        self.timer_specs[name] = spec
+        self.name(name, timer)
+
+    def name(self, name, variable):
+        if name in self.variables:
+            raise ValueError(name + ' is defined twice')
+        self.variables[name] = variable
+        Classes.register_module(name, variable)
+
+    def read_rule(self, element, index):
+        """
+        :param index: number of the rule in the config, names rules that have no name
+        :return: (name, triggers, conditions, commands, modules) of a rule element, all as text
+        """
+        name = element.get('name') or 'rule ' + str(index)
+        conditions = [child.text.strip() for child in element.findall('condition')]
+        commands = [child.text.strip() for child in element.findall('command')]
+        return name, element.get('triggers', '').split(), conditions, commands, element.get('modules', '').split()
+
+    def add_rule(self, name, triggers, conditions, commands, modules):
+        variables = []
+        for trigger in triggers:
+            if trigger not in self.variables:
+                raise ValueError('rule ' + name + ' is triggered by ' + trigger + ', which is not defined')
+            variables.append(self.variables[trigger])
+        conditions = [self.condition(text, name) for text in conditions]
+        commands = [self.command(text, name) for text in commands]
+        self.rules[name] = Classes.Event(commands, modules, variables, conditions, name=name)
+
+    def condition(self, text, rule):
+        """
+        :return: the shared Condition for text
+        """
+        condition = self.conditions.get(text)
+        if condition is not None:
+            return condition
+        code = compiled(text, 'eval', rule)
+        names = [name for name in code.co_names if name in self.variables]
+        inputs = [self.variables[name] for name in names]
+        builtins = {'__builtins__': __builtins__}
+
+        def evaluate(*modules):
+            values = {}
+            for name, variable in zip(names, inputs):
+                values[name] = variable.value
+            return eval(code, builtins, values)
+
+        condition = self.conditions[text] = Classes.Condition(evaluate, inputs)
+        return condition
+
+    def command(self, text, rule):
+        """
+        :return: a function running the statements in text with the variables in scope
+        """
+        code = compiled(text, 'exec', rule)
+        namespace = self.variables
+
+        def run(*modules):
+            exec code in {'__builtins__': __builtins__}, dict(namespace)
+
+        return run
+
+
+def load(source, scheduler=None):
+    """
+    :param source: path or open file of the XML config
+    :param scheduler: WaitingQueue for the timers. Only needed if the file has timers
+    :return: Config with everything the file defines
+    """
+    return Config(scheduler).load(source)
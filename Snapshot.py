@@ -0,0 +1,169 @@
+"""
+saves the state of a running system to one file and restores it after a restart:
+    - the values of the variables in registered VariableMatrix objects
+    - every compiled Schedule in the schedule cache, so TimeVariables made at boot do not parse their specs again
+    - the time each named entry of a registered WaitingQueue is due
+The file is a short header followed by a single binary pickle. Loading it is one read and one cPickle.loads. A file
+that can not be read, was written by another version or is damaged is reported and ignored, and the system starts
+with an empty state.
+example:
+    store = Store('/var/lib/esp/state')
+    store.add_matrix('lights', lights)
+    store.add_queue('scheduler', scheduler)
+    store.load()        # at boot, before the TimeVariables are made: warms the schedule cache
+    ...                 # make the variables, TimeVariables (with name=...) and events as usual
+    store.restore()     # puts the saved values and timer times back
+    ...
+    store.save()        # whenever the state should be kept, e.g. when stopping
+Timers that were due while the system was down are handled by the catch-up policy given to restore():
+    'skip': forget the missed runs, the timer waits for its next time
+    'coalesce': post once for all the missed runs
+    'fire-late': post once for every missed run, at most max_missed times
+"""
+import os
+import errno
+import datetime
+import threading
+import traceback
+import cPickle
+
+import Classes
+
+header = 'ESP-SNAPSHOT 1\n'
+policies = ('skip', 'coalesce', 'fire-late')
+
+
+class Store():
+    """
+    a snapshot file and the matrices and queues it holds the state of
+    """
+
+    def __init__(self, path):
+        """
+        :param path: file to save to and load from
+        """
+        self.path = path
+        self.matrices = {}  # name: VariableMatrix
+        self.queues = {}  # name: WaitingQueue
+        self.state = None  # what load() read, None until then
+        self.missed = 0  # runs that restore() found were missed while the system was down
+        self.lock = threading.Lock()  # held while saving, so saves from two threads do not share the temporary file
+
+    def add_matrix(self, name, matrix):
+        self.matrices[name] = matrix
+
+    def add_queue(self, name, queue):
+        self.queues[name] = queue
+
+    def save(self):
+        """
+        writes the snapshot. The old file is only replaced once the new one is completely on disk. Can be called from
+        any thread.
+        """
+        state = {
+            'saved': datetime.datetime.today(),
+            'schedules': Classes.schedule_cache.items(),
+            'matrices': {},
+            'queues': {},
+        }
+        for name, matrix in self.matrices.items():
+            values = {}
+            for key, variable in matrix.variables.items():
+                if isinstance(variable, Classes.Variable):
+                    values[key] = variable.value
+            state['matrices'][name] = values
+        for name, queue in self.queues.items():
+            state['queues'][name] = dict((handle.name, handle.when()) for handle in queue.handles()
+                                         if handle.name is not None)
+        temporary = self.path + '.tmp'
+        with self.lock:
+            with open(temporary, 'wb') as snapshot:
+                snapshot.write(header)
+                cPickle.dump(state, snapshot, cPickle.HIGHEST_PROTOCOL)
+                snapshot.flush()
+                os.fsync(snapshot.fileno())
+            os.rename(temporary, self.path)
+
+    def load(self):
+        """
+        reads the snapshot and puts its schedules in the schedule cache
+        :return: True if there was a snapshot to load. False if there was none or it could not be read, in which case
+        the state is empty
+        """
+        try:
+            with open(self.path, 'rb') as snapshot:
+                if snapshot.readline() != header:
+                    raise ValueError(self.path + ' is not a snapshot this version can read')
+                state = cPickle.load(snapshot)
+            if not all(part in state for part in ('schedules', 'matrices', 'queues')):
+                raise ValueError(self.path + ' is missing part of the state')
+        except IOError as error:
+            if error.errno != errno.ENOENT:
+                print 'could not read', self.path + ', starting with an empty state'
+                traceback.print_exc()
+            self.state = None
+            return False
+        except Exception:  # a damaged pickle can raise nearly anything: UnpicklingError, EOFError, ImportError...
+            print 'could not load', self.path + ', starting with an empty state'
+            traceback.print_exc()
+            self.state = None
+            return False
+        self.state = state
+        for (time_format, target_time), schedule in state['schedules']:
+            Classes.schedule_cache.put(time_format, target_time, schedule)
+        return True
+
+    def restore(self, policy='coalesce', max_missed=100):
+        """
+        puts the loaded values back into the registered matrices and the loaded times back into the registered
+        queues. Restored variables do not alert their listeners, but are posted by the matrix's next post().
+        :param policy: what to do with timers that were due while the system was down, see the module docstring
+        :param max_missed: most runs posted per timer with 'fire-late'
+        """
+        if policy not in policies:
+            raise ValueError('policy must be one of ' + ', '.join(policies))
+        if self.state is None:
+            return
+        for name, values in self.state['matrices'].items():
+            matrix = self.matrices.get(name)
+            if matrix is None:
+                continue
+            for key, value in values.items():
+                variable = matrix.variables.get(key)
+                if isinstance(variable, Classes.Variable):
+                    variable.restore(value)
+                    matrix.old_values.pop(key, None)
+                    matrix.mark_dirty(key)
+        now = datetime.datetime.today()
+        for name, times in self.state['queues'].items():
+            queue = self.queues.get(name)
+            if queue is None:
+                continue
+            for handle in queue.handles():
+                when = times.get(handle.name)
+                if when is None:
+                    continue
+                if when > now:
+                    handle.reschedule(when)
+                else:
+                    self.catch_up(handle, when, now, policy, max_missed)
+
+    def catch_up(self, handle, when, now, policy, max_missed):
+        """
+        handles a timer that was due at 'when', before 'now'
+        """
+        missed = 1
+        schedule = getattr(handle.obj, 'schedule', None)
+        if schedule is not None:  # count the other runs of a TimeVariable that were missed
+            missed = 1 + len([time for time in schedule.next_times(max_missed, when) if time <= now])
+        self.missed += missed
+        if policy == 'skip':
+            return
+        if policy == 'coalesce':
+            missed = 1
+        upcoming = handle.obj.value
+        for i in range(min(missed, max_missed)):
+            handle.obj.post()
+        if schedule is not None:  # each post() moved the TimeVariable on from the run it was already waiting for
+            handle.obj.value = upcoming
+        handle.reschedule()
@@ -0,0 +1,270 @@
+"""
+sends the state of output drivers to network devices, e.g. Wi-Fi LED controllers, without connecting on every post.
+Connections are kept open in a ConnectionPool, one per device, and shared by every driver writing to that device. A
+connection that fails is retried with exponential backoff, and the last state written for a device is sent once it is
+back. Connections are made without blocking: while a device is still being connected to, the others are sent to, and
+its packet is tried again on the next frame. So a device that is off does not hold up the others.
+Writes are coalesced per device: a device is sent at most one packet per 'frame' seconds, and a packet always carries
+the latest state written for it. Posts that come in while a packet is waiting replace it instead of queueing behind it.
+A device that has not been written to for a frame is sent to straight away.
+example:
+    transport = Transport(frame=.02)
+    transport.start()
+    lights = OutputDriver(variables, transport.poster(('192.168.1.40', 5577), encode))
+where encode(driver) returns the bytes to send. See FakeDevice.py for a device to test against.
+"""
+import os
+import time
+import errno
+import heapq
+import random
+import select
+import socket
+import threading
+
+import Classes
+
+
+class Connection():
+    """
+    a connection to one device that reconnects, with backoff, when it fails. Connecting never blocks, see ready()
+    """
+
+    def __init__(self, address, protocol='tcp', timeout=.05, connect_timeout=1.0, backoff=.05, max_backoff=5.0):
+        """
+        :param address: (host, port) of the device
+        :param protocol: 'tcp' or 'udp'
+        :param timeout: seconds a send may block for. Kept short, the sending thread is shared by every device
+        :param connect_timeout: seconds a connection may take to be made before it counts as failed. Nothing waits
+        for it, the connection is checked on each send
+        :param backoff: seconds to wait before retrying after the first failure, doubled on every failure after that
+        :param max_backoff: longest wait between retries
+        """
+        self.address = address
+        self.protocol = protocol
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.socket = None
+        self.connecting_since = None  # time.time() the connection being made was started, None once it is made
+        self.failures = 0  # failures in a row
+        self.retry_at = 0.0  # time.time() before which no connection is tried
+        self.connects = 0
+        self.errors = 0
+
+    def connect(self):
+        """
+        starts connecting, without waiting for the connection to be made
+        """
+        if self.protocol == 'udp':
+            connection = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        else:
+            connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection.setblocking(0)
+        try:
+            error = connection.connect_ex(self.address)
+        except socket.error:
+            connection.close()
+            raise
+        if error not in (0, errno.EISCONN, errno.EINPROGRESS, errno.EALREADY, errno.EWOULDBLOCK):
+            connection.close()
+            raise socket.error(error, os.strerror(error))
+        self.socket = connection
+        self.connecting_since = time.time()
+
+    def ready(self):
+        """
+        :return: True once the connection is made, False while it is still being made. Raises socket.error if making
+        it failed or took longer than connect_timeout
+        """
+        if self.connecting_since is None:
+            return True
+        if not select.select([], [self.socket], [], 0)[1]:
+            if time.time() - self.connecting_since > self.connect_timeout:
+                raise socket.timeout('no connection after ' + str(self.connect_timeout) + ' seconds')
+            return False
+        error = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            raise socket.error(error, os.strerror(error))
+        self.socket.settimeout(self.timeout)
+        self.connecting_since = None
+        self.connects += 1
+        return True
+
+    def send(self, data):
+        """
+        sends data, connecting first if needed
+        :return: True if it was sent, False if the device could not be reached, is waiting out its backoff or is still
+        being connected to
+        """
+        if self.socket is None:
+            if time.time() < self.retry_at:
+                return False
+            try:
+                self.connect()
+            except socket.error:
+                self.failed()
+                return False
+        try:
+            if not self.ready():
+                return False
+            self.socket.sendall(data)
+        except socket.error:
+            self.close()
+            self.failed()
+            return False
+        self.failures = 0
+        return True
+
+    def failed(self):
+        self.errors += 1
+        self.failures += 1
+        delay = min(self.max_backoff, self.backoff * 2 ** (self.failures - 1))
+        self.retry_at = time.time() + delay * random.uniform(.5, 1.0)  # spread out devices that failed together
+
+    def close(self):
+        if self.socket is not None:
+            try:
+                self.socket.close()
+            except socket.error:
+                pass
+            self.socket = None
+            self.connecting_since = None
+
+
+class ConnectionPool():
+    """
+    one Connection per device and protocol, made when first asked for
+    """
+
+    def __init__(self, **options):
+        """
+        :param options: keyword arguments for every Connection, e.g. timeout or backoff
+        """
+        self.options = options
+        self.connections = {}  # (address, protocol): Connection
+        self.lock = threading.Lock()
+
+    def get(self, address, protocol='tcp'):
+        key = (tuple(address), protocol)
+        connection = self.connections.get(key)
+        if connection is None:
+            with self.lock:
+                connection = self.connections.get(key)
+                if connection is None:
+                    connection = self.connections[key] = Connection(key[0], protocol, **self.options)
+        return connection
+
+    def close(self):
+        with self.lock:
+            for connection in self.connections.values():
+                connection.close()
+            self.connections.clear()
+
+
+class Transport():
+    """
+    coalesces writes per device and sends them from a thread of its own, over pooled connections
+    """
+
+    def __init__(self, frame=.02, pool=None, name='transport'):
+        """
+        :param frame: least time, in seconds, between two packets to the same device
+        :param pool: ConnectionPool to use, a new one by default
+        """
+        self.frame = frame
+        self.pool = pool or ConnectionPool()
+        self.name = name
+        self.pending = {}  # (address, protocol): latest data not sent yet
+        self.due = []  # heap of (time.time() to send at, (address, protocol)), one per key in pending
+        self.last_sent = {}  # (address, protocol): time.time() the last packet was sent
+        self.condition = Classes.PipeCondition()
+        self.stopped = False  # set by stop(), before or after the thread has started
+        self.thread = None
+        self.written = 0
+        self.sent = 0
+        self.coalesced = 0  # writes replaced by a later one before they were sent
+        self.failed = 0  # sends that failed because the device could not be reached. They are retried
+        self.send_time = Classes.Histogram()
+
+    def write(self, address, data, protocol='tcp'):
+        """
+        sets the data to send to a device. Never blocks on the network.
+        """
+        key = (tuple(address), protocol)
+        with self.condition:
+            self.written += 1
+            if key in self.pending:
+                self.pending[key] = data
+                self.coalesced += 1
+                return
+            self.pending[key] = data
+            when = max(time.time(), self.last_sent.get(key, 0.0) + self.frame)
+            heapq.heappush(self.due, (when, key))
+            if self.due[0][1] == key:
+                self.condition.notify()
+
+    def poster(self, address, encode, protocol='tcp'):
+        """
+        :param encode: function returning the bytes to send when passed the OutputDriver and its postArgs
+        :return: a post_method for an OutputDriver that writes to the device at address through this transport
+        """
+        def post(driver, *post_args):
+            self.write(address, encode(driver, *post_args), protocol)
+        return post
+
+    def run(self):
+        """
+        sends packets as they fall due until stop() is called. Should be run in a thread of its own
+        """
+        while not self.stopped:
+            with self.condition:
+                if not self.due:
+                    self.condition.wait()
+                    continue
+                when, key = self.due[0]
+                delay = when - time.time()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                heapq.heappop(self.due)
+                data = self.pending.pop(key)
+                self.last_sent[key] = time.time()
+            connection = self.pool.get(*key)
+            start = time.time()
+            if connection.send(data):
+                self.sent += 1
+            else:
+                if connection.connecting_since is None:  # not just still connecting
+                    self.failed += 1
+                with self.condition:
+                    if key not in self.pending:  # keep the state for when the device is back, unless it is stale
+                        self.pending[key] = data
+                        heapq.heappush(self.due, (max(connection.retry_at, time.time() + self.frame), key))
+            self.send_time.observe(time.time() - start)
+
+    def start(self):
+        """
+        runs the transport in a daemon thread
+        :return: the thread
+        """
+        self.thread = threading.Thread(target=self.run, name=self.name)
+        self.thread.daemon = True
+        self.thread.start()
+        return self.thread
+
+    def stop(self):
+        """
+        stops sending, closes the connections and, once the thread has ended, the pipe it waits on. A stopped
+        transport can not be started again
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(1)
+        self.pool.close()
+        if self.thread is None or not self.thread.is_alive():
+            self.condition.close()